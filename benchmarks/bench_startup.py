@@ -0,0 +1,59 @@
+"""
+Measures the cold-start cost of a workflow script: starting a fresh interpreter, importing the workflow engine and the task modules, and running entry_point discovery. Each sample is a new process, so
+nothing is shared between samples other than the operating system's file cache.
+
+To run, from the root of the repository:
+
+python benchmarks/bench_startup.py [samples]
+
+The baseline is a bare interpreter start; the difference between the two is what the devops package adds. It also lists the modules that are loaded eagerly and shouldn't be (see LAZY_MODULES).
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy third party / standard library modules that should only be imported when a task actually needs them.
+LAZY_MODULES = ['colorama', 'requests', 'xlrd', 'multiprocessing', 'concurrent.futures', 'logging.handlers']
+
+WORKFLOW_SCRIPT = '''
+import sys
+from devops.workflow.workflow import *
+from devops.workflow.core import *
+from devops.workflow.tasks import datatransformation, git, system, web
+
+@entry_point
+def main():
+    pass
+
+print(' '.join(name for name in {lazy!r} if name in sys.modules))
+'''.format(lazy=LAZY_MODULES)
+
+
+def sample(code):
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return time.perf_counter() - start, output.decode().strip()
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    subprocess.check_call([sys.executable, '-m', 'compileall', '-q', os.path.join(ROOT, 'devops')])
+
+    baseline = [sample('pass')[0] for i in range(samples)]
+    results = [sample(WORKFLOW_SCRIPT) for i in range(samples)]
+    workflow = [seconds for seconds, loaded in results]
+
+    print('Interpreter start:            {:7.1f} ms (median of {})'.format(statistics.median(baseline) * 1000, samples))
+    print('Workflow script start:        {:7.1f} ms'.format(statistics.median(workflow) * 1000))
+    print('Added by devops:              {:7.1f} ms'.format((statistics.median(workflow) - statistics.median(baseline)) * 1000))
+    print('Eagerly loaded heavy modules: {}'.format(results[0][1] or 'none'))
+
+
+if __name__ == '__main__':
+    main()
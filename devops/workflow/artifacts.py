@@ -0,0 +1,456 @@
+"""
+The artifacts module provides a content-addressed store for the files that steps produce, so that the same output is only ever kept on disk once.
+
+ArtifactStore keeps every file it is given under the SHA-256 of its contents. Putting a file that is already in the store costs one read (to hash it) and no space. Materializing a file from the store
+hardlinks it into place where possible, reflinks it (on file systems that support copy-on-write clones, e.g. Btrfs and XFS) otherwise, and only falls back to a plain copy across file systems. Objects
+in the store are read-only, and so is every hardlink to one; a task that wants to change a materialized file in place should delete it and write a new one. A directory is stored as a manifest (itself
+an object) listing the objects of its files.
+
+The store is evicted least recently used first once it grows beyond maxBytes. Stored objects that are hardlinked elsewhere stay intact there when they are evicted from the store.
+
+The store lives in the directory given by directory in the [Artifacts] section of appsettings.cfg (by default, a per-user directory, see core.get_private_directory()). A store that other users could
+write to (one that isn't owned by the current user, or is writable by its group or others) is not trusted: its objects are copied rather than hardlinked, and their digest is checked before they are
+used.
+
+Executable files keep their mode: they are materialized as copies (or reflinks) rather than as hardlinks to the read-only stored object, and are not linked back when a tree is put. Tasks use it through the Artifact marker,
+which can stand in for a file path much like a Stream: an Artifact destination puts the task's output into the store and publishes its digest as a workflow variable under the artifact's name, and an
+Artifact source materializes it again, e.g.:
+
+workflow.addstep('Retrieve XLS', web.HttpDataRetrieval(url, Artifact('xls')))
+workflow.addstep('Convert XLS to CSV', datatransformation.XlsToCsv(Artifact('xls'), Artifact('csv')))
+workflow.addstep('Publish CSV', system.Copy(Artifact('csv'), '/srv/data/margins.csv'))
+
+Copy, HttpDataRetrieval, XlsToCsv and Clone support Artifacts.
+"""
+
+import errno
+import io
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from functools import lru_cache
+from .core import file_digest
+from .core import get_private_directory
+from .core import get_system_config_value
+
+
+class ArtifactMissingError(KeyError):
+
+    """
+    Raised when an artifact is not in the store, e.g. because it has been evicted.
+    """
+
+    pass
+
+
+class ArtifactCorruptError(ValueError):
+
+    """
+    Raised when an object in a store that isn't trusted doesn't match its digest, i.e. it has been changed.
+    """
+
+    pass
+
+
+class Artifact(object):
+
+    """
+    A marker used in place of a file or directory path, naming a workflow variable that holds the digest of an artifact in the ArtifactStore.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Artifact({!r})'.format(self.name)
+
+
+def _reflink(source, destination):
+    """
+    Makes destination a copy-on-write clone of source. Raises OSError if the file system doesn't support it.
+    """
+
+    import fcntl
+    FICLONE = 0x40049409
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+_OBJECT_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+class ArtifactStore(object):
+
+    """
+    A content-addressed store of files. To use:
+
+    store = ArtifactStore('/var/cache/devops/artifacts', max_bytes=10 * 1024 ** 3)
+    digest = store.put('build/output.tar.gz')
+    store.materialize(digest, 'deploy/output.tar.gz')
+
+    Instance Variables
+    =====================================
+    - self.root = The directory the store lives in.
+    - self.max_bytes = The size the store is evicted down to, least recently used first, when it grows beyond it. 0 means no limit.
+    - self.verify = If true, objects are never hardlinked out of the store and their digest is checked before they are used. By default, true for a store that other users could write to.
+    """
+
+    def __init__(self, root, max_bytes=0, verify=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+        self.verify = not _is_owned_privately(root) if verify is None else verify
+
+    def path(self, digest):
+        """
+        Returns the path of the object with the given digest. The object is read-only. Raises ArtifactMissingError if it is not in the store.
+        """
+
+        path = os.path.join(self.root, 'objects', digest[:2], digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            raise ArtifactMissingError(digest)
+        except PermissionError:
+            # An object put by another user of a shared store; it just isn't marked as recently used.
+            pass
+        return path
+
+    def __contains__(self, digest):
+        return os.path.exists(os.path.join(self.root, 'objects', digest[:2], digest))
+
+    def _temporary_path(self):
+        return os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+
+    def _add(self, temporary, digest):
+        """
+        Moves the file at temporary into the store as the object for digest, unless it is already there.
+        """
+
+        destination = os.path.join(self.root, 'objects', digest[:2], digest)
+        if os.path.exists(destination):
+            os.remove(temporary)
+            os.utime(destination)
+            return destination
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.chmod(temporary, _OBJECT_MODE)
+        os.replace(temporary, destination)
+        self._grow(os.path.getsize(destination))
+        return destination
+
+    def put(self, path, link_back=False):
+        """
+        Puts the file at path into the store and returns its digest. If link_back is true, path itself is replaced by a (read-only) hardlink to the stored object, so that the two share their space.
+        In a store that is verified, path is replaced by a checked copy of an object that was already stored instead, and ArtifactCorruptError is raised (leaving path as it was) if the object doesn't
+        match its digest.
+        """
+
+        with open(path, 'rb') as source:
+            digest = file_digest(source).hexdigest()
+        if digest in self:
+            if link_back:
+                self._replace_with_link(self.path(digest), path, allow_hardlink=not self.verify, digest=digest)
+            return digest
+        temporary = self._temporary_path()
+        # With link_back, path is going to share the stored object anyway, so it can simply be hardlinked into the store.
+        self._link_or_copy(path, temporary, allow_hardlink=link_back)
+        stored = self._add(temporary, digest)
+        if link_back and not os.path.samefile(stored, path):
+            self._replace_with_link(stored, path, allow_hardlink=not self.verify, digest=digest)
+        return digest
+
+    def put_fileobj(self, fileobj):
+        """
+        Puts everything read from the binary file object fileobj into the store and returns its digest. The data is hashed while it is written, so it is only read once.
+        """
+
+        import hashlib
+        digest = hashlib.sha256()
+        temporary = self._temporary_path()
+        try:
+            with open(temporary, 'wb') as target:
+                for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    target.write(chunk)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        digest = digest.hexdigest()
+        self._add(temporary, digest)
+        return digest
+
+    def put_bytes(self, data):
+        return self.put_fileobj(io.BytesIO(data))
+
+    def put_tree(self, directory, link_back=False):
+        """
+        Puts every file below directory into the store, followed by a manifest of the directory, and returns the digest of the manifest. Symbolic links and empty directories are recorded in the
+        manifest as they are.
+        """
+
+        manifest = {'files': {}, 'links': {}, 'directories': []}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            relative = os.path.relpath(dirpath, directory)
+            for name in list(dirnames):
+                if os.path.islink(os.path.join(dirpath, name)):
+                    dirnames.remove(name)
+                    filenames.append(name)
+                else:
+                    manifest['directories'].append(os.path.normpath(os.path.join(relative, name)))
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.normpath(os.path.join(relative, name))
+                if os.path.islink(path):
+                    manifest['links'][key] = os.readlink(path)
+                else:
+                    mode = os.stat(path).st_mode & 0o777
+                    # Linking an executable back would leave it with the read-only mode of the stored object.
+                    manifest['files'][key] = [self.put(path, link_back and not mode & 0o111), mode]
+        return self.put_bytes(json.dumps(manifest, sort_keys=True).encode())
+
+    def materialize(self, digest, destination, allow_hardlink=True):
+        """
+        Makes destination a copy of the object with the given digest: a hardlink if allow_hardlink is true and the store is on the same file system, otherwise a reflink or, failing that, a copy. If
+        self.verify is true, the copy is never a hardlink, and ArtifactCorruptError is raised if it doesn't match digest.
+        """
+
+        self._replace_with_link(self.path(digest), destination, allow_hardlink and not self.verify, digest if self.verify else None)
+
+    def verified_path(self, digest):
+        """
+        Returns path(digest), after checking that the object matches digest if self.verify is true.
+        """
+
+        path = self.path(digest)
+        if self.verify:
+            with open(path, 'rb') as stored:
+                _check_digest(stored, digest, path)
+        return path
+
+    def materialize_tree(self, digest, destination, allow_hardlink=True):
+        """
+        Recreates the directory stored by put_tree() at destination. Files are given the mode they had when they were stored, except that hardlinked (non-executable) files stay read-only.
+        """
+
+        with open(self.verified_path(digest), 'rb') as manifest_file:
+            manifest = json.loads(manifest_file.read().decode())
+        os.makedirs(destination, exist_ok=True)
+        for name in manifest['directories']:
+            os.makedirs(os.path.join(destination, name), exist_ok=True)
+        for name, (object_digest, mode) in manifest['files'].items():
+            path = os.path.join(destination, name)
+            hardlink = allow_hardlink and not mode & 0o111
+            self.materialize(object_digest, path, hardlink)
+            if not hardlink or self.verify:
+                os.chmod(path, mode)
+        for name, target in manifest['links'].items():
+            path = os.path.join(destination, name)
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(target, path)
+
+    def _replace_with_link(self, source, destination, allow_hardlink=True, digest=None):
+        directory = os.path.dirname(os.path.abspath(destination))
+        temporary = os.path.join(directory, '.{}.tmp'.format(uuid.uuid4().hex))
+        self._link_or_copy(source, temporary, allow_hardlink)
+        if digest is not None:
+            # The copy is checked rather than the stored object, so the object can't be changed between the check and the copy.
+            try:
+                with open(temporary, 'rb') as copy:
+                    _check_digest(copy, digest, source)
+            except BaseException:
+                os.remove(temporary)
+                raise
+        os.replace(temporary, destination)
+
+    def _link_or_copy(self, source, destination, allow_hardlink=True):
+        if allow_hardlink:
+            try:
+                os.link(source, destination)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+                    raise
+        try:
+            _reflink(source, destination)
+            return
+        except (OSError, ImportError):
+            pass
+        shutil.copyfile(source, destination)
+
+    def _grow(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += size
+            over = self.max_bytes and self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _objects(self):
+        objects = os.path.join(self.root, 'objects')
+        for prefix in os.listdir(objects):
+            directory = os.path.join(objects, prefix)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def size(self):
+        """
+        Returns the total size, in bytes, of the objects in the store.
+        """
+
+        return sum(st.st_size for path, st in self._objects())
+
+    def evict(self, max_bytes=None):
+        """
+        Removes the least recently used objects until the store is no bigger than max_bytes (by default, self.max_bytes). Returns the number of bytes removed. Temporary files left behind by interrupted
+        puts are cleaned up as well.
+        """
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        objects = sorted(self._objects(), key=lambda item: item[1].st_mtime)
+        total = sum(st.st_size for path, st in objects)
+        removed = 0
+        for path, st in objects:
+            if total - removed <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += st.st_size
+            except FileNotFoundError:
+                pass
+        temporary = os.path.join(self.root, 'tmp')
+        for name in os.listdir(temporary):
+            path = os.path.join(temporary, name)
+            try:
+                if os.lstat(path).st_mtime < time.time() - 86400:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._size = total - removed
+        return removed
+
+
+def _is_owned_privately(directory):
+    """
+    Returns True if directory is owned by the current user and no one else can write to it. Always True where ownership can't be checked.
+    """
+
+    if not hasattr(os, 'getuid'):
+        return True
+    status = os.stat(directory)
+    return status.st_uid == os.getuid() and not status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _check_digest(fileobj, digest, path):
+    if file_digest(fileobj).hexdigest() != digest:
+        raise ArtifactCorruptError('{} does not match its digest {}'.format(path, digest))
+
+
+@lru_cache(maxsize=None)
+def get_artifact_store():
+    """
+    Returns the ArtifactStore configured in the [Artifacts] section of appsettings.cfg, which is shared by all tasks in this process.
+    """
+
+    directory = get_system_config_value('Artifacts', 'directory', fallback='') or get_private_directory('artifacts')
+    return ArtifactStore(directory, int(get_system_config_value('Artifacts', 'maxBytes', fallback='0')))
+
+
+# The prefix of the published digest of a directory; the digest that follows is that of its manifest.
+TREE_PREFIX = 'tree:'
+
+
+def publish_path(task, artifact, path, link_back=False):
+    """
+    Puts the file or directory at path into the store and publishes its digest in the task's exhaust under the artifact's name (for a directory, prefixed with TREE_PREFIX). If link_back is true, the
+    files at path are replaced by (read-only) hardlinks to the stored copies, which saves copying them into the store.
+    """
+
+    store = get_artifact_store()
+    if os.path.isdir(path):
+        digest = TREE_PREFIX + store.put_tree(path, link_back)
+    else:
+        digest = store.put(path, link_back)
+    task.exhaust[artifact.name] = digest
+    return digest
+
+
+def publish_fileobj(task, artifact, fileobj):
+    """
+    Puts everything read from fileobj into the store and publishes its digest in the task's exhaust under the artifact's name.
+    """
+
+    digest = get_artifact_store().put_fileobj(fileobj)
+    task.exhaust[artifact.name] = digest
+    return digest
+
+
+class _DestinationBuffer(io.BytesIO):
+
+    def __init__(self, task, artifact):
+        super().__init__()
+        self.task = task
+        self.artifact = artifact
+
+    def close(self):
+        if not self.closed:
+            self.seek(0)
+            publish_fileobj(self.task, self.artifact, self)
+        super().close()
+
+
+def open_destination(task, artifact):
+    """
+    Opens a binary file object for writing an artifact. What is written is put into the store, and its digest published in the task's exhaust, when the file object is closed.
+    """
+
+    return _DestinationBuffer(task, artifact)
+
+
+def temporary_directory():
+    """
+    Creates and returns a temporary directory on the same file system as the store, for a task to write output into that is then published with publish_path(link_back=True).
+    """
+
+    return tempfile.mkdtemp(dir=os.path.join(get_artifact_store().root, 'tmp'))
+
+
+def source_path(task, artifact):
+    """
+    Returns the (read-only) path in the store of the artifact named by artifact in the task's input, so that it can be read without being materialized. In a store that isn't trusted, its digest is
+    checked first.
+    """
+
+    return get_artifact_store().verified_path(task.input[artifact.name])
+
+
+def materialize(task, artifact, destination):
+    """
+    Materializes the artifact named by artifact in the task's input at destination. Directories stored with put_tree() are recreated as directories.
+    """
+
+    digest = task.input[artifact.name]
+    if digest.startswith(TREE_PREFIX):
+        get_artifact_store().materialize_tree(digest[len(TREE_PREFIX):], destination)
+    else:
+        get_artifact_store().materialize(digest, destination)
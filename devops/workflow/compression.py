@@ -0,0 +1,300 @@
+"""
+The compression module provides small helpers for compressing files. It is used by core for compressing finished log files.
+
+It also (de)compresses data as it streams between tasks: open_decompressed() and compressing_reader() wrap a file object that is being read, and open_compressed() one that is being written, so that tasks
+such as HttpDataRetrieval and XlsToCsv never write out or read back an uncompressed intermediate file. gzip, zstd and zip are supported.
+
+gzip support comes from the standard library. zstd support is optional and requires the zstandard module (https://pypi.python.org/pypi/zstandard); if it isn't installed, compress_file() uses gzip
+instead, while the streaming helpers raise ImportError rather than write gzip data where zstd was asked for.
+"""
+
+import gzip
+import io
+import os
+import shutil
+
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def resolve_method(method):
+    """
+    Returns the compression method that will actually be used for method. 'zstd' falls back to 'gzip' when zstandard isn't installed; 'none' or an empty value returns None.
+    """
+
+    if not method or method.lower() == 'none':
+        return None
+    method = method.lower()
+    if method not in SUFFIXES:
+        raise ValueError('Unsupported compression method: {}'.format(method))
+    if method == 'zstd' and _zstandard() is None:
+        return 'gzip'
+    return method
+
+
+def is_compressed(path):
+    """
+    Returns True if path has the suffix of one of the supported compression methods.
+    """
+
+    return path.endswith(tuple(SUFFIXES.values()))
+
+
+def compress_file(path, method='gzip', remove_source=True):
+    """
+    Compresses path using method and returns the path of the compressed file. The compressed output is written to a temporary file first and renamed into place, so a reader will never see a
+    partially written archive.
+    """
+
+    method = resolve_method(method)
+    if method is None:
+        return path
+
+    destination = path + SUFFIXES[method]
+    temporary = destination + '.tmp'
+    with open(path, 'rb') as source:
+        if method == 'zstd':
+            with open(temporary, 'wb') as raw:
+                with _zstandard().ZstdCompressor().stream_writer(raw) as target:
+                    shutil.copyfileobj(source, target)
+        else:
+            with gzip.open(temporary, 'wb') as target:
+                shutil.copyfileobj(source, target)
+    shutil.copystat(path, temporary)
+    os.replace(temporary, destination)
+    if remove_source:
+        os.remove(path)
+    return destination
+
+
+# Streaming (de)compression of data as it passes between tasks. Unlike compress_file(), these work on file objects rather than files.
+
+_MAGIC_NUMBERS = ((b'\x1f\x8b', 'gzip'), (b'\x28\xb5\x2f\xfd', 'zstd'), (b'PK\x03\x04', 'zip'))
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _resolve_streaming_method(method):
+    # A task given compress='zstd' names its output for zstd, so quietly writing gzip instead would be wrong.
+    if method and method.lower() == 'zstd' and _zstandard() is None:
+        raise ImportError('Compressing zstd data requires the zstandard module')
+    return resolve_method(method)
+
+
+class _PrefixedReader(object):
+
+    """
+    A binary file object that returns prefix, and then the rest of fileobj. Used to put back bytes that were read to sniff the compression method.
+    """
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def sniff_method(fileobj):
+    """
+    Reads the first bytes of fileobj to recognize gzip, zstd or zip data by its magic number. Returns the method (or None) and a file object to read all of the data from, including the bytes sniffed.
+    """
+
+    head = fileobj.read(4)
+    for magic, method in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return method, _PrefixedReader(head, fileobj)
+    return None, _PrefixedReader(head, fileobj)
+
+
+class _DecompressingReader(object):
+
+    """
+    Wraps a decompressing file object. Once the decompressed data ends, the rest of the compressed source is read (and discarded), so that the source always sees its end; e.g. so that a digest of the
+    compressed data is verified before the last of the decompressed data is handed on.
+    """
+
+    def __init__(self, decompressed, source, closables=()):
+        self.decompressed = decompressed
+        self.source = source
+        self.closables = closables
+
+    def read(self, size=-1):
+        data = self.decompressed.read(size)
+        if not data or size is None or size < 0:
+            for chunk in iter(lambda: self.source.read(_CHUNK_SIZE), b''):
+                pass
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        for closable in self.closables:
+            closable.close()
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_decompressed(fileobj, method):
+    """
+    Returns a binary file object that decompresses the data read from fileobj as it is read. method is gzip, zstd, zip or 'auto', which recognizes the method from the data itself (and passes data that
+    isn't compressed through as it is).
+
+    A zip archive keeps its directory at its end, so it can't be decompressed as it arrives: the archive is spooled (in memory, or to a temporary file once it is large) and its first member returned.
+    """
+
+    if method == 'auto':
+        method, fileobj = sniff_method(fileobj)
+        if method is None:
+            return fileobj
+    if method == 'gzip':
+        decompressed = gzip.GzipFile(fileobj=fileobj, mode='rb')
+        return _DecompressingReader(decompressed, fileobj, (decompressed,))
+    if method == 'zstd':
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise ImportError('Decompressing zstd data requires the zstandard module')
+        decompressed = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+        return _DecompressingReader(decompressed, fileobj, (decompressed,))
+    if method == 'zip':
+        import tempfile
+        import zipfile
+        spool = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        shutil.copyfileobj(fileobj, spool)
+        spool.seek(0)
+        archive = zipfile.ZipFile(spool)
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        if not members:
+            raise ValueError('The zip archive is empty')
+        return _DecompressingReader(archive.open(members[0]), fileobj, (archive, spool))
+    raise ValueError('Unsupported compression method: {}'.format(method))
+
+
+class _CompressingReader(object):
+
+    """
+    A binary file object that returns the data read from fileobj, gzip compressed.
+    """
+
+    def __init__(self, fileobj):
+        import zlib
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        self.pending = b''
+        self.finished = False
+
+    def read(self, size=-1):
+        while not self.finished and (size is None or size < 0 or len(self.pending) < size):
+            chunk = self.fileobj.read(_CHUNK_SIZE)
+            if chunk:
+                self.pending += self.compressor.compress(chunk)
+            else:
+                self.pending += self.compressor.flush()
+                self.finished = True
+        if size is None or size < 0:
+            data, self.pending = self.pending, b''
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compressing_reader(fileobj, method):
+    """
+    Returns a binary file object that returns the data read from fileobj, compressed with method (gzip, or zstd, which raises ImportError if zstandard isn't installed) as it is read. A zip archive
+    can only be written, see open_compressed().
+    """
+
+    if method == 'zip':
+        raise ValueError('zip compression is only supported when writing, e.g. by XlsToCsv')
+    method = _resolve_streaming_method(method)
+    if method is None:
+        return fileobj
+    if method == 'zstd':
+        return _zstandard().ZstdCompressor().stream_reader(fileobj)
+    return _CompressingReader(fileobj)
+
+
+def open_compressed(fileobj, method, member_name='data'):
+    """
+    Returns a binary file object that compresses what is written to it into fileobj, with method (gzip, zstd or zip). Closing it finishes the compressed data and closes fileobj. For zip, what is written
+    becomes the only member of the archive, named member_name. zstd raises ImportError if zstandard isn't installed.
+    """
+
+    if method == 'zip':
+        import zipfile
+        archive = zipfile.ZipFile(fileobj, mode='w', compression=zipfile.ZIP_DEFLATED)
+        return _ClosingWriter(archive.open(member_name, mode='w'), (archive, fileobj))
+    method = _resolve_streaming_method(method)
+    if method is None:
+        return fileobj
+    if method == 'zstd':
+        return _zstandard().ZstdCompressor().stream_writer(fileobj)
+    return _ClosingWriter(gzip.GzipFile(fileobj=fileobj, mode='wb'), (fileobj,))
+
+
+class _ClosingWriter(io.RawIOBase):
+
+    """
+    A writable binary file object that writes to writer, and closes writer and then closables when it is closed.
+    """
+
+    def __init__(self, writer, closables):
+        super().__init__()
+        self.writer = writer
+        self.closables = closables
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.writer.close()
+            for closable in self.closables:
+                closable.close()
+        super().close()
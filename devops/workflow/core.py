@@ -9,17 +9,20 @@ The colorize_output decorator initializes the colorama module. For Windows users
     color codes will be printed out in place of color if colorama isn't initialized. In the future, it is intended to be an optional feature.
 The basic_logging_configuration_setup decorator will setup logging with a "basic" configuration. This means that both file and console logging are setup. To setup the logging directory, it should be set in
     \devops\workflow\appsettings.cfg.
+    Log rotation, compression and retention (see the logrotation module) are configured in the [Logging] section of appsettings.cfg.
+get_private_directory() returns a per-user directory, created private, for caches and secrets that other users must not be able to tamper with.
+OutputMode, set_output_mode() and is_batch_output() determine whether console output is styled for an interactive terminal or written plainly for batch (cron) runs. The mode is set with outputMode
+    in the [ConsoleOutput] section of appsettings.cfg, or with set_output_mode().
 The variable_config decorator sets up VariableManager for use in scripts. Note that it passes the instance of VariableManager to the function it decorates.
 """
 
-import inspect
-import colorama
 import configparser
 import os
 import logging
 import datetime
 import sys
 from functools import wraps
+from functools import lru_cache
 
 
 class Singleton(type):
@@ -68,10 +71,11 @@ def entry_point(func):
 
     """
     The entry_point decorator was adapted from code located at: http://slowchop.com/2011/01/25/automain/. It allows the user to not have to type the standard if __name__ == '__main__' : main()
+
+    Only the calling frame's globals are looked at; building the whole stack (as inspect.stack() does) reads source files for every frame, which is a noticeable part of a short workflow's startup time.
     """
 
-    parent = inspect.stack()[1][0]
-    name = parent.f_locals.get('__name__', None)
+    name = sys._getframe(1).f_globals.get('__name__', None)
     if name == '__main__':
         func()
     return func
@@ -85,16 +89,120 @@ def colorize_output(func):
     """
 
     def decorate():
+        import colorama
         colorama.init(autoreset=True)
         func()
     return decorate
 
 
-def get_system_config_value(header, key):
+_NO_FALLBACK = object()
+
+
+def parse_address(text):
+    """
+    Parses a socket address from a config value or command line argument: host:port for TCP, or a filesystem path for a Unix socket.
+    """
+
+    if ':' in text and not text.startswith('/'):
+        host, port = text.rsplit(':', 1)
+        return host, int(port)
+    return text
+
+
+@lru_cache(maxsize=None)
+def _get_system_config():
     config = configparser.ConfigParser()
     path = os.path.dirname(__file__)
     config.read(os.path.join(path, r'appsettings.cfg'))
-    return config[header][key]
+    return config
+
+
+class OutputMode(object):
+
+    """
+    An "enumeration" class, used when determining how WorkflowTask items write their console output.
+
+    - Interactive: Output is styled with colorama and workflow variables are printed in full.
+    - Batch: Output is written without styles and large workflow variable dumps are abbreviated. This is meant for runs under cron or another scheduler, where nobody is watching the console.
+    - Auto: Batch if stdout is not a TTY, Interactive otherwise.
+    """
+
+    Auto = 'auto'
+    Batch = 'batch'
+    Interactive = 'interactive'
+
+
+_output_mode = None
+
+
+def set_output_mode(mode):
+    """
+    Explicitly sets the OutputMode for this process, overriding the outputMode setting in appsettings.cfg. Passing None goes back to using the configured value.
+    """
+
+    global _output_mode
+    _output_mode = mode
+
+
+def is_batch_output():
+    """
+    Returns True if console output should currently be written in OutputMode.Batch.
+    """
+
+    mode = _output_mode or get_system_config_value('ConsoleOutput', 'outputMode', fallback=OutputMode.Interactive)
+    if mode == OutputMode.Auto:
+        isatty = getattr(sys.stdout, 'isatty', None)
+        return not (isatty is not None and isatty())
+    return mode == OutputMode.Batch
+
+
+def file_digest(fileobj, algorithm='sha256'):
+    """
+    Returns the hashlib hash object of everything read from the binary file object fileobj. Use .hexdigest() on the result for the usual text form.
+    """
+
+    import hashlib
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(fileobj, algorithm)
+    digest = hashlib.new(algorithm)
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest
+
+
+def get_private_directory(name):
+    """
+    Returns <user cache directory>/devops-workflow/name, the default place for caches and secrets that other users of the machine must not be able to plant or change (e.g. the plan cache, or the daemon's
+    token). The user cache directory is $XDG_CACHE_HOME or ~/.cache (%LOCALAPPDATA% on Windows). The directory is created and checked by ensure_private_directory().
+    """
+
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return ensure_private_directory(os.path.join(base, 'devops-workflow', name))
+
+
+def ensure_private_directory(directory):
+    """
+    Creates directory with mode 0700 if it doesn't exist and returns it. Where ownership can be checked, PermissionError is raised unless it is a directory (not a symbolic link) owned by the current
+    user that no one else can access.
+    """
+
+    import stat
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        status = os.lstat(directory)
+        if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+            raise PermissionError('{} must be a directory owned by the current user that no one else can access'.format(directory))
+    return directory
+
+
+def get_system_config_value(header, key, fallback=_NO_FALLBACK):
+    config = _get_system_config()
+    if fallback is _NO_FALLBACK:
+        return config[header][key]
+    return config.get(header, key, fallback=fallback)
 
 
 def basic_logging_configuration_setup(name=None):
@@ -109,30 +217,35 @@ def basic_logging_configuration_setup(name=None):
 
         @wraps(func)
         def wrapper(*args, **kwargs):
+            from . import compression
+            from .logrotation import RotatingLogFileHandler, maintain_log_directory, _submit_log_maintenance
             datestring = datetime.datetime.now().strftime('.%Y%m%d.%f')
             if '.' in logname:
                 i = logname.rindex('.')
                 prefix = logname[0:i]
                 suffix = logname[i:]
+                logprefix = prefix
                 prefix += datestring
                 customlogname = prefix + suffix
             else:
+                logprefix = logname
                 customlogname = logname + datestring
 
-            config = configparser.ConfigParser()
-            path = os.path.dirname(__file__)
-            config.read(os.path.join(path, r'appsettings.cfg'))
             logdir = get_system_config_value('Default', 'logDirectory')
+            logpath = os.path.join(logdir, customlogname)
+            compression_method = compression.resolve_method(get_system_config_value('Logging', 'compression', fallback='none'))
 
             if not os.path.exists(logdir):
                 os.makedirs(logdir)
 
-            # 1. Setup basic logging configuration. This will log to both the console and the specified file
-            logging.basicConfig(filename=os.path.join(logdir, customlogname),
-                                filemode='w',
-                                level=logging.DEBUG,
-                                format='%(asctime)s:%(levelname)s: %(message)s',
-                                datefmt='%Y/%m/%d %I:%M:%S %p')
+            # 1. Setup basic logging configuration. This will log to both the console and the specified file. The file handler rotates the log by size and age, compressing finished segments.
+            log_fh = RotatingLogFileHandler(logpath,
+                                            max_bytes=int(get_system_config_value('Logging', 'maxBytes', fallback='0')),
+                                            rotate_interval=int(get_system_config_value('Logging', 'rotateInterval', fallback='0')),
+                                            compression_method=compression_method)
+            log_fh.setLevel(logging.DEBUG)
+            log_fh.setFormatter(logging.Formatter(fmt='%(asctime)s:%(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p'))
+            logging.basicConfig(handlers=[log_fh], level=logging.DEBUG)
 
             console = logging.StreamHandler()
             console.setLevel(logging.DEBUG)
@@ -143,11 +256,13 @@ def basic_logging_configuration_setup(name=None):
             # in the log
             w_print_logger = logging.getLogger('w_print_logger')
             w_print_logger.setLevel(logging.DEBUG)
-            w_print_fh = logging.FileHandler(os.path.join(logdir, customlogname))
-            w_print_fh.setLevel(logging.DEBUG)
-            w_print_formatter = logging.Formatter(fmt='%(asctime)s:%(levelname)s: %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p')
-            w_print_fh.setFormatter(w_print_formatter)
-            w_print_logger.addHandler(w_print_fh)
+            w_print_logger.addHandler(log_fh)
+
+            # 3. Apply the retention policy to, and compress, logs left behind by previous runs. This happens in the background so it doesn't hold up the workflow.
+            _submit_log_maintenance(maintain_log_directory, logdir, logprefix + '.', logpath, compression_method,
+                                    int(get_system_config_value('Logging', 'compressIdleSeconds', fallback='300')),
+                                    int(get_system_config_value('Logging', 'retentionDays', fallback='0')),
+                                    int(get_system_config_value('Logging', 'retentionMaxFiles', fallback='0')))
 
             return func(*args, **kwargs)
         return wrapper
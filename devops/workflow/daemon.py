@@ -0,0 +1,471 @@
+"""
+The daemon module runs the workflow engine as a long-running process. Workflows are submitted to it rather than being started from scratch by cron, so interpreter start, imports, config parsing and
+log setup are paid for once, and things that are expensive to build (the HTTP sessions in tasks.web, the cached git mirrors in tasks.git, the worker process pool) stay warm between runs.
+
+The WorkflowDaemon runs submitted workflows on a thread pool, so several can run at the same time, up to maxConcurrentRuns in the [Daemon] section of appsettings.cfg. A workflow is submitted as a factory:
+a callable that builds and returns the MainSequence to run, or the name of one as 'package.module:function'. Each submission gets a Run with a run id, a status and a list of events (step started, step
+finished, etc.) that can be followed while the run progresses. Only the latest maxEventsPerRun events of a run are kept, and finished runs are forgotten once there are more than maxRetainedRuns or
+they finished more than runRetentionSeconds ago. The daemon can also run workflows on a schedule itself.
+
+The HTTP API (see WorkflowDaemon.serve()) is:
+
+POST /runs                  {"workflow": "package.module:function", "name": "...", "variables": {...}} => {"run_id": "..."}
+GET  /runs                  => the status of every retained run
+GET  /runs/<run_id>         => the status of one run
+GET  /runs/<run_id>/events  => the run's events as newline-delimited JSON, streamed until the run finishes. Every event has a sequence number, seq, so a gap shows where events were dropped.
+
+Every request must carry the daemon's token as "Authorization: Bearer <token>". The token is token in the [Daemon] section or, if that is empty, a random token made when the daemon starts and written
+to a file only the daemon's user can read (see read_token()). Only the workflows listed in workflows in the [Daemon] section, or scheduled in [DaemonSchedule], can be submitted by name. The daemon
+listens on 127.0.0.1 (or a Unix socket, which is made accessible to its user only) by default and should not be exposed beyond the machine.
+
+To start the daemon, with the address and schedules from appsettings.cfg:
+
+python -m devops.workflow.daemon
+
+Schedules are read from the [DaemonSchedule] section, one per line, as: name = package.module:function <interval in seconds>
+"""
+
+import collections
+import hmac
+import http.server
+import importlib
+import itertools
+import json
+import logging
+import os
+import secrets
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .core import basic_logging_configuration_setup
+from .core import entry_point
+from .core import get_private_directory
+from .core import get_system_config_value
+from .core import parse_address
+from .core import _get_system_config
+from .workflow import WorkflowListener
+from .workflow import WorkflowTask
+
+
+_STATUS_NAMES = {WorkflowTask.Status.NotYetRun: 'not_yet_run',
+                 WorkflowTask.Status.Running: 'running',
+                 WorkflowTask.Status.CompletedOK: 'completed_ok',
+                 WorkflowTask.Status.CompletedError: 'completed_error'}
+
+
+def load_workflow_factory(name):
+    """
+    Imports and returns the workflow factory named by name, which has the form 'package.module:function'. Modules stay imported, so later submissions of the same workflow don't import it again.
+    """
+
+    module_name, _, attribute = name.partition(':')
+    if not module_name or not attribute:
+        raise ValueError('A workflow must be given as package.module:function, not {}'.format(name))
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def _get_token_path():
+    return os.path.join(get_private_directory('daemon'), 'token')
+
+
+def read_token():
+    """
+    Returns the token that requests to the daemon's HTTP API must carry: token in the [Daemon] section, or else the one the running daemon generated (for the same user), or None.
+    """
+
+    token = get_system_config_value('Daemon', 'token', fallback='')
+    if token:
+        return token
+    try:
+        with open(_get_token_path()) as token_file:
+            return token_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _get_allowed_workflows():
+    """
+    Returns the workflows that may be submitted by name: workflows in the [Daemon] section (separated by commas or whitespace) and those in the [DaemonSchedule] section.
+    """
+
+    allowed = set(get_system_config_value('Daemon', 'workflows', fallback='').replace(',', ' ').split())
+    config = _get_system_config()
+    if config.has_section('DaemonSchedule'):
+        allowed.update(value.split()[0] for name, value in config.items('DaemonSchedule') if value.split())
+    return allowed
+
+
+class Run(object):
+
+    """
+    A single submission of a workflow to the WorkflowDaemon.
+
+    Instance Variables
+    =====================================
+    - self.run_id = The unique id of the run.
+    - self.name = A display name for the run.
+    - self.status = One of the Run.Status values.
+    - self.submitted, self.started, self.finished = Times (as returned by time.time()) of each stage of the run, or None.
+    - self.error = The formatted traceback if the workflow could not be built or raised, otherwise None.
+    - self.events = Dictionaries describing what has happened in the run so far: the latest max_events of them (all of them if max_events is None), each numbered by its seq.
+    - self.event_count = The number of events the run has had, including those that were dropped.
+    """
+
+    class Status(object):
+
+        """
+        An "enumeration" class, used when determining the status of a Run.
+        """
+
+        Queued = 'queued'
+        Running = 'running'
+        Succeeded = 'succeeded'
+        Failed = 'failed'
+
+    def __init__(self, run_id, name, max_events=None):
+        self.run_id = run_id
+        self.name = name
+        self.status = Run.Status.Queued
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.events = collections.deque(maxlen=max_events)
+        self.event_count = 0
+        self._condition = threading.Condition()
+
+    def done(self):
+        return self.status in (Run.Status.Succeeded, Run.Status.Failed)
+
+    def add_event(self, event, **details):
+        details['event'] = event
+        details['time'] = time.time()
+        with self._condition:
+            details['seq'] = self.event_count
+            self.events.append(details)
+            self.event_count += 1
+            self._condition.notify_all()
+
+    def set_status(self, status, error=None):
+        with self._condition:
+            self.status = status
+            if status == Run.Status.Running:
+                self.started = time.time()
+            elif self.done():
+                self.finished = time.time()
+                self.error = error
+            self._condition.notify_all()
+
+    def wait_for_events(self, since, timeout=None):
+        """
+        Blocks until there are events numbered since or later, the run is done, or timeout seconds pass, and returns the events numbered since or later that are still kept.
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self.event_count > since or self.done(), timeout)
+            dropped = self.event_count - len(self.events)
+            return list(itertools.islice(self.events, max(since - dropped, 0), None))
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the run is done, or timeout seconds pass. Returns True if the run is done.
+        """
+
+        with self._condition:
+            return self._condition.wait_for(self.done, timeout)
+
+    def to_dict(self):
+        return {'run_id': self.run_id, 'name': self.name, 'status': self.status, 'submitted': self.submitted, 'started': self.started, 'finished': self.finished, 'error': self.error}
+
+
+class _RunListener(WorkflowListener):
+
+    """
+    Records the progress of a workflow as events on its Run.
+    """
+
+    def __init__(self, run):
+        self.run = run
+
+    def step_started(self, sequence, step_name, step):
+        self.run.add_event('step_started', step=step_name)
+
+    def step_finished(self, sequence, step_name, step, error=None):
+        self.run.add_event('step_finished', step=step_name, status=_STATUS_NAMES.get(step.status), error=error)
+
+
+class _Schedule(object):
+
+    def __init__(self, workflow, interval, name, variables):
+        self.workflow = workflow
+        self.interval = interval
+        self.name = name
+        self.variables = variables
+        self.next_run = time.time()
+        self.last_run = None
+
+
+class WorkflowDaemon(object):
+
+    """
+    Runs submitted and scheduled workflows in this process. To use:
+
+    daemon = WorkflowDaemon()
+    run_id = daemon.submit('mypackage.workflows:build_nightly')
+    daemon.schedule('mypackage.workflows:fetch_market_data', 3600)
+    daemon.serve()
+
+    Instance Variables
+    =====================================
+    - self.max_concurrent_runs = The number of workflows that can run at the same time. Submissions beyond that are queued.
+    - self.max_retained_runs = The number of finished runs that are kept for status queries. The oldest are forgotten first.
+    - self.run_retention_seconds = How long a finished run is kept for status queries, or 0 to keep it until max_retained_runs is reached.
+    - self.max_events_per_run = The number of events kept for each run; the oldest are dropped first.
+    - self.token = The token requests to the HTTP API must carry. If None, token in the [Daemon] section, or a random one made by serve().
+    - self.allowed_workflows = The workflow names that submit() accepts. By default, those configured in appsettings.cfg (see the module documentation); schedule() adds its workflow.
+    """
+
+    def __init__(self, max_concurrent_runs=None, max_retained_runs=None, token=None, allowed_workflows=None, run_retention_seconds=None, max_events_per_run=None):
+        self.max_concurrent_runs = max_concurrent_runs or int(get_system_config_value('Daemon', 'maxConcurrentRuns', fallback='4'))
+        self.max_retained_runs = max_retained_runs or int(get_system_config_value('Daemon', 'maxRetainedRuns', fallback='1000'))
+        self.run_retention_seconds = run_retention_seconds if run_retention_seconds is not None else float(get_system_config_value('Daemon', 'runRetentionSeconds', fallback='86400'))
+        self.max_events_per_run = max_events_per_run or int(get_system_config_value('Daemon', 'maxEventsPerRun', fallback='1000'))
+        self.token = token or get_system_config_value('Daemon', 'token', fallback='') or None
+        self.allowed_workflows = set(allowed_workflows) if allowed_workflows is not None else _get_allowed_workflows()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_runs)
+        self._runs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._schedules = []
+        self._stopping = threading.Event()
+        self._scheduler = None
+        self._server = None
+
+    def submit(self, workflow, name=None, variables=None):
+        """
+        Queues a workflow to be run and returns the id of its Run. workflow is a factory that returns the MainSequence to run, or its name as 'package.module:function', which must be one of
+        self.allowed_workflows (PermissionError is raised otherwise). variables, if given, are the initial workflow variables.
+        """
+
+        if isinstance(workflow, str) and workflow not in self.allowed_workflows:
+            raise PermissionError('Workflow {} is not allowed; add it to workflows in the [Daemon] section of appsettings.cfg'.format(workflow))
+        factory = load_workflow_factory(workflow) if isinstance(workflow, str) else workflow
+        run = Run(uuid.uuid4().hex, name or (workflow if isinstance(workflow, str) else getattr(workflow, '__name__', 'workflow')), self.max_events_per_run)
+        with self._lock:
+            self._runs[run.run_id] = run
+            self._forget_old_runs()
+        self._executor.submit(self._execute, run, factory, variables)
+        return run.run_id
+
+    def _forget_old_runs(self):
+        surplus = len(self._runs) - self.max_retained_runs
+        expired = time.time() - self.run_retention_seconds if self.run_retention_seconds else None
+        for run_id, run in list(self._runs.items()):
+            if run.done() and (surplus > 0 or expired is not None and run.finished < expired):
+                del self._runs[run_id]
+                surplus -= 1
+
+    def _execute(self, run, factory, variables):
+        run.set_status(Run.Status.Running)
+        run.add_event('run_started')
+        try:
+            workflow = factory()
+            workflow.add_listener(_RunListener(run))
+            workflow.execute(step_name=run.name, existing_variables=dict(variables) if variables else None)
+        except BaseException:
+            run.add_event('run_finished', status=Run.Status.Failed)
+            run.set_status(Run.Status.Failed, traceback.format_exc())
+            return
+        status = Run.Status.Failed if workflow.status == WorkflowTask.Status.CompletedError else Run.Status.Succeeded
+        run.add_event('run_finished', status=status)
+        run.set_status(status)
+
+    def get_run(self, run_id):
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def runs(self):
+        with self._lock:
+            self._forget_old_runs()
+            return list(self._runs.values())
+
+    def schedule(self, workflow, interval, name=None, variables=None):
+        """
+        Runs workflow every interval seconds, starting now. A scheduled run is skipped if the previous run of the same schedule hasn't finished yet.
+        """
+
+        with self._lock:
+            if isinstance(workflow, str):
+                self.allowed_workflows.add(workflow)
+            self._schedules.append(_Schedule(workflow, interval, name, variables))
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target=self._run_schedules, daemon=True)
+                self._scheduler.start()
+
+    def _run_schedules(self):
+        while not self._stopping.is_set():
+            now = time.time()
+            with self._lock:
+                schedules = list(self._schedules)
+            for schedule in schedules:
+                if schedule.next_run > now:
+                    continue
+                schedule.next_run = now + schedule.interval
+                previous = self.get_run(schedule.last_run) if schedule.last_run else None
+                if previous is not None and not previous.done():
+                    logging.getLogger(__name__).warning('Skipping scheduled run of %s; the previous run is still going.', schedule.name or schedule.workflow)
+                    continue
+                try:
+                    schedule.last_run = self.submit(schedule.workflow, schedule.name, schedule.variables)
+                except Exception:
+                    logging.getLogger(__name__).exception('Unable to submit scheduled workflow %s', schedule.workflow)
+            wait = min([schedule.next_run for schedule in schedules] or [now + 1]) - time.time()
+            self._stopping.wait(max(0.01, min(wait, 1)))
+
+    def serve(self, address=None):
+        """
+        Starts the HTTP API on a background thread and returns the address it is listening on. address is a (host, port) tuple or a Unix socket path; if not given, address in the [Daemon] section of
+        appsettings.cfg is used. If no token is set, a random one is made and written where read_token() finds it.
+        """
+
+        if address is None:
+            address = parse_address(get_system_config_value('Daemon', 'address', fallback='127.0.0.1:8765'))
+        if self.token is None:
+            self.token = secrets.token_urlsafe(32)
+            descriptor = os.open(_get_token_path(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w') as token_file:
+                token_file.write(self.token)
+        if isinstance(address, str):
+            self._server = _UnixHTTPServer(address, _RequestHandler)
+            os.chmod(address, 0o600)
+        else:
+            self._server = _TCPHTTPServer(address, _RequestHandler)
+        self._server.workflow_daemon = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address
+
+    def shutdown(self, wait=True):
+        """
+        Stops the HTTP API and the scheduler, (if wait is true) waits for the running workflows to finish, and closes the idle shell sessions (see ExecuteCommand's use_session).
+        """
+
+        self._stopping.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self._executor.shutdown(wait=wait)
+        from .tasks.system import close_shell_sessions
+        close_shell_sessions()
+
+
+class _TCPHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    """
+    Serves the daemon's HTTP API. See the module documentation for the endpoints.
+    """
+
+    def _path_parts(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def _authorized(self):
+        """
+        Returns True if the request carries the daemon's token; otherwise responds with 401 and returns False.
+        """
+
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode(), self.server.workflow_daemon.token.encode()):
+            return True
+        self._send_json(401, {'error': 'Unauthorized'})
+        return False
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        parts = self._path_parts()
+        daemon = self.server.workflow_daemon
+        if parts == ['runs']:
+            self._send_json(200, [run.to_dict() for run in daemon.runs()])
+            return
+        run = daemon.get_run(parts[1]) if len(parts) in (2, 3) and parts[0] == 'runs' else None
+        if run is None or (len(parts) == 3 and parts[2] != 'events'):
+            self._send_json(404, {'error': 'Not found'})
+        elif len(parts) == 2:
+            self._send_json(200, run.to_dict())
+        else:
+            self._stream_events(run)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self._path_parts() != ['runs']:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode() or '{}')
+            if not isinstance(body.get('workflow'), str):
+                raise ValueError('workflow must be given as package.module:function')
+            run_id = self.server.workflow_daemon.submit(body['workflow'], body.get('name'), body.get('variables'))
+        except PermissionError as e:
+            self._send_json(403, {'error': str(e)})
+            return
+        except (KeyError, ValueError, ImportError, AttributeError) as e:
+            self._send_json(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        self._send_json(202, {'run_id': run_id})
+
+    def _stream_events(self, run):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        since = 0
+        while True:
+            events = run.wait_for_events(since, timeout=30)
+            for event in events:
+                self.wfile.write(json.dumps(event).encode() + b'\n')
+            self.wfile.flush()
+            if events:
+                since = events[-1]['seq'] + 1
+            if run.done() and since >= run.event_count:
+                break
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug('%s - %s', self.address_string(), format % args)
+
+
+@entry_point
+@basic_logging_configuration_setup('WorkflowDaemon.log')
+def main():
+    daemon = WorkflowDaemon()
+    config = _get_system_config()
+    if config.has_section('DaemonSchedule'):
+        for name, value in config.items('DaemonSchedule'):
+            workflow, interval = value.split()
+            daemon.schedule(workflow, float(interval), name=name)
+    address = daemon.serve()
+    logging.info('Workflow daemon listening on %s', address)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        daemon.shutdown()
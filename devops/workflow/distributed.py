@@ -0,0 +1,223 @@
+"""
+The distributed module spreads the DevOpsTask steps of a workflow across worker processes, which can live on this machine or on others.
+
+The Coordinator listens on a TCP or Unix socket for Workers to connect. It is a step executor: set it as the step_executor of a MainSequence (or any Sequence) and every DevOpsTask step below it is pickled
+and handed to an idle worker, which runs it and sends back the task's exhaust, status, formatted traceback and output. Control flow (Sequence, IfElse, ForEach) still runs in the coordinating process, so a
+ForEach with max_workers set keeps several workers busy at once. A step whose worker goes away before it answers is handed to another worker, and a run with no workers connected fails with
+NoWorkersError rather than waiting forever.
+
+The Worker connects to a coordinator and runs the steps it is sent until the coordinator shuts down. start_local_workers() starts workers as local processes, which is handy for using every core of one
+machine and for testing. A worker on another machine can be started with:
+
+python -m devops.workflow.distributed <host>:<port>
+
+with the coordinator's authentication key in the DEVOPS_WORKFLOW_AUTHKEY environment variable. Workers must be able to import the task classes the workflow uses.
+
+Steps travel as pickles, so only ever connect workers to coordinators that you trust (and vice versa); the authentication key is what keeps anyone else out.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from .core import entry_point
+from .core import parse_address
+from .workflow import _run_isolated_task
+
+
+class WorkerLostError(Exception):
+
+    """
+    Raised by Coordinator.run() when the connection to the worker running a step is lost before the step's result comes back, and there is no other worker left to run it.
+    """
+
+    pass
+
+
+class NoWorkersError(Exception):
+
+    """
+    Raised by Coordinator.run() when no worker has been connected for worker_timeout seconds, so there is nothing to run a step on.
+    """
+
+    pass
+
+
+class Coordinator(object):
+
+    """
+    The Coordinator hands pickled steps to connected Workers. To use:
+
+    coordinator = Coordinator(('0.0.0.0', 6000), authkey=b'secret')
+    workflow = MainSequence()
+    workflow.step_executor = coordinator
+    ...
+    workflow.execute()
+    coordinator.close()
+
+    Instance Variables
+    =====================================
+    - self.address = The address workers connect to. A (host, port) tuple for TCP, or a filesystem path for a Unix socket. Port 0 picks a free port; self.address then holds the actual one.
+    - self.authkey = The key workers must present when connecting. If not given, a random key is generated, which is enough for workers started with start_local_workers().
+    - self.worker_timeout = How long (in seconds) run() waits for a worker while none is connected, before it raises NoWorkersError. None waits forever. While workers are connected but busy, run()
+    waits for one of them without a limit.
+    """
+
+    def __init__(self, address=('localhost', 0), authkey=None, worker_timeout=60):
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.worker_timeout = worker_timeout
+        self._listener = Listener(address, authkey=self.authkey)
+        self.address = self._listener.address
+        self._idle = queue.Queue()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+        self._closed = False
+        self._accept_thread = threading.Thread(target=self._accept, daemon=True)
+        self._accept_thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            with self._workers_lock:
+                self._workers.append(connection)
+            self._idle.put(connection)
+
+    def worker_count(self):
+        with self._workers_lock:
+            return len(self._workers)
+
+    def wait_for_workers(self, count, timeout=None):
+        """
+        Blocks until at least count workers are connected. Returns False if timeout seconds pass first.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.worker_count() < count:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def run(self, payload):
+        """
+        Sends a pickled task to the next idle worker and returns its result. Blocks until a worker is free. If the connection to the worker is lost, the task is sent to another worker; WorkerLostError
+        is raised once there are none left.
+        """
+
+        while True:
+            connection = self._get_idle_worker()
+            try:
+                connection.send(('run', payload))
+                result = connection.recv()
+            except (OSError, EOFError) as e:
+                self._drop(connection)
+                if not self.worker_count():
+                    raise WorkerLostError('Lost the connection to the worker running this step, and no other worker is connected: {}'.format(e))
+                continue
+            self._idle.put(connection)
+            return result
+
+    def _get_idle_worker(self):
+        deadline = None if self.worker_timeout is None else time.monotonic() + self.worker_timeout
+        while True:
+            try:
+                return self._idle.get(timeout=0.1)
+            except queue.Empty:
+                if self.worker_count():
+                    # The workers are busy, not gone; the timeout only counts while none is connected.
+                    deadline = None if self.worker_timeout is None else time.monotonic() + self.worker_timeout
+                elif deadline is not None and time.monotonic() >= deadline:
+                    raise NoWorkersError('No worker has been connected to {} for {} seconds'.format(self.address, self.worker_timeout))
+
+    def _drop(self, connection):
+        with self._workers_lock:
+            if connection in self._workers:
+                self._workers.remove(connection)
+        connection.close()
+
+    def close(self):
+        """
+        Tells the idle workers to stop and stops accepting new ones.
+        """
+
+        self._closed = True
+        self._wake_accept_thread()
+        self._accept_thread.join(5)
+        self._listener.close()
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                connection.send(('stop', None))
+            except OSError:
+                pass
+            self._drop(connection)
+
+
+    def _wake_accept_thread(self):
+        # Closing the listener doesn't interrupt a blocked accept(), and a listener opened later could get the same file descriptor, so connect once for the accept thread to see that it is closed.
+        import socket
+        try:
+            if isinstance(self.address, tuple):
+                socket.create_connection(self.address, timeout=5).close()
+            elif hasattr(socket, 'AF_UNIX'):
+                with socket.socket(socket.AF_UNIX) as connection:
+                    connection.settimeout(5)
+                    connection.connect(self.address)
+        except OSError:
+            pass
+
+
+class Worker(object):
+
+    """
+    A Worker connects to a Coordinator and runs the steps it is sent, one at a time, until the coordinator shuts down.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+
+    def serve(self):
+        connection = Client(self.address, authkey=self.authkey)
+        try:
+            while True:
+                try:
+                    command, payload = connection.recv()
+                except EOFError:
+                    break
+                if command == 'stop':
+                    break
+                connection.send(_run_isolated_task(payload))
+        finally:
+            connection.close()
+
+
+def run_worker(address, authkey):
+    Worker(address, authkey).serve()
+
+
+def start_local_workers(coordinator, count):
+    """
+    Starts count worker processes on this machine, connected to coordinator, and returns them. They exit when the coordinator is closed.
+    """
+
+    workers = []
+    for i in range(count):
+        process = multiprocessing.Process(target=run_worker, args=(coordinator.address, coordinator.authkey), daemon=True)
+        process.start()
+        workers.append(process)
+    return workers
+
+
+@entry_point
+def main():
+    run_worker(parse_address(sys.argv[1]), os.environ['DEVOPS_WORKFLOW_AUTHKEY'].encode())
@@ -0,0 +1,239 @@
+"""
+The history module keeps a database (SQLite) of workflow runs: when each run started, how long it took and how it ended, and the same for every step in it. It is used to find steps that have become
+slower than they used to be, and to estimate how long a run (or a step) will take before it starts.
+
+A RunHistory is a WorkflowListener. It records the run of the Sequence it is registered on, and writes it to the database in one transaction when the run finishes. MainSequence adds one to every run
+if database is set in the [History] section of appsettings.cfg. Runs are recorded under a workflow name: the MainSequence's step name (the daemon passes the run's name), or else the name of the script
+that was started.
+
+A step is identified by its path: the names of the steps it is nested in and its own, separated by /, e.g. 'Build/Run tests'. To use the history:
+
+history = RunHistory('runs.sqlite')
+for regression in history.regressions('nightly_build'):
+    print('{} took {:.1f}s; it usually takes {:.1f}s'.format(regression.path, regression.seconds, regression.baseline))
+print(history.estimate_duration('nightly_build'))
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import uuid
+from .workflow import DevOpsTask
+from .workflow import WorkflowListener
+from .workflow import WorkflowTask
+from .core import get_system_config_value
+
+
+Regression = collections.namedtuple('Regression', ('path', 'run_id', 'seconds', 'baseline', 'ratio', 'baseline_runs'))
+Regression.__doc__ = 'A step of a run that took ratio times its baseline: the median duration of the same step in the baseline_runs successful runs before it.'
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, workflow TEXT NOT NULL, started REAL NOT NULL, seconds REAL NOT NULL, status TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS runs_by_workflow ON runs (workflow, started);
+CREATE TABLE IF NOT EXISTS steps (run_id TEXT NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE, path TEXT NOT NULL, parent TEXT, task TEXT NOT NULL, started REAL NOT NULL,
+                                  seconds REAL NOT NULL, status TEXT NOT NULL, bytes INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS steps_by_run ON steps (run_id);
+CREATE INDEX IF NOT EXISTS steps_by_path ON steps (path, run_id);
+'''
+
+
+def _default_workflow_name():
+    return os.path.splitext(os.path.basename(sys.argv[0] or ''))[0] or 'workflow'
+
+
+def _status_name(task):
+    return 'error' if task.status == WorkflowTask.Status.CompletedError else 'ok'
+
+
+class RunHistory(WorkflowListener):
+
+    """
+    Records workflow runs in, and answers questions from, a SQLite database.
+
+    Instance Variables
+    =====================================
+    - self.database = The path of the SQLite database. It is created if it doesn't exist.
+    - self.workflow = The name runs are recorded under. If None, see the module documentation.
+    """
+
+    def __init__(self, database=None, workflow=None):
+        self.database = database or get_system_config_value('History', 'database')
+        self.workflow = workflow
+        self._lock = threading.Lock()
+        self._root = None
+        self._paths = {}
+        self._started = {}
+        self._steps = []
+        self._run_started = None
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """
+        Opens the database (creating its tables if needed) for one transaction, which is committed if no exception is raised, and closes it afterwards.
+        """
+
+        connection = sqlite3.connect(self.database, timeout=30)
+        try:
+            connection.execute('PRAGMA foreign_keys = ON')
+            connection.executescript(_SCHEMA)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def sequence_started(self, sequence):
+        with self._lock:
+            if self._root is None and self._find_path(sequence) is None:
+                self._root = sequence
+                self._paths[id(sequence)] = ''
+                self._steps = []
+                self._run_started = time.time()
+
+    def step_started(self, sequence, step_name, step):
+        with self._lock:
+            parent = self._find_path(sequence)
+            if parent is not None:
+                self._paths[id(step)] = parent + '/' + step_name if parent else step_name
+                self._started[id(step)] = time.time()
+
+    def step_finished(self, sequence, step_name, step, error=None):
+        from .tracing import get_byte_counts
+        with self._lock:
+            path = self._paths.pop(id(step), None)
+            if path is None:
+                return
+            started = self._started.pop(id(step))
+            counts = get_byte_counts(step._exhaust) if isinstance(step, DevOpsTask) else {}
+            self._steps.append((path, path.rpartition('/')[0] or None, type(step).__name__, started, time.time() - started, _status_name(step), sum(counts.values())))
+
+    def sequence_finished(self, sequence):
+        with self._lock:
+            if sequence is not self._root:
+                return
+            steps, started = self._steps, self._run_started
+            self._root, self._paths, self._started, self._steps = None, {}, {}, []
+        try:
+            self.record(self.get_workflow_name(sequence), started, time.time() - started, _status_name(sequence), steps)
+        except sqlite3.Error as e:
+            logging.warning('Unable to record the run in the run history: %s', e)
+
+    def get_workflow_name(self, sequence):
+        """
+        Returns the name the runs of sequence are recorded under.
+        """
+
+        return self.workflow or sequence.step_name or _default_workflow_name()
+
+    def _find_path(self, task):
+        # Sequences that aren't steps themselves (IfElse branches, ForEach bodies) share the path of the step they run in.
+        while task is not None:
+            path = self._paths.get(id(task))
+            if path is not None:
+                return path
+            task = task.parent
+        return None
+
+    def record(self, workflow, started, seconds, status, steps):
+        """
+        Records a run and its steps, each a tuple of (path, parent path or None, task class name, started, seconds, status, bytes), and returns the run id.
+        """
+
+        run_id = uuid.uuid4().hex
+        with self._connection() as connection:
+            connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?)', (run_id, workflow, started, seconds, status))
+            connection.executemany('INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(run_id,) + tuple(step) for step in steps])
+        return run_id
+
+    def runs(self, workflow, limit=20):
+        """
+        Returns the latest runs of workflow, newest first, as dictionaries of run_id, workflow, started, seconds and status.
+        """
+
+        with self._connection() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute('SELECT * FROM runs WHERE workflow = ? ORDER BY started DESC LIMIT ?', (workflow, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def steps(self, run_id):
+        """
+        Returns the steps of a run, in the order they finished, as dictionaries of path, parent, task, started, seconds, status and bytes.
+        """
+
+        with self._connection() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute('SELECT path, parent, task, started, seconds, status, bytes FROM steps WHERE run_id = ? ORDER BY rowid', (run_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def step_durations(self, workflow, window=20):
+        """
+        Returns the median duration of every step (by path) in the latest window successful runs of workflow, e.g. to estimate how long each step of the next run will take.
+        """
+
+        durations = collections.defaultdict(list)
+        with self._connection() as connection:
+            rows = connection.execute('SELECT steps.path, steps.seconds FROM steps JOIN (SELECT run_id FROM runs WHERE workflow = ? AND status = ? ORDER BY started DESC LIMIT ?) AS latest '
+                                      'USING (run_id) WHERE steps.status = ?', (workflow, 'ok', window, 'ok')).fetchall()
+        for path, seconds in rows:
+            durations[path].append(seconds)
+        return {path: statistics.median(seconds) for path, seconds in durations.items()}
+
+    def estimate_duration(self, workflow, window=20):
+        """
+        Returns the expected duration (in seconds) of the next run of workflow: the median duration of its latest window successful runs. Returns None if it has never run successfully.
+        """
+
+        with self._connection() as connection:
+            rows = connection.execute('SELECT seconds FROM runs WHERE workflow = ? AND status = ? ORDER BY started DESC LIMIT ?', (workflow, 'ok', window)).fetchall()
+        return statistics.median(seconds for seconds, in rows) if rows else None
+
+    def regressions(self, workflow, run_id=None, window=20, threshold=1.5, min_seconds=1.0, min_runs=3):
+        """
+        Returns the steps of a run of workflow (by default, its latest) that regressed: took more than threshold times, and min_seconds more than, their baseline. A step's baseline is its median
+        duration in the window successful runs before this one in which it succeeded; steps with fewer than min_runs such runs aren't judged. The slowest regressions (by ratio) come first.
+        """
+
+        with self._connection() as connection:
+            if run_id is None:
+                row = connection.execute('SELECT run_id FROM runs WHERE workflow = ? ORDER BY started DESC LIMIT 1', (workflow,)).fetchone()
+                if row is None:
+                    return []
+                run_id = row[0]
+            started, = connection.execute('SELECT started FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+            current = connection.execute('SELECT path, seconds FROM steps WHERE run_id = ?', (run_id,)).fetchall()
+            baseline_rows = connection.execute('SELECT steps.path, steps.seconds FROM steps JOIN (SELECT run_id FROM runs WHERE workflow = ? AND status = ? AND started < ? '
+                                               'ORDER BY started DESC LIMIT ?) AS previous USING (run_id) WHERE steps.status = ?', (workflow, 'ok', started, window, 'ok')).fetchall()
+        history = collections.defaultdict(list)
+        for path, seconds in baseline_rows:
+            history[path].append(seconds)
+        regressions = []
+        for path, seconds in current:
+            previous = history.get(path, ())
+            if len(previous) < min_runs:
+                continue
+            baseline = statistics.median(previous)
+            if seconds > baseline * threshold and seconds - baseline > min_seconds:
+                regressions.append(Regression(path, run_id, seconds, baseline, seconds / baseline if baseline else float('inf'), len(previous)))
+        return sorted(regressions, key=lambda regression: regression.ratio, reverse=True)
+
+    def report(self, workflow, **kwargs):
+        """
+        Returns lines of text describing the latest run of workflow, its expected duration and its regressions (see regressions() for the keyword arguments).
+        """
+
+        runs = self.runs(workflow, limit=1)
+        if not runs:
+            return ['{} has no recorded runs'.format(workflow)]
+        run = runs[0]
+        estimate = self.estimate_duration(workflow)
+        lines = ['{} run {} took {:.3f}s ({}); runs usually take {}'.format(workflow, run['run_id'], run['seconds'], run['status'], '{:.3f}s'.format(estimate) if estimate is not None else 'unknown')]
+        for regression in self.regressions(workflow, run_id=run['run_id'], **kwargs):
+            lines.append('Regression: {} took {:.3f}s, {:.1f}x its baseline of {:.3f}s over {} run(s)'.format(regression.path, regression.seconds, regression.ratio, regression.baseline,
+                                                                                                        regression.baseline_runs))
+        return lines
@@ -0,0 +1,112 @@
+"""
+The logrotation module rotates, compresses and prunes the log files written by the basic_logging_configuration_setup decorator in core. It is imported the first time logging is set up, rather than with
+core, so that scripts that don't log don't pay for importing logging.handlers.
+
+The RotatingLogFileHandler rotates the log by size and age, and hands finished log files off to a background thread for compression.
+maintain_log_directory() applies the retention policy to a log directory and compresses the logs left behind by previous runs.
+"""
+
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import compression
+
+
+_log_maintenance_executor = None
+_log_maintenance_lock = threading.Lock()
+
+
+def _submit_log_maintenance(func, *args):
+    """
+    Runs func on the single background log maintenance thread. The thread is joined at interpreter exit, so pending compression work is finished rather than left half-written.
+    """
+
+    global _log_maintenance_executor
+    with _log_maintenance_lock:
+        if _log_maintenance_executor is None:
+            _log_maintenance_executor = ThreadPoolExecutor(max_workers=1)
+        return _log_maintenance_executor.submit(func, *args)
+
+
+def _compress_log(path, method):
+    try:
+        compression.compress_file(path, method)
+    except OSError:
+        logging.getLogger(__name__).exception('Unable to compress log file %s', path)
+
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+
+    """
+    A log file handler that rolls the log over once it grows past max_bytes, or once rotate_interval seconds have passed since it was opened (whichever comes first). Rolled over segments are renamed to
+    <log name>.1, <log name>.2, etc. and compressed on a background thread.
+    """
+
+    def __init__(self, filename, max_bytes=0, rotate_interval=0, compression_method=None):
+
+        """
+        self.rotate_interval => The number of seconds a log segment is written to before it is rolled over. 0 disables time based rotation.
+        self.compression_method => 'gzip', 'zstd' or None. Rolled over segments are compressed with this method.
+        """
+
+        super().__init__(filename, mode='a', maxBytes=max_bytes, delay=True)
+        self.rotate_interval = rotate_interval
+        self.compression_method = compression_method
+        self._segment = 0
+        self._rollover_at = time.time() + rotate_interval if rotate_interval else None
+
+    def shouldRollover(self, record):
+        if self._rollover_at is not None and time.time() >= self._rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            self._segment += 1
+            rotated = '{}.{}'.format(self.baseFilename, self._segment)
+            os.replace(self.baseFilename, rotated)
+            if self.compression_method:
+                _submit_log_maintenance(_compress_log, rotated, self.compression_method)
+        if self.rotate_interval:
+            self._rollover_at = time.time() + self.rotate_interval
+        self.stream = self._open()
+
+
+def maintain_log_directory(logdir, prefix, current_log, compression_method=None, compress_idle_seconds=300, retention_days=0, retention_max_files=0):
+    """
+    Applies the log retention policy to the files in logdir that start with prefix, and compresses the ones that are finished. A log file is considered finished once it hasn't been written to for
+    compress_idle_seconds; this keeps logs belonging to concurrently running workflows from being compressed out from under them. current_log is never touched.
+
+    Files older than retention_days are removed, and after that only the newest retention_max_files are kept. A value of 0 disables that part of the policy.
+    """
+
+    now = time.time()
+    entries = []
+    with os.scandir(logdir) as scan:
+        for entry in scan:
+            if entry.name.startswith(prefix) and entry.path != current_log and entry.is_file() and not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort(reverse=True)
+
+    kept = []
+    for index, (mtime, path) in enumerate(entries):
+        expired = retention_days and now - mtime > retention_days * 86400
+        surplus = retention_max_files and index >= retention_max_files
+        if expired or surplus:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        else:
+            kept.append((mtime, path))
+
+    if compression_method:
+        for mtime, path in kept:
+            if not compression.is_compressed(path) and now - mtime > compress_idle_seconds:
+                _compress_log(path, compression_method)
@@ -0,0 +1,428 @@
+"""
+The plan module builds workflows from declarative workflow files instead of Python scripts. A workflow file is JSON, TOML or YAML (YAML requires the PyYAML module, https://pypi.python.org/pypi/PyYAML)
+and describes the steps of a MainSequence, e.g. in JSON:
+
+{
+    "variables": {"distribution_directory": "dist"},
+    "steps": [
+        {"name": "Clean Distribution Directory", "if": {"exists": "dist"},
+         "then": [{"name": "Delete", "task": "system:Delete", "args": ["dist"], "kwargs": {"fail_on_error": true}}]},
+        {"name": "Make Distribution Directory", "task": "system:MakeDirectory", "args": ["dist"], "depends_on": ["Clean Distribution Directory"]},
+        {"name": "Get Source Code From Git", "task": "git:Clone", "args": ["https://example.com/devops.git", "source"]}
+    ]
+}
+
+Each step has a unique name and is either a task step or a conditional step:
+
+- A task step names its task class in "task" as 'package.module:Class'; a module without a package (e.g. 'system:Copy') is looked up in devops.workflow.tasks. "args" and "kwargs" are passed to the task's
+  constructor, and "continue_on_error" is set on the task. "resources" declares what the task needs to run, e.g. {"cpu": 4, "memory": 2147483648, "disk_io": true, "host": "example.com"} (see the
+  resources module).
+- A conditional step has an "if" condition and "then" and/or "else" lists of steps, and becomes an IfElse. A condition is true or false, {"exists": path}, {"env": name} (the environment variable is set and
+  not empty), {"variable": name} (the workflow variable is set and not empty), {"not": condition}, {"all": [conditions]} or {"any": [conditions]}. Conditions are evaluated when the step is reached, so they
+  see what earlier steps have done, and only the branch that is taken is built.
+
+Steps run in the order they are listed, except that a step always runs after the steps named in its "depends_on" (which must be in the same list of steps). "variables" are the initial workflow variables.
+
+If "max_workers" is above 1, up to that many steps run at the same time: a step starts as soon as the steps in its "depends_on" have completed (a step without "depends_on" can start straight away).
+Ready steps on the longest remaining path start first; a step's "cost" (its expected duration in seconds) sets its length, as do the step durations of earlier runs if a run history is configured (see
+Sequence.addstep() and the history module).
+
+A workflow file is validated and compiled into an ExecutionPlan once; the plan is cached on disk, as JSON, keyed by the SHA-256 of the file, so later runs of an unchanged file skip parsing, validation
+and ordering. The cache is in a directory only the current user can access: cacheDirectory in the [WorkflowPlan] section of appsettings.cfg, or a per-user directory (see core.get_private_directory()),
+since whoever can write a cached plan decides what the workflow runs. The tasks of a plan are built as StepRecords, which keeps even very large workflows cheap to build. To run a workflow file:
+
+python -m devops.workflow.plan path/to/workflow.json
+"""
+
+import functools
+import hashlib
+import heapq
+import importlib
+import json
+import logging
+import os
+import sys
+from .core import basic_logging_configuration_setup
+from .core import entry_point
+from .core import ensure_private_directory
+from .core import get_private_directory
+from .core import get_system_config_value
+from .resources import Resources
+from .workflow import IfElse
+from .workflow import MainSequence
+from .workflow import Sequence
+from .workflow import StepRecord
+from .workflow import WorkflowTask
+
+
+# Bumped whenever the compiled form changes, so that plans cached by an older version are not used.
+PLAN_FORMAT_VERSION = 4
+
+_TASK_KEYS = frozenset(['name', 'task', 'args', 'kwargs', 'continue_on_error', 'depends_on', 'cost', 'resources'])
+_CONDITIONAL_KEYS = frozenset(['name', 'if', 'then', 'else', 'continue_on_error', 'depends_on', 'cost'])
+
+
+class PlanError(ValueError):
+
+    """
+    Raised when a workflow file can't be parsed or is not a valid workflow. The message says which step is at fault.
+    """
+
+    pass
+
+
+class _TaskStep(object):
+
+    __slots__ = ('name', 'task_class', 'args', 'kwargs', 'continue_on_error', 'depends_on', 'cost', 'resources')
+
+    def __init__(self, name, task_class, args, kwargs, continue_on_error, depends_on=(), cost=None, resources=None):
+        self.name = name
+        self.task_class = task_class
+        self.args = args
+        self.kwargs = kwargs
+        self.continue_on_error = continue_on_error
+        self.depends_on = depends_on
+        self.cost = cost
+        self.resources = resources
+
+    def build(self, max_workers=1):
+        record = StepRecord(self.task_class, *self.args, **self.kwargs)
+        record.continue_on_error = self.continue_on_error
+        record.resources = self.resources
+        return record
+
+
+class _ConditionalStep(object):
+
+    __slots__ = ('name', 'condition', 'then_steps', 'else_steps', 'continue_on_error', 'depends_on', 'cost')
+
+    def __init__(self, name, condition, then_steps, else_steps, continue_on_error, depends_on=(), cost=None):
+        self.name = name
+        self.condition = condition
+        self.then_steps = then_steps
+        self.else_steps = else_steps
+        self.continue_on_error = continue_on_error
+        self.depends_on = depends_on
+        self.cost = cost
+
+    def build(self, max_workers=1):
+        conditional = IfElse(functools.partial(_evaluate_condition, self.condition), iffactory=functools.partial(_build_steps, self.then_steps, max_workers),
+                             elsefactory=functools.partial(_build_steps, self.else_steps, max_workers))
+        conditional.continue_on_error = self.continue_on_error
+        return conditional
+
+
+def _build_steps(steps, max_workers, variables):
+    """
+    The branch factory of a conditional step, so that only the branch that is taken gets built.
+    """
+
+    return _add_steps(Sequence(max_workers=max_workers), steps)
+
+
+def _add_steps(sequence, steps):
+    for step in steps:
+        sequence.addstep(step.name, step.build(sequence.max_workers), depends_on=step.depends_on, cost=step.cost)
+    return sequence
+
+
+class ExecutionPlan(object):
+
+    """
+    The compiled form of a workflow file: its steps, validated, with their task classes resolved and in execution order. Use load_plan() to get one.
+
+    Instance Variables
+    =====================================
+    - self.steps = The compiled steps, in execution order.
+    - self.variables = The initial workflow variables.
+    - self.digest = The SHA-256 of the workflow file the plan was compiled from.
+    - self.max_workers = The number of steps that may run at the same time.
+    """
+
+    __slots__ = ('steps', 'variables', 'digest', 'max_workers')
+
+    def __init__(self, steps, variables, digest, max_workers=1):
+        self.steps = steps
+        self.variables = variables
+        self.digest = digest
+        self.max_workers = max_workers
+
+    def build(self):
+        """
+        Builds a new MainSequence from the plan.
+        """
+
+        return _add_steps(MainSequence(max_workers=self.max_workers), self.steps)
+
+    def execute(self):
+        """
+        Builds a new MainSequence from the plan and executes it with the plan's variables. Returns the MainSequence.
+        """
+
+        workflow = self.build()
+        workflow.execute(existing_variables=dict(self.variables))
+        return workflow
+
+
+def _evaluate_condition(condition, variables):
+    if isinstance(condition, bool):
+        return condition
+    (operator, operand), = condition.items()
+    if operator == 'exists':
+        return os.path.exists(operand)
+    if operator == 'env':
+        return bool(os.environ.get(operand))
+    if operator == 'variable':
+        return bool(variables.get(operand))
+    if operator == 'not':
+        return not _evaluate_condition(operand, variables)
+    if operator == 'all':
+        return all(_evaluate_condition(c, variables) for c in operand)
+    return any(_evaluate_condition(c, variables) for c in operand)
+
+
+def _validate_condition(condition, where):
+    if isinstance(condition, bool):
+        return
+    if not isinstance(condition, dict) or len(condition) != 1:
+        raise PlanError('{}: a condition must be true, false or an object with exactly one operator'.format(where))
+    (operator, operand), = condition.items()
+    if operator in ('exists', 'env', 'variable'):
+        if not isinstance(operand, str):
+            raise PlanError('{}: "{}" takes a string'.format(where, operator))
+    elif operator == 'not':
+        _validate_condition(operand, where)
+    elif operator in ('all', 'any'):
+        if not isinstance(operand, list):
+            raise PlanError('{}: "{}" takes a list of conditions'.format(where, operator))
+        for c in operand:
+            _validate_condition(c, where)
+    else:
+        raise PlanError('{}: unknown condition "{}"'.format(where, operator))
+
+
+def _resolve_task_class(name, where):
+    module_name, _, class_name = name.partition(':')
+    if not module_name or not class_name:
+        raise PlanError('{}: a task must be given as package.module:Class, not {}'.format(where, name))
+    if '.' not in module_name:
+        module_name = '{}.tasks.{}'.format(__package__, module_name)
+    try:
+        task_class = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError) as e:
+        raise PlanError('{}: unable to load task {}: {}'.format(where, name, e))
+    if not (isinstance(task_class, type) and issubclass(task_class, WorkflowTask)):
+        raise PlanError('{}: {} is not a WorkflowTask'.format(where, name))
+    return task_class
+
+
+def _compile_resources(resources, where):
+    if resources is None:
+        return None
+    if not isinstance(resources, dict):
+        raise PlanError('{}: resources must be an object'.format(where))
+    unknown = set(resources).difference(Resources._fields)
+    if unknown:
+        raise PlanError('{}: unknown resource(s) {}'.format(where, ', '.join(sorted(unknown))))
+    for key in ('cpu', 'memory'):
+        value = resources.get(key, 0)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise PlanError('{}: resource {} must be a non-negative integer'.format(where, key))
+    if not isinstance(resources.get('disk_io', False), bool):
+        raise PlanError('{}: resource disk_io must be true or false'.format(where))
+    if not isinstance(resources.get('host', ''), str):
+        raise PlanError('{}: resource host must be a string'.format(where))
+    return Resources(**resources)
+
+
+def _order_steps(steps, where):
+    """
+    Orders steps so that every step comes after the steps in its depends_on, otherwise keeping the order they were listed in.
+    """
+
+    index = {step['name']: i for i, step in enumerate(steps)}
+    waiting_on = [0] * len(steps)
+    dependents = [[] for step in steps]
+    for i, step in enumerate(steps):
+        depends_on = set(step.get('depends_on', ()))
+        unknown = depends_on.difference(index)
+        if unknown:
+            raise PlanError('{}/{}: depends on unknown step(s) {}'.format(where, step['name'], ', '.join(sorted(unknown))))
+        waiting_on[i] = len(depends_on)
+        for name in depends_on:
+            dependents[index[name]].append(i)
+    ready = [i for i, count in enumerate(waiting_on) if count == 0]
+    ordered = []
+    while ready:
+        i = heapq.heappop(ready)
+        ordered.append(steps[i])
+        for dependent in dependents[i]:
+            waiting_on[dependent] -= 1
+            if waiting_on[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    if len(ordered) < len(steps):
+        cycle = sorted(step['name'] for i, step in enumerate(steps) if waiting_on[i])
+        raise PlanError('{}: the dependencies of steps {} form a cycle'.format(where, ', '.join(cycle)))
+    return ordered
+
+
+def _compile_steps(steps, where):
+    if not isinstance(steps, list):
+        raise PlanError('{}: steps must be a list'.format(where))
+    seen = set()
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or not isinstance(step.get('name'), str):
+            raise PlanError('{}[{}]: a step must be an object with a "name"'.format(where, index))
+        if step['name'] in seen:
+            raise PlanError('{}/{}: duplicate step name'.format(where, step['name']))
+        seen.add(step['name'])
+        depends_on = step.get('depends_on', [])
+        if not isinstance(depends_on, list) or not all(isinstance(name, str) for name in depends_on):
+            raise PlanError('{}/{}: depends_on must be a list of step names'.format(where, step['name']))
+        cost = step.get('cost')
+        if cost is not None and (isinstance(cost, bool) or not isinstance(cost, (int, float)) or cost < 0):
+            raise PlanError('{}/{}: cost must be a number of seconds'.format(where, step['name']))
+
+    compiled = []
+    for step in _order_steps(steps, where):
+        step_where = '{}/{}'.format(where, step['name'])
+        continue_on_error = step.get('continue_on_error', False)
+        if not isinstance(continue_on_error, bool):
+            raise PlanError('{}: continue_on_error must be true or false'.format(step_where))
+        dependencies = (tuple(step.get('depends_on', ())), step.get('cost'))
+        if 'if' in step:
+            unknown = set(step).difference(_CONDITIONAL_KEYS)
+            if unknown:
+                raise PlanError('{}: unknown key(s) {}'.format(step_where, ', '.join(sorted(unknown))))
+            _validate_condition(step['if'], step_where)
+            compiled.append(_ConditionalStep(step['name'], step['if'], _compile_steps(step.get('then', []), step_where + '/then'),
+                                             _compile_steps(step.get('else', []), step_where + '/else'), continue_on_error, *dependencies))
+        elif 'task' in step:
+            unknown = set(step).difference(_TASK_KEYS)
+            if unknown:
+                raise PlanError('{}: unknown key(s) {}'.format(step_where, ', '.join(sorted(unknown))))
+            args = step.get('args', [])
+            kwargs = step.get('kwargs', {})
+            if not isinstance(args, list) or not isinstance(kwargs, dict):
+                raise PlanError('{}: args must be a list and kwargs an object'.format(step_where))
+            compiled.append(_TaskStep(step['name'], _resolve_task_class(step['task'], step_where), tuple(args), kwargs, continue_on_error, *dependencies,
+                                      resources=_compile_resources(step.get('resources'), step_where)))
+        else:
+            raise PlanError('{}: a step needs either a "task" or an "if"'.format(step_where))
+    return compiled
+
+
+def _parse(path, data):
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == '.json':
+            return json.loads(data.decode('utf-8'))
+        if extension == '.toml':
+            import tomllib
+            return tomllib.loads(data.decode('utf-8'))
+        if extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise PlanError('{}: reading YAML workflow files requires the PyYAML module'.format(path))
+            return yaml.safe_load(data)
+    except PlanError:
+        raise
+    except Exception as e:
+        raise PlanError('{}: unable to parse: {}'.format(path, e))
+    raise PlanError('{}: unsupported workflow file type {}; use .json, .toml, .yaml or .yml'.format(path, extension))
+
+
+def compile_plan(path, data):
+    """
+    Parses, validates and compiles the contents of a workflow file (data, as bytes) into an ExecutionPlan. Raises PlanError if it is not a valid workflow.
+    """
+
+    document = _parse(path, data)
+    if not isinstance(document, dict):
+        raise PlanError('{}: a workflow file must contain an object with "steps"'.format(path))
+    unknown = set(document).difference(['steps', 'variables', 'max_workers'])
+    if unknown:
+        raise PlanError('{}: unknown key(s) {}'.format(path, ', '.join(sorted(unknown))))
+    variables = document.get('variables', {})
+    if not isinstance(variables, dict):
+        raise PlanError('{}: variables must be an object'.format(path))
+    max_workers = document.get('max_workers', 1)
+    if isinstance(max_workers, bool) or not isinstance(max_workers, int) or max_workers < 1:
+        raise PlanError('{}: max_workers must be a positive integer'.format(path))
+    return ExecutionPlan(_compile_steps(document.get('steps', []), path), variables, hashlib.sha256(data).hexdigest(), max_workers)
+
+
+def _get_cache_directory():
+    directory = get_system_config_value('WorkflowPlan', 'cacheDirectory', fallback='')
+    return ensure_private_directory(directory) if directory else get_private_directory('plans')
+
+
+def _step_to_json(step):
+    common = {'name': step.name, 'continue_on_error': step.continue_on_error, 'depends_on': list(step.depends_on), 'cost': step.cost}
+    if isinstance(step, _ConditionalStep):
+        return dict(common, condition=step.condition, then=[_step_to_json(s) for s in step.then_steps], otherwise=[_step_to_json(s) for s in step.else_steps])
+    return dict(common, task='{}:{}'.format(step.task_class.__module__, step.task_class.__name__), args=list(step.args), kwargs=step.kwargs,
+                resources=list(step.resources) if step.resources is not None else None)
+
+
+def _step_from_json(step):
+    dependencies = (tuple(step['depends_on']), step['cost'])
+    if 'condition' in step:
+        return _ConditionalStep(step['name'], step['condition'], [_step_from_json(s) for s in step['then']], [_step_from_json(s) for s in step['otherwise']], step['continue_on_error'],
+                                *dependencies)
+    return _TaskStep(step['name'], _resolve_task_class(step['task'], 'cached plan'), tuple(step['args']), step['kwargs'], step['continue_on_error'], *dependencies,
+                     resources=Resources(*step['resources']) if step['resources'] is not None else None)
+
+
+def _read_cached_plan(cache_path):
+    try:
+        with open(cache_path, 'rb') as cached:
+            document = json.loads(cached.read().decode('utf-8'))
+        return ExecutionPlan([_step_from_json(step) for step in document['steps']], document['variables'], document['digest'], document['max_workers'])
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # A cache entry that can't be loaded (e.g. a task class has since moved) is simply compiled again.
+        logging.debug('Ignoring unreadable cached plan %s', cache_path, exc_info=True)
+        return None
+
+
+def _write_cached_plan(cache_path, plan):
+    try:
+        # Plans with values JSON can't hold (e.g. TOML dates) are not cached.
+        data = json.dumps({'steps': [_step_to_json(step) for step in plan.steps], 'variables': plan.variables, 'digest': plan.digest, 'max_workers': plan.max_workers}).encode('utf-8')
+        temporary = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(temporary, 'wb') as cached:
+            cached.write(data)
+        os.replace(temporary, cache_path)
+    except (OSError, TypeError, ValueError):
+        logging.debug('Unable to cache plan %s', cache_path, exc_info=True)
+
+
+def load_plan(path, use_cache=True):
+    """
+    Returns the ExecutionPlan for the workflow file at path, from the plan cache if the file hasn't changed since it was last compiled.
+    """
+
+    with open(path, 'rb') as workflow_file:
+        data = workflow_file.read()
+    if not use_cache:
+        return compile_plan(path, data)
+    key = hashlib.sha256(data + '\0{}\0{}'.format(PLAN_FORMAT_VERSION, sys.version_info[:2]).encode()).hexdigest()
+    try:
+        cache_path = os.path.join(_get_cache_directory(), key + '.json')
+    except OSError as e:
+        logging.warning('Not using the plan cache: %s', e)
+        return compile_plan(path, data)
+    plan = _read_cached_plan(cache_path)
+    if plan is None:
+        plan = compile_plan(path, data)
+        _write_cached_plan(cache_path, plan)
+    return plan
+
+
+@entry_point
+@basic_logging_configuration_setup('WorkflowPlan.log')
+def main():
+    load_plan(sys.argv[1]).execute()
@@ -0,0 +1,192 @@
+"""
+The resources module decides when a step may start, so that steps running at the same time (see Sequence.addstep() and ForEach) don't oversubscribe the host: too many CPU-bound steps, more memory than
+there is, disks thrashed by parallel copies or a remote host hit by too many connections.
+
+A DevOpsTask declares what it needs in its resources instance variable, e.g.:
+
+task = ExecuteCommand('make -j4', 'src')
+task.resources = Resources(cpu=4, memory=2 * 1024 ** 3)
+
+cpu is a number of CPU slots, memory the estimated peak memory in bytes, disk_io marks a step that is heavy on the disk and host names the remote host it works against. A step is only started once the
+tokens it needs are free, within the limits set in the [Resources] section of appsettings.cfg: cpuSlots (0 means one per CPU), memoryBytes (0 means no limit), diskIoSlots and hostSlots (the slots of
+each remote host). A step that needs more than a limit allows runs when nothing else is running. Steps that don't declare resources take no tokens.
+
+New steps are also held back while the host is short of memory: while less than minAvailableMemoryBytes is available (MemAvailable in /proc/meminfo), or while the workflow's own process has a resident
+set larger than maxRssBytes (0 means no limit). Where those can't be measured, only the tokens apply. Steps are admitted in the order they ask, so a step that needs a lot is not starved by smaller ones.
+"""
+
+import collections
+import contextlib
+import os
+import threading
+from functools import lru_cache
+from .core import get_system_config_value
+
+
+Resources = collections.namedtuple('Resources', ('cpu', 'memory', 'disk_io', 'host'), defaults=(1, 0, False, None))
+Resources.__doc__ = 'What a step needs to run: cpu slots, an estimate of its peak memory in bytes, whether it is heavy on the disk and the remote host it works against.'
+
+
+def available_memory():
+    """
+    Returns the memory available for new processes (MemAvailable in /proc/meminfo) in bytes, or None if it isn't known.
+    """
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def process_rss():
+    """
+    Returns the resident set size of this process in bytes, or None if it isn't known.
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _get_int_setting(key, fallback):
+    return int(get_system_config_value('Resources', key, fallback='') or fallback)
+
+
+class ResourceGovernor(object):
+
+    """
+    Admits steps within the configured limits. Limits that aren't given are read from the [Resources] section of appsettings.cfg. To use:
+
+    with governor.admit(task.resources):
+        task.execute()
+
+    Instance Variables
+    =====================================
+    - self.cpu_slots = The CPU slots that steps can hold at the same time.
+    - self.memory_bytes = The total memory that the steps running at the same time may declare, or 0 for no limit.
+    - self.disk_io_slots = The number of disk heavy steps that may run at the same time.
+    - self.host_slots = The number of steps that may work against the same remote host at the same time.
+    - self.min_available_memory_bytes = New steps are held back while less memory than this is available, or 0 to not watch the available memory.
+    - self.max_rss_bytes = New steps are held back while the resident set of this process is larger than this, or 0 for no limit.
+    - self.poll_interval = How often (in seconds) a held back step checks the memory again.
+    """
+
+    def __init__(self, cpu_slots=None, memory_bytes=None, disk_io_slots=None, host_slots=None, min_available_memory_bytes=None, max_rss_bytes=None, poll_interval=0.5):
+        self.cpu_slots = cpu_slots if cpu_slots is not None else _get_int_setting('cpuSlots', 0) or os.cpu_count() or 1
+        self.memory_bytes = memory_bytes if memory_bytes is not None else _get_int_setting('memoryBytes', 0)
+        self.disk_io_slots = disk_io_slots if disk_io_slots is not None else _get_int_setting('diskIoSlots', 2)
+        self.host_slots = host_slots if host_slots is not None else _get_int_setting('hostSlots', 4)
+        self.min_available_memory_bytes = min_available_memory_bytes if min_available_memory_bytes is not None else _get_int_setting('minAvailableMemoryBytes', 0)
+        self.max_rss_bytes = max_rss_bytes if max_rss_bytes is not None else _get_int_setting('maxRssBytes', 0)
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._waiting = collections.deque()
+        self._running = 0
+        self._cpu = 0
+        self._memory = 0
+        self._disk_io = 0
+        self._hosts = collections.Counter()
+
+    @property
+    def running(self):
+        """
+        The number of steps that have been admitted and not yet released.
+        """
+
+        return self._running
+
+    def under_memory_pressure(self):
+        """
+        Returns True if the host has less memory available than min_available_memory_bytes, or this process has a larger resident set than max_rss_bytes.
+        """
+
+        if self.min_available_memory_bytes:
+            available = available_memory()
+            if available is not None and available < self.min_available_memory_bytes:
+                return True
+        if self.max_rss_bytes:
+            rss = process_rss()
+            if rss is not None and rss > self.max_rss_bytes:
+                return True
+        return False
+
+    def _fits(self, resources):
+        if not self._running:
+            # Whatever a step needs, it runs on its own rather than never.
+            return True
+        if resources is not None:
+            if resources.cpu and self._cpu + resources.cpu > self.cpu_slots:
+                return False
+            if resources.memory and self.memory_bytes and self._memory + resources.memory > self.memory_bytes:
+                return False
+            if resources.disk_io and self._disk_io >= self.disk_io_slots:
+                return False
+            if resources.host is not None and self._hosts[resources.host] >= self.host_slots:
+                return False
+        return not self.under_memory_pressure()
+
+    def acquire(self, resources):
+        """
+        Waits until a step that needs resources (a Resources, or None for a step that declares nothing) can start, and takes its tokens. Every acquire() must be followed by a release().
+        """
+
+        with self._condition:
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                while self._waiting[0] is not ticket or not self._fits(resources):
+                    self._condition.wait(self.poll_interval)
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+            self._running += 1
+            if resources is not None:
+                self._cpu += resources.cpu
+                self._memory += resources.memory
+                self._disk_io += bool(resources.disk_io)
+                if resources.host is not None:
+                    self._hosts[resources.host] += 1
+
+    def release(self, resources):
+        """
+        Gives back the tokens taken by acquire(resources).
+        """
+
+        with self._condition:
+            self._running -= 1
+            if resources is not None:
+                self._cpu -= resources.cpu
+                self._memory -= resources.memory
+                self._disk_io -= bool(resources.disk_io)
+                if resources.host is not None:
+                    self._hosts[resources.host] -= 1
+                    if not self._hosts[resources.host]:
+                        del self._hosts[resources.host]
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def admit(self, resources):
+        """
+        A context manager that acquires resources on entry and releases them on exit.
+        """
+
+        self.acquire(resources)
+        try:
+            yield
+        finally:
+            self.release(resources)
+
+
+@lru_cache(maxsize=None)
+def get_governor():
+    """
+    Returns the ResourceGovernor shared by all of the workflows in this process, configured from appsettings.cfg.
+    """
+
+    return ResourceGovernor()
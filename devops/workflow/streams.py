@@ -0,0 +1,175 @@
+"""
+The streams module lets tasks hand data to each other in memory instead of through intermediate files.
+
+A task that supports streams accepts a Stream in place of a file path for its source and/or destination. A Stream destination publishes the task's output as a workflow variable under the stream's name, and
+a Stream source with the same name reads it from there, e.g.:
+
+workflow.addstep('Retrieve XLS', web.HttpDataRetrieval(url, Stream('xls')))
+workflow.addstep('Convert XLS to CSV', datatransformation.XlsToCsv(Stream('xls'), 'data.csv'))
+
+Nothing is written to disk unless a file path is given. The published variable is a StreamBuffer (the whole output, held in memory, which any number of later steps can read) or, for a Stream created
+with buffered=False, a StreamReader (a single-use byte stream that is read while it is being produced, e.g. straight from the network, so the data is never held in memory all at once). Only a
+StreamBuffer can be passed to a step that runs in another process (see DevOpsTask.run_in_process); such a step can still run after an unbuffered Stream is published, it just can't read it.
+
+Tasks use open_source() and publish() / open_destination() to support streams; see XlsToCsv and HttpDataRetrieval.
+"""
+
+import io
+import os
+import shutil
+
+
+class Stream(object):
+
+    """
+    A marker used in place of a file path, naming a workflow variable that carries data between tasks in memory.
+
+    Instance Variables
+    =====================================
+    - self.name = The name of the workflow variable the data is published under.
+    - self.buffered = If True (the default), the producing task publishes a StreamBuffer; otherwise it publishes a StreamReader, where it can.
+    """
+
+    __slots__ = ('name', 'buffered')
+
+    def __init__(self, name, buffered=True):
+        self.name = name
+        self.buffered = buffered
+
+    def __repr__(self):
+        return 'Stream({!r})'.format(self.name)
+
+
+class StreamBuffer(object):
+
+    """
+    Data published to a Stream, held in memory. It can be opened any number of times; each open() returns a new binary file object over the same bytes, without copying them.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<StreamBuffer {} bytes>'.format(len(self.data))
+
+
+class StreamReader(object):
+
+    """
+    Data published to an unbuffered Stream: a binary file object that is read as the data is produced. It can only be opened once.
+    """
+
+    __slots__ = ('fileobj',)
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def open(self):
+        fileobj, self.fileobj = self.fileobj, None
+        if fileobj is None:
+            raise ValueError('An unbuffered stream can only be read once')
+        return fileobj
+
+    def __reduce__(self):
+        raise TypeError('An unbuffered stream can not be passed to another process; use a buffered Stream instead')
+
+    def __repr__(self):
+        return '<StreamReader>'
+
+
+class _UnavailableStream(object):
+
+    """
+    Stands in for a StreamReader in the input of a step that runs in another process, so that only a step that actually reads the stream fails.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def open(self):
+        raise ValueError('Stream {} is unbuffered, so it can not be read by a step that runs in another process; use a buffered Stream instead'.format(self.name))
+
+    def __repr__(self):
+        return '<UnavailableStream {}>'.format(self.name)
+
+
+def without_stream_readers(variables):
+    """
+    Returns variables as they can be sent to another process: if they hold StreamReaders, a dictionary copy in which each is replaced by a stand-in that raises a clear error when opened; otherwise
+    variables itself.
+    """
+
+    if not any(isinstance(value, StreamReader) for value in variables.values()):
+        return variables
+    return {name: _UnavailableStream(name) if isinstance(value, StreamReader) else value for name, value in variables.items()}
+
+
+def open_source(task, source):
+    """
+    Opens the source of a task for reading, as a binary file object. source is either a file path, or a Stream whose data is read from the task's input.
+    """
+
+    if isinstance(source, Stream):
+        try:
+            return task.input[source.name].open()
+        except KeyError:
+            raise KeyError('Stream {} has not been published by an earlier step'.format(source.name))
+    return open(source, 'rb')
+
+
+def publish(task, destination, fileobj):
+    """
+    Writes the data read from the binary file object fileobj to the destination of a task: a file path, or a Stream, which is published in the task's exhaust. fileobj is closed once it has been read.
+    For an unbuffered Stream, fileobj itself is published, and is read and closed by the consuming step.
+    """
+
+    if isinstance(destination, Stream) and not destination.buffered:
+        task.exhaust[destination.name] = StreamReader(fileobj)
+        return
+    with fileobj:
+        if isinstance(destination, Stream):
+            task.exhaust[destination.name] = StreamBuffer(fileobj.read())
+        else:
+            # Written to a temporary file next to destination and renamed into place, so destination is never left half written (e.g. when the data turns out to be corrupt).
+            temporary = '{}.{}.part'.format(destination, os.getpid())
+            try:
+                with open(temporary, 'wb') as target:
+                    shutil.copyfileobj(fileobj, target)
+                os.replace(temporary, destination)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+
+
+class _DestinationBuffer(io.BytesIO):
+
+    def __init__(self, task, stream):
+        super().__init__()
+        self.task = task
+        self.stream = stream
+
+    def close(self):
+        if not self.closed:
+            self.task.exhaust[self.stream.name] = StreamBuffer(self.getvalue())
+        super().close()
+
+
+def open_destination(task, destination):
+    """
+    Opens the destination of a task for writing, as a binary file object. If destination is a Stream, what is written is published in the task's exhaust when the file object is closed.
+    """
+
+    if isinstance(destination, Stream):
+        return _DestinationBuffer(task, destination)
+    return open(destination, 'wb')
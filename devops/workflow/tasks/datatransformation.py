@@ -1,11 +1,18 @@
 """
 The datatransformation module offers classes that transform data in some way.
 
-The XlsToCsv class takes an Excel (xls) file and converts it to csv format.
+The XlsToCsv class takes an Excel (xls) file and converts it to csv format. Either end can be a Stream (see the streams module) or an Artifact (see the artifacts module) rather than a file.
+    The source can be decompressed, and the csv compressed, as they are read and written (see the compression module).
 """
 
 import csv
-import xlrd
+import io
+import os
+from .. import artifacts
+from .. import compression
+from ..streams import Stream
+from ..streams import open_destination
+from ..streams import open_source
 from ..workflow import DevOpsTask
 
 
@@ -15,16 +22,20 @@ class XlsToCsv(DevOpsTask):
     XlsToCsv class takes an Excel (xls) file and converts it to csv format.
     """
 
-    def __init__(self, source, destination):
+    def __init__(self, source, destination, decompress=None, compress=None):
 
         """
-        self.source => The source xls file to convert.
-        self.destination = The target (output) csv file.
+        self.source => The source xls file to convert, or a Stream or Artifact published by an earlier step.
+        self.destination = The target (output) csv file, or a Stream or Artifact to publish the (utf-8 encoded) csv data to.
+        self.decompress => gzip, zstd, zip or 'auto' to decompress the source as it is read. Default is None.
+        self.compress => gzip, zstd or zip to compress the csv data as it is written; a compressed csv is always utf-8 encoded. Default is None.
         """
 
         super().__init__()
         self.source = source
         self.destination = destination
+        self.decompress = decompress
+        self.compress = compress
 
     def execute(self, step_name=''):
 
@@ -33,11 +44,44 @@ class XlsToCsv(DevOpsTask):
         be changed to use a config entry in the next version.
         """
 
+        import xlrd
         super().execute(step_name)
-        book = xlrd.open_workbook(self.source)
+        source_path = artifacts.source_path(self, self.source) if isinstance(self.source, artifacts.Artifact) else self.source
+        if self.decompress:
+            with compression.open_decompressed(open_source(self, source_path), self.decompress) as source:
+                book = xlrd.open_workbook(file_contents=source.read())
+        elif isinstance(source_path, Stream):
+            with open_source(self, source_path) as source:
+                book = xlrd.open_workbook(file_contents=source.read())
+        else:
+            book = xlrd.open_workbook(source_path)
         sheet = book.sheets()[0]
-        with open(self.destination, 'w') as csvfile:
+        if isinstance(self.destination, Stream):
+            output = open_destination(self, self.destination)
+        elif isinstance(self.destination, artifacts.Artifact):
+            output = artifacts.open_destination(self, self.destination)
+        elif self.compress:
+            output = open(self.destination, 'wb')
+        else:
+            output = None
+        if output is None:
+            csvfile = open(self.destination, 'w')
+        else:
+            if self.compress:
+                output = compression.open_compressed(output, self.compress, member_name=self._get_member_name())
+            csvfile = io.TextIOWrapper(output, encoding='utf-8', newline='')
+        with csvfile:
             csvwriter = csv.writer(csvfile, delimiter='|', quoting=csv.QUOTE_NONE)
             for rowNum in range(sheet.nrows):
                 csvwriter.writerow(sheet.row_values(rowNum))
-        self._w_print('A copy of the xls file {} has been saved using csv format. Saved to: {}'.format(self.source, self.destination))
\ No newline at end of file
+        self._w_print('A copy of the xls file {} has been saved using csv format. Saved to: {}'.format(self.source, self.destination))
+
+    def _get_member_name(self):
+        """
+        Returns the name of the csv file inside a zip archive: the destination file's name without its .zip suffix.
+        """
+
+        if isinstance(self.destination, (Stream, artifacts.Artifact)):
+            return self.destination.name + '.csv'
+        name = os.path.basename(self.destination)
+        return name[:-4] if name.lower().endswith('.zip') else name
@@ -1,11 +1,33 @@
 """
 The git module offers classes that deal with git source control tasks.
+
+If cacheDirectory is set in the [SourceControl] section of appsettings.cfg, Clone keeps a bare mirror of every remote it clones in that directory, and later clones of the same remote only fetch what has
+changed since. The mirror is kept between runs (and stays warm in a long-running process such as the workflow daemon).
+Clone publishes the resources its git commands used, added up, in the exhaust as rusage (see ExecuteCommand).
+Clone can also put the cloned repository into the artifact store (see the artifacts module), by passing an Artifact as the local repo.
 """
 
+import hashlib
+import os
+import shutil
+import threading
+from .. import artifacts
 from .system import ExecuteCommand
+from .system import combine_rusage
+from .system import delete_onerror
 from ..workflow import DevOpsTask
 from ..core import get_system_config_value
 
+
+_mirror_locks = {}
+_mirror_locks_lock = threading.Lock()
+
+
+def _get_mirror_lock(mirror):
+    with _mirror_locks_lock:
+        return _mirror_locks.setdefault(mirror, threading.Lock())
+
+
 class Clone(DevOpsTask):
 
     """
@@ -16,7 +38,7 @@ class Clone(DevOpsTask):
 
         """
         self.remote_repo_url => The url of the remote repository.
-        self.local_repo => The location of the local repository.
+        self.local_repo => The location of the local repository, or an Artifact to put the cloned repository into the artifact store. Copy can then materialize it wherever it is needed.
         """
 
         super().__init__()
@@ -30,6 +52,48 @@ class Clone(DevOpsTask):
         """
 
         super().execute(step_name)
+        git = get_system_config_value('SourceControl', 'git')
+        command = [git, 'clone']
+        mirror = self._update_mirror(git)
+        if mirror is not None:
+            command += ['--reference-if-able', mirror, '--dissociate']
         self._w_print('Attempting to run git clone {} {}'.format(self.remote_repo_url, self.local_repo))
-        command_execution = ExecuteCommand([get_system_config_value('SourceControl', 'git'), 'clone', self.remote_repo_url, self.local_repo])
-        command_execution.execute()
\ No newline at end of file
+        if not isinstance(self.local_repo, artifacts.Artifact):
+            self._run(command + [self.remote_repo_url, self.local_repo])
+            return
+        directory = artifacts.temporary_directory()
+        try:
+            local_repo = os.path.join(directory, 'repo')
+            self._run(command + [self.remote_repo_url, local_repo])
+            digest = artifacts.publish_path(self, self.local_repo, local_repo, link_back=True)
+            self._w_print('Stored the cloned repository as artifact {}'.format(digest))
+        finally:
+            shutil.rmtree(directory, onerror=delete_onerror)
+
+    def _update_mirror(self, git):
+        """
+        Creates or refreshes the cached mirror of self.remote_repo_url and returns its path, or returns None if no cacheDirectory is configured.
+        """
+
+        cache_directory = get_system_config_value('SourceControl', 'cacheDirectory', fallback='')
+        if not cache_directory:
+            return None
+        mirror = os.path.join(cache_directory, hashlib.sha1(self.remote_repo_url.encode()).hexdigest() + '.git')
+        with _get_mirror_lock(mirror):
+            if os.path.isdir(mirror):
+                self._w_print('Updating cached mirror {}'.format(mirror))
+                self._run([git, '--git-dir', mirror, 'remote', 'update', '--prune'])
+            else:
+                os.makedirs(cache_directory, exist_ok=True)
+                self._w_print('Creating cached mirror {}'.format(mirror))
+                self._run([git, 'clone', '--mirror', self.remote_repo_url, mirror])
+        return mirror
+
+    def _run(self, command):
+        """
+        Runs a git command, adding the resources it used to the rusage in the exhaust.
+        """
+
+        task = ExecuteCommand(command)
+        task.execute()
+        self.exhaust['rusage'] = combine_rusage(self.exhaust.get('rusage'), task.exhaust['rusage'])
\ No newline at end of file
@@ -1,13 +1,31 @@
 """
 The filesystem module offers classes that deal with filesystem tasks.
 
-The Copy class copies a file from one location to another.
+The Copy class copies a file from one location to another. Either end can be a Stream (see the streams module), e.g. to save data that earlier steps passed around in memory, or an Artifact (see the
+    artifacts module), to put a file or directory into the artifact store or to materialize one from it. Copy can also decompress and/or compress the data as it copies it (see the compression module).
+The ExecuteCommand class runs a command, either in a new process or, to save the cost of starting one for each of many small commands, in a long-lived shell (see ShellSession). It publishes the
+    resources the command used (see rusage in ExecuteCommand).
+The Fingerprint class computes a digest of a file or directory tree, hashing files on a thread pool and skipping files that haven't changed since the last run.
 """
 
+import atexit
+import collections
+import contextlib
 import os
 import shutil
-import subprocess
+import sys
+import threading
+import time
+from .. import artifacts
+from .. import compression
+from .. import tracing
+from ..streams import Stream
+from ..streams import open_source
+from ..streams import publish
 from ..workflow import DevOpsTask
+from ..core import ensure_private_directory
+from ..core import get_private_directory
+from ..core import get_system_config_value
 
 
 class Copy(DevOpsTask):
@@ -16,16 +34,20 @@ class Copy(DevOpsTask):
     The Copy class copies an operating system entity from one location to another.
     """
 
-    def __init__(self, source, destination):
+    def __init__(self, source, destination, decompress=None, compress=None):
 
         """
-        self.source => The source file to copy.
-        self.destination => The target (output) file.
+        self.source => The source file to copy, or a Stream or Artifact.
+        self.destination => The target (output) file, or a Stream or Artifact. Copying an Artifact to a path materializes it there, as a hardlink where possible.
+        self.decompress => gzip, zstd, zip or 'auto' to decompress the source as it is copied. Default is None.
+        self.compress => gzip or zstd to compress the data as it is copied. Default is None.
         """
 
         super().__init__()
         self.source = source
         self.destination = destination
+        self.decompress = decompress
+        self.compress = compress
 
     def execute(self, step_name=''):
 
@@ -35,7 +57,37 @@ class Copy(DevOpsTask):
 
         super().execute(step_name)
         self._w_print('Copying {} to {}'.format(self.source, self.destination))
-        shutil.copy2(self.source, self.destination)
+        if self.decompress or self.compress:
+            self._copy_transformed()
+        elif isinstance(self.source, artifacts.Artifact):
+            artifacts.materialize(self, self.source, self.destination)
+        elif isinstance(self.destination, artifacts.Artifact):
+            if isinstance(self.source, Stream):
+                with open_source(self, self.source) as source:
+                    artifacts.publish_fileobj(self, self.destination, source)
+            else:
+                artifacts.publish_path(self, self.destination, self.source)
+        elif isinstance(self.source, Stream) or isinstance(self.destination, Stream):
+            publish(self, self.destination, open_source(self, self.source))
+        else:
+            shutil.copy2(self.source, self.destination)
+
+    def _copy_transformed(self):
+        """
+        Copies the data through the decompressing and/or compressing readers, from and to any kind of source and destination.
+        """
+
+        source = artifacts.source_path(self, self.source) if isinstance(self.source, artifacts.Artifact) else self.source
+        data = open_source(self, source)
+        if self.decompress:
+            data = compression.open_decompressed(data, self.decompress)
+        if self.compress:
+            data = compression.compressing_reader(data, self.compress)
+        if isinstance(self.destination, artifacts.Artifact):
+            with data:
+                artifacts.publish_fileobj(self, self.destination, data)
+        else:
+            publish(self, self.destination, data)
 
 
 class MakeDirectory(DevOpsTask):
@@ -126,19 +178,33 @@ def delete_onerror(func, path, exc_info):
 class ExecuteCommand(DevOpsTask):
 
     """
-    Executes a command on the command line.
+    Executes a command on the command line. Its return code and output (stdout and stderr, decoded as utf-8) are published in the exhaust as return_code and output.
+
+    The resources the command used are published in the exhaust as rusage, a dictionary of wall_seconds and output_bytes and, where os.wait4() is available, the child's user_seconds,
+    system_seconds, max_rss_bytes, block_input and block_output (operations), and voluntary_context_switches and involuntary_context_switches. A command run in a ShellSession only has wall_seconds and
+    output_bytes, as the session's shell is the one that waits for it.
+
+    If the step is being traced (see the tracing module), the command gets the W3C traceparent of the step's span in its TRACEPARENT environment variable.
+
+    With use_session, the command is run by a ShellSession kept for the working directory instead of a new process of its own, which makes running many small commands much cheaper. Where there is no
+    shell to use (see _get_shell()), the command runs in a new process as usual.
+
+    A command given as a list means the same either way. A command given as a str does not: without use_session it is the name (or path) of an executable to run without arguments, as with
+    subprocess.Popen, while with use_session it is a shell command line, with its own arguments, quoting, variables and redirections.
     """
 
-    def __init__(self, command, working_directory=None):
+    def __init__(self, command, working_directory=None, use_session=False):
 
         """
-        self.command => The command to execute. This should be passed in as a list of format: [executable_name, arg1, arg2,...]
+        self.command => The command to execute. This should be passed in as a list of format: [executable_name, arg1, arg2,...]. With use_session, a str is run as a shell command line.
         self.working_directory => The working directory to execute the command in. Default is None. If not specified, the current working directory is used.
+        self.use_session => If True, run the command in a long-lived shell. Default is False.
         """
 
         super().__init__()
         self.command = command
         self.working_directory = working_directory
+        self.use_session = use_session
 
 
     def execute(self, step_name=''):
@@ -147,8 +213,354 @@ class ExecuteCommand(DevOpsTask):
         Will run the command specified by self.command
         """
 
+        import subprocess
         super().execute(step_name)
         self._w_print('Attempting to run command {}'.format(self.command))
-        proc = subprocess.Popen(args=self.command, cwd=self.working_directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        out, err = proc.communicate()
+        started = time.monotonic()
+        usage = None
+        traceparent = tracing.current_traceparent()
+        environment = {'TRACEPARENT': traceparent} if traceparent else {}
+        if self.use_session and _get_shell():
+            with shell_session(self.working_directory) as session:
+                return_code, out = session.run(self.command, environment)
+        else:
+            proc = subprocess.Popen(args=self.command, cwd=self.working_directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, **environment) if environment else None)
+            if hasattr(os, 'wait4'):
+                with proc.stdout:
+                    out = proc.stdout.read()
+                # Reaping the child with wait4() rather than Popen.wait() is what gets its resource usage.
+                _, status, usage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+            else:
+                out, err = proc.communicate()
+            return_code = proc.returncode
         self._w_print('Result: {}'.format(out))
+        self.exhaust['return_code'] = return_code
+        self.exhaust['output'] = out.decode('utf-8', errors='replace')
+        self.exhaust['rusage'] = _rusage_to_dict(usage, time.monotonic() - started, len(out))
+
+
+def _rusage_to_dict(usage, wall_seconds, output_bytes):
+    rusage = {'wall_seconds': wall_seconds, 'output_bytes': output_bytes}
+    if usage is not None:
+        rusage.update(user_seconds=usage.ru_utime, system_seconds=usage.ru_stime,
+                      # ru_maxrss is in kilobytes, except on macOS, where it is in bytes.
+                      max_rss_bytes=usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+                      block_input=usage.ru_inblock, block_output=usage.ru_oublock,
+                      voluntary_context_switches=usage.ru_nvcsw, involuntary_context_switches=usage.ru_nivcsw)
+    return rusage
+
+
+def combine_rusage(total, rusage):
+    """
+    Adds the rusage of a command (see ExecuteCommand) to total, the rusage of the commands before it, and returns the result; e.g. for a task that runs several commands. max_rss_bytes is the largest
+    of them. total can be None.
+    """
+
+    if total is None:
+        return dict(rusage)
+    combined = dict(total)
+    for key, value in rusage.items():
+        combined[key] = max(combined.get(key, 0), value) if key == 'max_rss_bytes' else combined.get(key, 0) + value
+    return combined
+
+
+def _get_shell():
+    """
+    Returns the shell ShellSession runs: shell in the [Execution] section of appsettings.cfg, or by default /bin/sh, except on Windows, where there is no default.
+    """
+
+    return get_system_config_value('Execution', 'shell', fallback='') or ('' if os.name == 'nt' else '/bin/sh')
+
+
+class ShellSession(object):
+
+    """
+    A long-lived POSIX shell that runs commands one after another, so that running a command doesn't cost starting a new process from Python. The shell still forks the subshell each command runs in
+    (see below), but a fork of a running shell is cheap next to starting an interpreter, and a shell builtin runs in that subshell without executing another program.
+
+    Each command is sent to the shell's stdin followed by a line that prints a delimiter (unique to the session) and the command's exit status; its output is everything the shell writes to stdout
+    before the delimiter. A command runs in a subshell, through eval, with its stdin redirected from /dev/null and stderr to stdout: a command that changes directory or variables, reads stdin, or
+    doesn't even parse, can't disturb the session or the commands after it. The shell's environment is that of the process when the session was started.
+
+    A session runs one command at a time; see shell_session() for the pool of sessions that ExecuteCommand uses.
+    """
+
+    def __init__(self, working_directory=None, shell=None):
+        import subprocess
+        import uuid
+        self.working_directory = working_directory
+        self.delimiter = 'devops-command-done-{}'.format(uuid.uuid4().hex).encode()
+        self.process = subprocess.Popen([shell or _get_shell()], cwd=working_directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def run(self, command, environment=None):
+        """
+        Runs command (a list of arguments, or a shell command line) and returns its exit status and output (bytes). environment is a dictionary of environment variables to export to the command.
+        Raises RuntimeError if the shell has exited.
+        """
+
+        import shlex
+        if not isinstance(command, str):
+            command = ' '.join(shlex.quote(str(argument)) for argument in command)
+        exports = ''.join('export {}={}; '.format(name, shlex.quote(value)) for name, value in (environment or {}).items())
+        script = '( {}eval {} ) </dev/null 2>&1; printf \'\\n%s %d\\n\' {} $?\n'.format(exports, shlex.quote(command), self.delimiter.decode())
+        try:
+            self.process.stdin.write(script.encode())
+            self.process.stdin.flush()
+        except OSError:
+            raise RuntimeError('The shell session for {} has exited'.format(self.working_directory))
+        lines = []
+        for line in iter(self.process.stdout.readline, b''):
+            if line.startswith(self.delimiter + b' '):
+                # The output ends with the newline printed before the delimiter, so that the delimiter always starts a line.
+                return int(line.split()[1]), b''.join(lines)[:-1]
+            lines.append(line)
+        raise RuntimeError('The shell session for {} has exited'.format(self.working_directory))
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self, timeout=5):
+        """
+        Ends the session: closes the shell's stdin and waits up to timeout seconds for it to exit, and kills it if it hasn't (e.g. because a command it runs hangs).
+        """
+
+        import subprocess
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+_idle_shell_sessions = collections.defaultdict(list)
+_shell_sessions_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def shell_session(working_directory=None):
+    """
+    Lends out an idle ShellSession for working_directory, starting a new one if all of them are busy, and returns it to the pool afterwards. Sessions are kept for the life of the process; a session
+    whose command fails with an exception (e.g. because the shell exited) is closed instead of returned.
+    """
+
+    working_directory = os.path.abspath(working_directory or os.getcwd())
+    session = None
+    with _shell_sessions_lock:
+        idle = _idle_shell_sessions[working_directory]
+        while idle and session is None:
+            session = idle.pop()
+            if not session.alive:
+                session = None
+    if session is None:
+        session = ShellSession(working_directory)
+    try:
+        yield session
+    except BaseException:
+        session.close()
+        raise
+    if session.alive:
+        with _shell_sessions_lock:
+            _idle_shell_sessions[working_directory].append(session)
+
+
+def close_shell_sessions():
+    """
+    Closes every idle ShellSession. It is called when the process exits, and by the workflow daemon when it shuts down.
+    """
+
+    with _shell_sessions_lock:
+        sessions = [session for idle in _idle_shell_sessions.values() for session in idle]
+        _idle_shell_sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+atexit.register(close_shell_sessions)
+
+
+def _hash_file(path):
+    """
+    Returns the SHA-256 hex digest of the file at path, read through a memory map. hashlib releases the GIL while it hashes large buffers, so several files can be hashed at once on a thread pool.
+    """
+
+    import hashlib
+    import mmap
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, 64 * 1024 * 1024):
+                        digest.update(view[offset:offset + 64 * 1024 * 1024])
+                finally:
+                    view.release()
+    return digest.hexdigest()
+
+
+class Fingerprint(DevOpsTask):
+
+    """
+    Computes a digest of a file or a directory tree, for change detection, verifying artifacts and cache keys. Files are hashed (SHA-256) through memory-mapped reads on a thread pool. A directory's digest
+    is a Merkle digest over the names, kinds and digests of its entries, so two trees have the same digest exactly when they have the same content and layout.
+
+    A stat cache (a JSON file, see cacheDirectory in the [Fingerprint] section of appsettings.cfg) remembers the size, modification time, change time and inode of every file hashed, so files that haven't
+    changed since the last run aren't read again. The change time can't be set back, so a file rewritten with its old modification time is hashed again. A file modified within the same second the cache
+    was written is always hashed again, as its modification time can't tell whether it changed since. The cache lives in a directory only the current user can access, as a planted cache could forge digests.
+
+    Only regular files are hashed: FIFOs, sockets and devices below the directory are skipped (reading one could block forever), and fingerprinting one of them directly raises ValueError.
+
+    The digest is published in the exhaust under variable_name, and a manifest of every file's digest (keyed by its path relative to the fingerprinted directory, with / separators) under
+    variable_name + '_manifest'.
+    """
+
+    def __init__(self, path, variable_name='fingerprint', max_workers=None, cache_file=None):
+
+        """
+        self.path => The file or directory to fingerprint.
+        self.variable_name => The exhaust variable the digest is published under.
+        self.max_workers => The number of threads that hash files. Default is None, which uses the concurrent.futures default.
+        self.cache_file => The stat cache file. Default is None, which uses a file named after self.path in the configured cacheDirectory.
+        """
+
+        super().__init__()
+        self.path = path
+        self.variable_name = variable_name
+        self.max_workers = max_workers
+        self.cache_file = cache_file
+
+    def execute(self, step_name=''):
+
+        """
+        Hashes every file below self.path that isn't in the stat cache, or has changed, and publishes the digest and manifest.
+        """
+
+        super().execute(step_name)
+        self._w_print('Fingerprinting {}'.format(self.path))
+        try:
+            cache_file = self.cache_file or self._get_default_cache_file()
+        except OSError as e:
+            self._w_print('Not using the stat cache: {}'.format(e))
+            cache_file = None
+        cache = self._read_cache(cache_file) if cache_file else {}
+        cache_written = cache.get('written', 0)
+        cached_files = cache.get('files', {})
+
+        root = os.path.abspath(self.path)
+        files, links, directories, skipped = self._scan(root)
+        if skipped:
+            self._w_print('Skipped {} file(s) that are not regular files: {}'.format(len(skipped), ', '.join(skipped)))
+        manifest = {}
+        stats = {}
+        to_hash = []
+        for relative, st in files.items():
+            key = [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+            stats[relative] = key
+            cached = cached_files.get(relative)
+            if cached is not None and cached[:4] == key and st.st_mtime_ns < cache_written - 1000000000:
+                manifest[relative] = cached[4]
+            else:
+                to_hash.append(relative)
+
+        if to_hash:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                paths = [root if relative == '' else os.path.join(root, *relative.split('/')) for relative in to_hash]
+                for relative, digest in zip(to_hash, executor.map(_hash_file, paths)):
+                    manifest[relative] = digest
+        self._w_print('Hashed {} file(s); {} unchanged file(s) were taken from the stat cache.'.format(len(to_hash), len(files) - len(to_hash)))
+
+        if cache_file:
+            self._write_cache(cache_file, {'written': time.time_ns(), 'files': {relative: stats[relative] + [manifest[relative]] for relative in manifest}})
+        if '' in manifest:
+            digest = manifest['']
+        else:
+            digest = self._tree_digest(manifest, links, directories)
+        self.exhaust[self.variable_name] = digest
+        self.exhaust[self.variable_name + '_manifest'] = manifest
+        self._w_print('Fingerprint: {}'.format(digest))
+
+    def _scan(self, root):
+        """
+        Returns the regular files (relative path => os.stat_result), symbolic links (relative path => target), directories (relative paths) and skipped files (relative paths of anything else) below
+        root. A root that is a file is returned as the file ''.
+        """
+
+        import stat
+        files, links, directories, skipped = {}, {}, [''], []
+        if not os.path.isdir(root):
+            st = os.stat(root)
+            if not stat.S_ISREG(st.st_mode):
+                raise ValueError('{} is not a regular file or a directory'.format(root))
+            files[''] = st
+            return files, links, [], skipped
+        stack = [('', root)]
+        while stack:
+            relative, directory = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    name = relative + '/' + entry.name if relative else entry.name
+                    if entry.is_symlink():
+                        links[name] = os.readlink(entry.path)
+                    elif entry.is_dir():
+                        directories.append(name)
+                        stack.append((name, entry.path))
+                    else:
+                        st = entry.stat()
+                        if stat.S_ISREG(st.st_mode):
+                            files[name] = st
+                        else:
+                            skipped.append(name)
+        return files, links, directories, skipped
+
+    def _tree_digest(self, manifest, links, directories):
+        """
+        Computes the Merkle digest of the tree: every directory's digest is the SHA-256 of the sorted list of its entries' kind, name and digest.
+        """
+
+        import hashlib
+        children = {directory: [] for directory in directories}
+        for relative, digest in manifest.items():
+            children[relative.rpartition('/')[0]].append(('f', relative.rpartition('/')[2], digest))
+        for relative, target in links.items():
+            children[relative.rpartition('/')[0]].append(('l', relative.rpartition('/')[2], hashlib.sha256(target.encode()).hexdigest()))
+        # Deepest directories first, so that every directory's children are complete before it is hashed.
+        for directory in sorted(directories, key=lambda d: d.count('/') + bool(d), reverse=True):
+            entries = sorted(children[directory], key=lambda entry: entry[1])
+            digest = hashlib.sha256(''.join('{} {}\0{}\n'.format(*entry) for entry in entries).encode()).hexdigest()
+            if directory:
+                children[directory.rpartition('/')[0]].append(('d', directory.rpartition('/')[2], digest))
+        return digest
+
+    def _get_default_cache_file(self):
+        import hashlib
+        configured = get_system_config_value('Fingerprint', 'cacheDirectory', fallback='')
+        directory = ensure_private_directory(configured) if configured else get_private_directory('fingerprints')
+        return os.path.join(directory, hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest() + '.json')
+
+    def _read_cache(self, cache_file):
+        import json
+        try:
+            with open(cache_file, 'r') as cache:
+                return json.load(cache)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, cache_file, cache):
+        import json
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+            temporary = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(temporary, 'w') as output:
+                json.dump(cache, output)
+            os.replace(temporary, cache_file)
+        except OSError:
+            self._w_print('Unable to write the stat cache {}'.format(cache_file))
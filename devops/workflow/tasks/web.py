@@ -2,28 +2,271 @@
 The web module offers classes that deal with traversing and getting data from the web.
 
 The HttpDataRetrieval class makes use of the requests module (http://requests.readthedocs.org/en/latest/) to do a GET on static data from some web address.
+get_session() returns the requests.Session used by the tasks in this module. There is one per thread and it is kept for the life of the process, so connections to a host are reused across steps, and across
+    runs in a long-running process such as the workflow daemon.
+HttpDataRetrieval can publish what it retrieves to a Stream (see the streams module) or put it into the artifact store (see the artifacts module) instead of saving it to a file.
+HttpDataRetrieval hashes the data while it is retrieved, and can verify it against an expected digest or a checksum file before it is saved.
+HttpDataRetrieval can decompress (gzip, zstd or zip) and/or compress the data as it arrives (see the compression module), so no uncompressed intermediate file is written.
+HttpDataRetrieval can race mirrors of the data against each other: see hedge_delay().
+Every request is sent with the connect and read timeouts of get_timeout(), so a server that stops responding fails the request rather than holding a thread forever.
+The BulkHttpDataRetrieval class retrieves a manifest of urls concurrently, capping the number of requests per host and overall, and adapting how many run at once to the latency and errors it observes.
 """
 
+import collections
+import collections.abc
+import functools
+import io
+import math
+import threading
+import time
+from .. import artifacts
+from .. import compression
+from ..streams import Stream
+from ..streams import publish
 from ..workflow import DevOpsTask
-import requests
+from ..core import get_system_config_value
+
+
+_sessions = threading.local()
+_first_byte_times = collections.defaultdict(lambda: collections.deque(maxlen=200))
+_first_byte_times_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns this thread's requests.Session, creating it on first use.
+    """
+
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        import requests
+        session = _sessions.session = requests.Session()
+    return session
+
+
+def _record_first_byte_time(url, seconds):
+    from urllib.parse import urlsplit
+    with _first_byte_times_lock:
+        _first_byte_times[urlsplit(url).netloc].append(seconds)
+
+
+def hedge_delay(url):
+    """
+    Returns how long (in seconds) HttpDataRetrieval waits for the first bytes from url before it sends a hedged request to the next mirror: the hedgePercentile percentile (in the [Web] section of
+    appsettings.cfg) of the times to first byte recently seen from url's host. Until hedgeMinSamples times have been seen (the history is kept in memory, for the life of the process), hedgeDelay is
+    used instead.
+    """
+
+    from urllib.parse import urlsplit
+    with _first_byte_times_lock:
+        samples = sorted(_first_byte_times.get(urlsplit(url).netloc, ()))
+    if len(samples) < int(get_system_config_value('Web', 'hedgeMinSamples', fallback='20')):
+        return float(get_system_config_value('Web', 'hedgeDelay', fallback='2.0'))
+    percentile = float(get_system_config_value('Web', 'hedgePercentile', fallback='95'))
+    return samples[max(0, math.ceil(percentile / 100 * len(samples)) - 1)]
+
+
+def get_timeout():
+    """
+    Returns the (connect, read) timeout in seconds that requests are sent with: connectTimeout and readTimeout in the [Web] section of appsettings.cfg. The read timeout is the longest wait for the next
+    bytes of a response, not for all of it.
+    """
+
+    return (float(get_system_config_value('Web', 'connectTimeout', fallback='10')), float(get_system_config_value('Web', 'readTimeout', fallback='60')))
+
+
+def _request(url):
+    """
+    GETs url and waits for the first bytes of the data to arrive. Returns the url, the response, a binary file object over the (decoded) data and the time to first byte.
+    """
+
+    started = time.monotonic()
+    r = get_session().get(url, stream=True, timeout=get_timeout())
+    r.raise_for_status()
+    r.raw.decode_content = True
+    data = io.BufferedReader(r.raw)
+    data.peek(1)
+    return url, r, data, time.monotonic() - started
+
+
+def _close_loser(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result()[2].close()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_race_executor():
+    """
+    Returns the thread pool hedged requests are sent on. It is kept for the life of the process, so that its threads' sessions (see get_session()) keep their connections.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=int(get_system_config_value('Web', 'maxConcurrency', fallback='16')), thread_name_prefix='hedged-request')
+
+
+def _race(urls, delay):
+    """
+    Requests urls[0], and every time delay seconds pass without any data arriving (or a request fails) the next of urls as well. Returns the result of _request() for the first one to produce data,
+    and the number of requests sent. The others are cancelled: requests that haven't been sent are dropped, and the responses of those in flight are closed as they arrive.
+
+    The times to first byte of the losers are recorded too (see hedge_delay()), or for a loser still waiting, how long it has waited so far; recording only the winners would leave out the slow
+    responses, so the percentile would drift low and requests would be hedged more and more often.
+    """
+
+    from concurrent.futures import wait, FIRST_COMPLETED
+    remaining = collections.deque(urls)
+    executor = _get_race_executor()
+    sent = {}
+
+    def submit(url):
+        future = executor.submit(_request, url)
+        sent[future] = url, time.monotonic()
+        return future
+    racing = {submit(remaining.popleft())}
+    errors = []
+    while racing:
+        done, racing = wait(racing, timeout=delay if remaining else None, return_when=FIRST_COMPLETED)
+        winner = None
+        for future in done:
+            if future.exception() is not None:
+                errors.append(future.exception())
+            elif winner is None:
+                winner = future.result()
+            else:
+                url, _, _, seconds = future.result()
+                _record_first_byte_time(url, seconds)
+                _close_loser(future)
+        if winner is not None:
+            now = time.monotonic()
+            for future in racing:
+                if not future.cancel():
+                    url, submitted = sent[future]
+                    _record_first_byte_time(url, now - submitted)
+                future.add_done_callback(_close_loser)
+            return winner, len(urls) - len(remaining)
+        if remaining:
+            racing.add(submit(remaining.popleft()))
+    raise errors[-1]
+
+
+class DigestMismatchError(ValueError):
+
+    """
+    Raised when the digest of retrieved data doesn't match the expected digest. The data is not saved or published.
+    """
+
+    pass
+
+
+class _VerifyingReader(object):
+
+    """
+    Wraps a binary file object, hashing the data as it is read. If an expected digest is given, reaching the end of the data raises DigestMismatchError when the digest doesn't match it.
+    """
+
+    def __init__(self, fileobj, algorithm, expected=None):
+        import hashlib
+        self.fileobj = fileobj
+        self.digest = hashlib.new(algorithm)
+        self.expected = expected
+        self.hexdigest = None
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        self.bytes_read += len(data)
+        if not data or size is None or size < 0:
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self.hexdigest is not None:
+            return
+        self.hexdigest = self.digest.hexdigest()
+        if self.expected is not None and self.hexdigest != self.expected:
+            raise DigestMismatchError('Expected {} digest {}, but the data retrieved has digest {}'.format(self.digest.name, self.expected, self.hexdigest))
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _save(task, destination, fileobj):
+    """
+    Saves the data read from fileobj to the destination of task: a file path, a Stream or an Artifact.
+    """
+
+    if isinstance(destination, artifacts.Artifact):
+        with fileobj:
+            artifacts.publish_fileobj(task, destination, fileobj)
+    else:
+        publish(task, destination, fileobj)
+
+
+def _parse_checksum_file(text, url):
+    """
+    Finds the digest for url in the contents of a checksum file: either a bare digest, or lines of '<digest>  <file name>' as written by sha256sum and similar tools.
+    """
+
+    name = url.rstrip('/').rpartition('/')[2].partition('?')[0]
+    lines = [line.split() for line in text.splitlines() if line.strip()]
+    if len(lines) == 1 and len(lines[0]) == 1:
+        return lines[0][0]
+    for fields in lines:
+        if len(fields) >= 2 and fields[-1].lstrip('*') == name:
+            return fields[0]
+    raise ValueError('No checksum for {} was found in the checksum file'.format(name))
 
 
 class HttpDataRetrieval(DevOpsTask):
 
     """
     The HttpDataRetrieval class makes use of the requests module (http://requests.readthedocs.org/en/latest/) to do a GET on static data from some web address.
+
+    The data is hashed while it is retrieved and its digest is published in the exhaust under digest_name. If an expected digest (or the url of a checksum file to find it in) is given, data that
+    doesn't match it is rejected with a DigestMismatchError before it is saved: a file destination is written to a temporary file that is only renamed into place once the digest is verified. Data
+    retrieved to an unbuffered Stream is verified by the step that reads it, when it reaches the end of the data, and its digest isn't published.
+
+    The data can be decompressed and/or compressed while it is retrieved. The digest is always that of the data as it was retrieved, i.e. before it is decompressed.
+
+    If mirrors are given, requests are hedged: when the first bytes haven't arrived from url within hedge_delay() (a high percentile of the times to first byte recently seen from the host), the same
+    data is requested from the next mirror as well, and so on, and the first to produce data is used; the others are cancelled. A mirror is also tried as soon as a request fails. The url the data
+    was retrieved from, its time to first byte, the number of requests sent and the number of bytes retrieved are published in the exhaust under source_name.
     """
 
-    def __init__(self, url, destination):
+    def __init__(self, url, destination, expected_digest=None, checksum_url=None, algorithm='sha256', digest_name='digest', decompress=None, compress=None, mirrors=(), source_name='source'):
 
         """
         self.url => The url to GET data from.
-        self.destination = The target save location on the local machine.
+        self.destination = The target save location on the local machine, or a Stream to hand the data to the next steps in memory. With an unbuffered Stream, the data is read from the network
+            by the step that consumes it. Or an Artifact, to put the data into the artifact store.
+        self.expected_digest => The expected hex digest of the data, optionally prefixed with the algorithm (e.g. 'sha256:...'). Default is None, which doesn't verify the data.
+        self.checksum_url => The url of a checksum file (e.g. SHA256SUMS) to take the expected digest from, if expected_digest is not given.
+        self.algorithm => The hashlib algorithm to hash the data with, e.g. 'sha256' or 'blake2b'.
+        self.digest_name => The exhaust variable the digest is published under.
+        self.decompress => gzip, zstd or zip to decompress the data as it arrives, or 'auto' to recognize the compression from the data (data that isn't compressed is saved as it is). Default is None.
+        self.compress => gzip or zstd to compress the (decompressed) data before it is saved. Default is None.
+        self.mirrors => Other urls the same data can be retrieved from, in order of preference. Pass [url] to hedge with a second request to url itself.
+        self.source_name => The exhaust variable the url the data was retrieved from (and its time to first byte) is published under.
         """
 
         super().__init__()
         self.url = url
         self.destination = destination
+        self.expected_digest = expected_digest
+        self.checksum_url = checksum_url
+        self.algorithm = algorithm
+        self.digest_name = digest_name
+        self.decompress = decompress
+        self.compress = compress
+        self.mirrors = mirrors
+        self.source_name = source_name
 
     def execute(self, step_name=''):
 
@@ -32,8 +275,200 @@ class HttpDataRetrieval(DevOpsTask):
         """
 
         super().execute(step_name)
+        algorithm, expected = self._get_expected_digest()
         self._w_print('Attempting to retrieve data from {}'.format(self.url))
-        r = requests.get(self.url)
+        if self.mirrors:
+            (url, _, raw, seconds), requests = _race([self.url] + list(self.mirrors), hedge_delay(self.url))
+        else:
+            (url, _, raw, seconds), requests = _request(self.url), 1
+        _record_first_byte_time(url, seconds)
+        self.exhaust[self.source_name] = {'url': url, 'first_byte_seconds': seconds, 'requests': requests}
+        if url != self.url or requests > 1:
+            self._w_print('Retrieving from {} (first bytes after {:.3f}s, {} request(s) sent)'.format(url, seconds, requests))
+        reader = data = _VerifyingReader(raw, algorithm, expected)
+        if self.decompress:
+            data = compression.open_decompressed(data, self.decompress)
+        if self.compress:
+            data = compression.compressing_reader(data, self.compress)
         self._w_print('Saving data to: {}'.format(self.destination))
-        with open(self.destination, 'wb') as dest:
-            dest.write(r.content)
\ No newline at end of file
+        _save(self, self.destination, data)
+        if not isinstance(self.destination, Stream) or self.destination.buffered:
+            self.exhaust[self.source_name]['bytes'] = reader.bytes_read
+        if reader.hexdigest is not None:
+            self.exhaust[self.digest_name] = reader.hexdigest
+            self._w_print('{} digest: {}{}'.format(algorithm, reader.hexdigest, ' (verified)' if expected else ''))
+
+    def _get_expected_digest(self):
+        """
+        Returns the hashlib algorithm to use and the expected hex digest, or None if the data isn't to be verified.
+        """
+
+        expected = self.expected_digest
+        if expected is None and self.checksum_url is not None:
+            self._w_print('Retrieving checksum from {}'.format(self.checksum_url))
+            response = get_session().get(self.checksum_url, timeout=get_timeout())
+            response.raise_for_status()
+            expected = _parse_checksum_file(response.text, self.url)
+        if expected is None:
+            return self.algorithm, None
+        algorithm, _, digest = expected.rpartition(':')
+        return (algorithm or self.algorithm).lower(), digest.lower()
+
+
+class _AdaptiveLimit(object):
+
+    """
+    A concurrency limit that adapts to the server's responses by additive increase, multiplicative decrease (AIMD, as TCP does for its congestion window): every response that comes back in good
+    time raises the limit by about one per limit responses, and an error, or a response much slower than usual, halves it. The limit is only halved once per limit responses, so a burst of slow
+    responses to requests that were all sent at once counts as one congestion event.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = float(max(self.minimum, maximum // 2))
+        self.baseline = None
+        self.since_decrease = 0
+
+    def __int__(self):
+        return int(self.limit)
+
+    def success(self, latency):
+        """
+        Records a response that took latency seconds to arrive. A latency more than twice the moving average of those before it is taken as a sign of congestion.
+        """
+
+        self.since_decrease += 1
+        if self.baseline is not None and latency > 2 * self.baseline:
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.baseline = latency if self.baseline is None else 0.8 * self.baseline + 0.2 * latency
+
+    def failure(self):
+        self.since_decrease += 1
+        self._decrease()
+
+    def _decrease(self):
+        if self.since_decrease >= self.limit:
+            self.limit = max(self.minimum, self.limit / 2)
+            self.since_decrease = 0
+
+
+class BulkHttpDataRetrieval(DevOpsTask):
+
+    """
+    The BulkHttpDataRetrieval class retrieves a manifest of urls, each to its own destination, concurrently on a thread pool.
+
+    At most max_concurrency requests run at once, and at most max_per_host to any one host. Within those caps, the number of requests in flight adapts to the server: it starts at half of
+    max_concurrency, grows while responses come back in good time, and is halved when a request fails or a response is much slower than usual. A request that fails is retried, up to retries times,
+    after the others that are waiting.
+
+    The data is hashed while it is retrieved. A summary is published in the exhaust under summary_name: a list of files (each with its url, destination, bytes, seconds, bytes_per_second and digest, or
+    error) and the aggregate bytes, seconds, bytes_per_second and failed count. If any url couldn't be retrieved, the task fails once all of the others are done.
+    """
+
+    def __init__(self, manifest, max_concurrency=None, max_per_host=None, retries=2, algorithm='sha256', summary_name='downloads'):
+
+        """
+        self.manifest => A mapping of url => destination, or a list of (url, destination) pairs. A destination is a file path, a (buffered) Stream or an Artifact, as for HttpDataRetrieval.
+        self.max_concurrency => The maximum number of requests in flight. Default is None, which uses maxConcurrency in the [Web] section of appsettings.cfg.
+        self.max_per_host => The maximum number of requests in flight to one host. Default is None, which uses maxConnectionsPerHost in the [Web] section of appsettings.cfg.
+        self.retries => The number of times a failed request is retried.
+        self.algorithm => The hashlib algorithm to hash the data with.
+        self.summary_name => The exhaust variable the summary is published under.
+        """
+
+        super().__init__()
+        self.manifest = manifest
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.algorithm = algorithm
+        self.summary_name = summary_name
+
+    def execute(self, step_name=''):
+
+        """
+        Retrieves every url in self.manifest, and publishes the summary.
+        """
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from urllib.parse import urlsplit
+        super().execute(step_name)
+        entries = list(self.manifest.items() if isinstance(self.manifest, collections.abc.Mapping) else self.manifest)
+        max_concurrency = self.max_concurrency or int(get_system_config_value('Web', 'maxConcurrency', fallback='16'))
+        max_per_host = self.max_per_host or int(get_system_config_value('Web', 'maxConnectionsPerHost', fallback='4'))
+        self._w_print('Retrieving {} url(s), at most {} at once and {} per host'.format(len(entries), max_concurrency, max_per_host))
+
+        limit = _AdaptiveLimit(max_concurrency)
+        pending = collections.deque((index, 0) for index in range(len(entries)))
+        running = {}
+        per_host = collections.Counter()
+        results = {}
+        started = time.monotonic()
+        # The workers publish their destinations into the exhaust, which is otherwise created on first use: create it here, so they don't race to create it and lose each other's variables.
+        if self._exhaust is None:
+            self._exhaust = {}
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            while pending or running:
+                waiting = collections.deque()
+                while pending and len(running) < int(limit):
+                    index, attempt = entry = pending.popleft()
+                    url, destination = entries[index]
+                    host = urlsplit(url).netloc
+                    if per_host[host] >= max_per_host:
+                        waiting.append(entry)
+                        continue
+                    per_host[host] += 1
+                    running[executor.submit(self._retrieve, url, destination)] = entry, host
+                pending.extendleft(reversed(waiting))
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (index, attempt), host = running.pop(future)
+                    url, destination = entries[index]
+                    per_host[host] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        limit.failure()
+                        if attempt < self.retries:
+                            self._w_print('Retrying {} after error: {}'.format(url, e))
+                            pending.append((index, attempt + 1))
+                        else:
+                            results[index] = {'url': url, 'destination': destination, 'error': e}
+                    else:
+                        limit.success(result.pop('latency'))
+                        results[index] = dict(result, url=url, destination=destination)
+        self._publish_summary([results[index] for index in sorted(results)], time.monotonic() - started)
+
+    def _retrieve(self, url, destination):
+        """
+        Retrieves url to destination (on a worker thread) and returns its statistics: the latency until the response arrived, and the bytes, seconds and digest of the data.
+        """
+
+        started = time.monotonic()
+        _, _, raw, latency = _request(url)
+        _record_first_byte_time(url, latency)
+        reader = _VerifyingReader(raw, self.algorithm)
+        _save(self, destination, reader)
+        seconds = time.monotonic() - started
+        return {'latency': latency, 'bytes': reader.bytes_read, 'seconds': seconds, 'bytes_per_second': reader.bytes_read / seconds if seconds else 0.0, 'digest': reader.hexdigest}
+
+    def _publish_summary(self, files, seconds):
+        """
+        Prints and publishes the per file and aggregate throughput, and raises the error of the first url that couldn't be retrieved.
+        """
+
+        errors = [file['error'] for file in files if 'error' in file]
+        total = sum(file.get('bytes', 0) for file in files)
+        for file in files:
+            if 'error' in file:
+                self._w_print('{} failed: {}'.format(file['url'], file['error']))
+            else:
+                self._w_print('{} => {}: {} bytes in {:.3f}s ({:.0f} bytes/s)'.format(file['url'], file['destination'], file['bytes'], file['seconds'], file['bytes_per_second']))
+        self._w_print('Retrieved {} bytes from {} url(s) in {:.3f}s ({:.0f} bytes/s); {} failed'.format(total, len(files) - len(errors), seconds, total / seconds if seconds else 0.0, len(errors)))
+        self.exhaust[self.summary_name] = {'files': [dict(file, error=str(file['error'])) if 'error' in file else file for file in files], 'bytes': total, 'seconds': seconds,
+                                           'bytes_per_second': total / seconds if seconds else 0.0, 'failed': len(errors)}
+        if errors:
+            raise errors[0]
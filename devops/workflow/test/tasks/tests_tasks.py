@@ -1,4 +1,86 @@
 import unittest
+import collections
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import mock
+
+from ...workflow import MainSequence
+from ...workflow import WorkflowTask
+from ...streams import Stream
+from ...streams import StreamBuffer
+from ...streams import StreamReader
+from ...tasks import web
+from ...tasks.web import DigestMismatchError
+from ...tasks import system
+from ...tasks.system import Copy
+from ...tasks.system import ExecuteCommand
+from ...tasks.system import combine_rusage
+from ...tasks.system import Fingerprint
+from ...tasks.datatransformation import XlsToCsv
+from ... import compression
+from ...core import OutputMode
+from ...core import set_output_mode
+
+
+class FakeSession(object):
+
+    def __init__(self, content, checksums=''):
+        self.content = content
+        self.checksums = checksums
+
+    def get(self, url, stream=False, timeout=None):
+        response = mock.Mock()
+        response.raw = io.BytesIO(self.content)
+        response.text = self.checksums
+        return response
+
+
+class BulkSession(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.most_in_flight = {}
+        self.attempts = {}
+
+    def get(self, url, stream=False, timeout=None):
+        host = url.split('/')[2]
+        with self.lock:
+            self.attempts[url] = self.attempts.get(url, 0) + 1
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            self.most_in_flight[host] = max(self.most_in_flight.get(host, 0), self.in_flight[host])
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight[host] -= 1
+        if url.endswith('flaky') and self.attempts[url] == 1:
+            raise ConnectionError('reset')
+        response = mock.Mock()
+        response.raw = io.BytesIO(url.encode())
+        return response
+
+
+class MirroredSession(object):
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.responses = {}
+
+    def get(self, url, stream=False, timeout=None):
+        delay = self.delays[url]
+        if delay is None:
+            raise ConnectionError('refused')
+        time.sleep(delay)
+        response = self.responses[url] = mock.Mock()
+        response.raw = io.BytesIO(b'payload')
+        return response
 
 
 class TasksTests(unittest.TestCase):
@@ -8,15 +90,275 @@ class TasksTests(unittest.TestCase):
 
     def setUp(self):
         "Hook method for setting up the test fixture before exercising it."
-        pass
+        set_output_mode(OutputMode.Batch)
+        self.directory = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
 
     def tearDown(self):
         "Hook method for deconstructing the test fixture after testing it."
-        pass
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+        set_output_mode(None)
+
+    def test_http_data_retrieval_to_stream(self):
+        destination = os.path.join(self.directory, 'saved.bin')
+        workflow = MainSequence()
+        workflow.addstep('retrieve', web.HttpDataRetrieval('http://example.com/data', Stream('data')))
+        workflow.addstep('save', Copy(Stream('data'), destination))
+        workflow.addstep('save again', Copy(Stream('data'), destination + '2'))
+        with mock.patch.object(web, 'get_session', return_value=FakeSession(b'payload')):
+            workflow.execute()
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertIsInstance(workflow.get('retrieve').exhaust['data'], StreamBuffer)
+        for path in (destination, destination + '2'):
+            with open(path, 'rb') as saved:
+                self.assertEqual(saved.read(), b'payload')
+
+    def test_unbuffered_stream_is_read_once(self):
+        retrieve = web.HttpDataRetrieval('http://example.com/data', Stream('data', buffered=False))
+        with mock.patch.object(web, 'get_session', return_value=FakeSession(b'payload')):
+            retrieve.execute()
+        reader = retrieve.exhaust['data']
+        self.assertIsInstance(reader, StreamReader)
+        self.assertEqual(reader.open().read(), b'payload')
+        self.assertRaises(ValueError, reader.open)
+
+    def test_requests_have_timeouts(self):
+        session = mock.Mock()
+        session.get.return_value.raw = io.BytesIO(b'payload')
+        with mock.patch.object(web, 'get_session', return_value=session):
+            web.HttpDataRetrieval('http://example.com/data', Stream('data')).execute()
+        self.assertEqual(session.get.call_args[1]['timeout'], web.get_timeout())
+        self.assertTrue(all(seconds > 0 for seconds in web.get_timeout()))
+
+    def test_xls_to_csv_streams(self):
+        book = mock.Mock()
+        sheet = mock.Mock(nrows=2)
+        sheet.row_values.side_effect = lambda row: ['a', row]
+        book.sheets.return_value = [sheet]
+        task = XlsToCsv(Stream('xls'), Stream('csv'))
+        task.input = {'xls': StreamBuffer(b'xls data')}
+        with mock.patch('xlrd.open_workbook', return_value=book) as open_workbook:
+            task.execute()
+        open_workbook.assert_called_once_with(file_contents=b'xls data')
+        self.assertEqual(task.exhaust['csv'].data, b'a|0\r\na|1\r\n')
+
+    def test_http_data_retrieval_verifies_digest(self):
+        destination = os.path.join(self.directory, 'saved.bin')
+        digest = hashlib.sha256(b'payload').hexdigest()
+        session = FakeSession(b'payload', '{}  other.bin\n{}  data.bin\n'.format('0' * 64, digest))
+        with mock.patch.object(web, 'get_session', return_value=session):
+            retrieve = web.HttpDataRetrieval('http://example.com/data.bin', destination, checksum_url='http://example.com/SHA256SUMS')
+            retrieve.execute()
+            self.assertEqual(retrieve.exhaust['digest'], digest)
+            os.remove(destination)
+            retrieve = web.HttpDataRetrieval('http://example.com/data.bin', destination, expected_digest='sha256:' + '0' * 64)
+            self.assertRaises(DigestMismatchError, retrieve.execute)
+            self.assertEqual(os.listdir(self.directory), [])
+            retrieve = web.HttpDataRetrieval('http://example.com/data.bin', Stream('data'), expected_digest='0' * 64)
+            self.assertRaises(DigestMismatchError, retrieve.execute)
+            self.assertNotIn('data', retrieve.exhaust)
+            blake2b = hashlib.blake2b(b'payload').hexdigest()
+            retrieve = web.HttpDataRetrieval('http://example.com/data.bin', Stream('data', buffered=False), expected_digest='blake2b:' + blake2b)
+            retrieve.execute()
+            with retrieve.exhaust['data'].open() as reader:
+                self.assertEqual(reader.read(), b'payload')
+
+    def test_http_data_retrieval_decompresses(self):
+        destination = os.path.join(self.directory, 'saved.csv.gz')
+        compressed = gzip.compress(b'a|b\r\n' * 1000)
+        with mock.patch.object(web, 'get_session', return_value=FakeSession(compressed)):
+            retrieve = web.HttpDataRetrieval('http://example.com/data.gz', Stream('data'), expected_digest=hashlib.sha256(compressed).hexdigest(), decompress='auto')
+            retrieve.execute()
+            self.assertEqual(retrieve.exhaust['data'].data, b'a|b\r\n' * 1000)
+            retrieve = web.HttpDataRetrieval('http://example.com/data.gz', destination, expected_digest='0' * 64, decompress='gzip', compress='gzip')
+            self.assertRaises(DigestMismatchError, retrieve.execute)
+            self.assertEqual(os.listdir(self.directory), [])
+        with mock.patch.object(web, 'get_session', return_value=FakeSession(b'plain')):
+            retrieve = web.HttpDataRetrieval('http://example.com/data', Stream('data'), decompress='auto')
+            retrieve.execute()
+            self.assertEqual(retrieve.exhaust['data'].data, b'plain')
+        task = Copy(Stream('data'), destination, decompress='gzip', compress='gzip')
+        task.input = {'data': StreamBuffer(compressed)}
+        task.execute()
+        with gzip.open(destination, 'rb') as saved:
+            self.assertEqual(saved.read(), b'a|b\r\n' * 1000)
+
+    def test_xls_to_csv_compresses(self):
+        book = mock.Mock()
+        sheet = mock.Mock(nrows=2)
+        sheet.row_values.side_effect = lambda row: ['a', row]
+        book.sheets.return_value = [sheet]
+        destination = os.path.join(self.directory, 'data.csv.zip')
+        task = XlsToCsv(Stream('xls'), destination, decompress='auto', compress='zip')
+        task.input = {'xls': StreamBuffer(gzip.compress(b'xls data'))}
+        with mock.patch('xlrd.open_workbook', return_value=book) as open_workbook:
+            task.execute()
+        open_workbook.assert_called_once_with(file_contents=b'xls data')
+        with zipfile.ZipFile(destination) as archive:
+            self.assertEqual(archive.read('data.csv'), b'a|0\r\na|1\r\n')
+
+    def test_zstd_requires_zstandard(self):
+        with mock.patch.object(compression, '_zstandard', return_value=None):
+            self.assertEqual(compression.resolve_method('zstd'), 'gzip')
+            with self.assertRaises(ImportError):
+                compression.compressing_reader(io.BytesIO(b'data'), 'zstd')
+            with self.assertRaises(ImportError):
+                compression.open_compressed(io.BytesIO(), 'zstd')
+
+    def test_bulk_http_data_retrieval(self):
+        manifest = [('http://{}.example.com/{}'.format(host, n), Stream('{}{}'.format(host, n))) for host in ('a', 'b') for n in range(6)]
+        manifest.append(('http://a.example.com/flaky', os.path.join(self.directory, 'flaky')))
+        session = BulkSession()
+        retrieve = web.BulkHttpDataRetrieval(manifest, max_concurrency=8, max_per_host=2)
+        with mock.patch.object(web, 'get_session', return_value=session):
+            retrieve.execute()
+        self.assertEqual(retrieve.exhaust['b5'].data, b'http://b.example.com/5')
+        with open(os.path.join(self.directory, 'flaky'), 'rb') as flaky:
+            self.assertEqual(flaky.read(), b'http://a.example.com/flaky')
+        self.assertLessEqual(max(session.most_in_flight.values()), 2)
+        summary = retrieve.exhaust['downloads']
+        self.assertEqual((len(summary['files']), summary['failed']), (13, 0))
+        self.assertEqual(summary['files'][0]['bytes'], len('http://a.example.com/0'))
+        self.assertEqual(summary['bytes'], sum(file['bytes'] for file in summary['files']))
+
+    def test_adaptive_limit(self):
+        limit = web._AdaptiveLimit(16)
+        self.assertEqual(int(limit), 8)
+        for _ in range(40):
+            limit.success(0.1)
+        self.assertGreater(int(limit), 10)
+        before = int(limit)
+        limit.failure()
+        limit.failure()
+        self.assertEqual(int(limit), before // 2)
+        for _ in range(100):
+            limit.failure()
+        self.assertEqual(int(limit), 1)
+
+    def test_hedged_requests_to_mirrors(self):
+        session = MirroredSession({'http://slow/data': 0.5, 'http://fast/data': 0.0, 'http://down/data': None})
+        first_byte_times = collections.defaultdict(lambda: collections.deque(maxlen=200))
+        with mock.patch.object(web, 'get_session', return_value=session), mock.patch.object(web, 'hedge_delay', return_value=0.05), \
+                mock.patch.object(web, '_first_byte_times', first_byte_times):
+            retrieve = web.HttpDataRetrieval('http://slow/data', Stream('data'), mirrors=['http://fast/data'])
+            retrieve.execute()
+            self.assertEqual(sorted(first_byte_times), ['fast', 'slow'])
+            self.assertGreaterEqual(first_byte_times['slow'][0], 0.05)
+            self.assertEqual(retrieve.exhaust['data'].data, b'payload')
+            self.assertEqual(retrieve.exhaust['source']['url'], 'http://fast/data')
+            self.assertEqual(retrieve.exhaust['source']['requests'], 2)
+            self.assertLess(retrieve.exhaust['source']['first_byte_seconds'], 0.5)
+            retrieve = web.HttpDataRetrieval('http://down/data', Stream('data'), mirrors=['http://slow/data'])
+            retrieve.execute()
+            self.assertEqual(retrieve.exhaust['source']['url'], 'http://slow/data')
+            retrieve = web.HttpDataRetrieval('http://down/data', Stream('data'), mirrors=['http://down/data'])
+            self.assertRaises(ConnectionError, retrieve.execute)
+
+    def test_hedge_delay_percentile(self):
+        with mock.patch.object(web, '_first_byte_times', collections.defaultdict(lambda: collections.deque(maxlen=200))):
+            self.assertEqual(web.hedge_delay('http://host/data'), 2.0)
+            for n in range(1, 101):
+                web._record_first_byte_time('http://host/{}'.format(n), n / 100)
+            self.assertEqual(web.hedge_delay('http://host/data'), 0.95)
+            self.assertEqual(web.hedge_delay('http://other/data'), 2.0)
+
+    @unittest.skipIf(os.name == 'nt', 'Shell sessions need a POSIX shell')
+    def test_execute_command_in_shell_session(self):
+        results = []
+        for command in (['sh', '-c', 'printf "%s" "$0"; exit 3', 'a b'], 'echo $$; pwd; cd /', 'if then', 'echo $$; pwd'):
+            task = ExecuteCommand(command, working_directory=self.directory, use_session=True)
+            task.execute()
+            results.append((task.exhaust['return_code'], task.exhaust['output']))
+        self.assertEqual(results[0], (3, 'a b'))
+        self.assertEqual(results[1][1].split('\n')[1], os.path.realpath(self.directory))
+        self.assertNotEqual(results[2][0], 0)
+        self.assertEqual(results[3], (0, results[1][1]))
+        system.close_shell_sessions()
+        task = ExecuteCommand(['sh', '-c', 'printf "%s" "$0"; exit 3', 'a b'])
+        task.execute()
+        self.assertEqual((task.exhaust['return_code'], task.exhaust['output']), (3, 'a b'))
+
+    @unittest.skipIf(os.name == 'nt', 'Shell sessions need a POSIX shell')
+    def test_shell_session_close_kills_hung_shell(self):
+        session = system.ShellSession(self.directory)
+        session.process.stdin.write(b'sleep 5\n')
+        session.process.stdin.flush()
+        started = time.monotonic()
+        session.close(timeout=0.2)
+        self.assertLess(time.monotonic() - started, 4)
+        self.assertFalse(session.alive)
+
+    def test_execute_command_rusage(self):
+        task = ExecuteCommand([sys.executable, '-c', 'data = bytearray(32 * 1024 * 1024); print(len(data))'])
+        task.execute()
+        rusage = task.exhaust['rusage']
+        self.assertEqual((task.exhaust['return_code'], rusage['output_bytes']), (0, len(task.exhaust['output'])))
+        if hasattr(os, 'wait4'):
+            self.assertGreater(rusage['max_rss_bytes'], 32 * 1024 * 1024)
+            self.assertGreater(rusage['user_seconds'] + rusage['system_seconds'], 0)
+        combined = combine_rusage(combine_rusage(None, rusage), {'wall_seconds': 1.0, 'output_bytes': 1, 'max_rss_bytes': 1})
+        self.assertEqual(combined['output_bytes'], rusage['output_bytes'] + 1)
+        self.assertEqual(combined['max_rss_bytes'], rusage.get('max_rss_bytes', 1))
+
+    def make_tree(self, name):
+        root = os.path.join(self.directory, name)
+        os.makedirs(os.path.join(root, 'sub', 'empty'))
+        for relative, data in (('a.txt', b'a'), ('sub/b.txt', b'b' * 100000), ('sub/c.txt', b'')):
+            path = os.path.join(root, *relative.split('/'))
+            with open(path, 'wb') as output:
+                output.write(data)
+            os.utime(path, (time.time() - 60, time.time() - 60))
+        return root
+
+    def fingerprint(self, path, cache_file='cache.json'):
+        task = Fingerprint(path, cache_file=os.path.join(self.directory, cache_file))
+        task.execute()
+        return task.exhaust
+
+    def test_fingerprint(self):
+        first = self.fingerprint(self.make_tree('first'))
+        second = self.fingerprint(self.make_tree('second'), 'other.json')
+        self.assertEqual(first['fingerprint'], second['fingerprint'])
+        self.assertEqual(sorted(first['fingerprint_manifest']), ['a.txt', 'sub/b.txt', 'sub/c.txt'])
+        os.rmdir(os.path.join(self.directory, 'second', 'sub', 'empty'))
+        self.assertNotEqual(self.fingerprint(os.path.join(self.directory, 'second'), 'other.json')['fingerprint'], first['fingerprint'])
+        single = self.fingerprint(os.path.join(self.directory, 'first', 'a.txt'), 'single.json')
+        self.assertEqual(single['fingerprint'], first['fingerprint_manifest']['a.txt'])
+
+    def test_fingerprint_stat_cache(self):
+        root = self.make_tree('tree')
+        digest = self.fingerprint(root)['fingerprint']
+        with mock.patch.object(system, '_hash_file', side_effect=system._hash_file) as hash_file:
+            self.assertEqual(self.fingerprint(root)['fingerprint'], digest)
+            self.assertEqual(hash_file.call_count, 0)
+            with open(os.path.join(root, 'a.txt'), 'wb') as changed:
+                changed.write(b'changed')
+            self.assertNotEqual(self.fingerprint(root)['fingerprint'], digest)
+            self.assertEqual(hash_file.call_count, 1)
+
+    def test_fingerprint_same_size_and_mtime(self):
+        root = self.make_tree('tree')
+        path = os.path.join(root, 'sub', 'b.txt')
+        digest = self.fingerprint(root)['fingerprint']
+        st = os.stat(path)
+        time.sleep(0.01)
+        with open(path, 'r+b') as changed:
+            changed.write(b'B')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertNotEqual(self.fingerprint(root)['fingerprint'], digest)
 
-    #def test_one(self):
-    #    raise NotImplementedError()
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'requires FIFOs')
+    def test_fingerprint_skips_fifos(self):
+        root = self.make_tree('tree')
+        digest = self.fingerprint(root)['fingerprint']
+        os.mkfifo(os.path.join(root, 'sub', 'pipe'))
+        self.assertEqual(self.fingerprint(root)['fingerprint'], digest)
+        with self.assertRaises(ValueError):
+            self.fingerprint(os.path.join(root, 'sub', 'pipe'))
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from .. import artifacts
+from ..artifacts import Artifact
+from ..artifacts import ArtifactStore
+from ..artifacts import ArtifactMissingError
+from ..artifacts import ArtifactCorruptError
+from ..workflow import MainSequence
+from ..workflow import WorkflowTask
+from ..tasks.system import Copy
+from ..core import OutputMode
+from ..core import set_output_mode
+
+
+class ArtifactTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        self.directory = tempfile.mkdtemp()
+        self.store = ArtifactStore(os.path.join(self.directory, 'store'))
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output:
+            output.write(data)
+        return path
+
+    def test_duplicates_are_stored_once(self):
+        first = self.write('first', b'same')
+        second = self.write('second', b'same')
+        digest = self.store.put(first)
+        self.assertEqual(self.store.put(second, link_back=True), digest)
+        self.assertEqual(self.store.put_bytes(b'same'), digest)
+        self.assertTrue(os.path.samefile(second, self.store.path(digest)))
+        self.assertFalse(os.path.samefile(first, self.store.path(digest)))
+        self.assertEqual(self.store.size(), 4)
+        destination = os.path.join(self.directory, 'materialized')
+        self.store.materialize(digest, destination)
+        self.assertTrue(os.path.samefile(destination, self.store.path(digest)))
+        self.assertRaises(ArtifactMissingError, self.store.path, '0' * 64)
+
+    def test_tree_round_trip(self):
+        self.write('tree/a.txt', b'a')
+        self.write('tree/sub/b.txt', b'b')
+        os.makedirs(os.path.join(self.directory, 'tree', 'empty'))
+        os.symlink('a.txt', os.path.join(self.directory, 'tree', 'link'))
+        digest = self.store.put_tree(os.path.join(self.directory, 'tree'))
+        destination = os.path.join(self.directory, 'copy')
+        self.store.materialize_tree(digest, destination)
+        with open(os.path.join(destination, 'sub', 'b.txt'), 'rb') as b:
+            self.assertEqual(b.read(), b'b')
+        self.assertTrue(os.path.isdir(os.path.join(destination, 'empty')))
+        self.assertEqual(os.readlink(os.path.join(destination, 'link')), 'a.txt')
+
+    def test_tree_keeps_executable_mode(self):
+        script = self.write('tree/run.sh', b'#!/bin/sh\n')
+        os.chmod(script, 0o755)
+        self.write('tree/data.txt', b'data')
+        digest = self.store.put_tree(os.path.join(self.directory, 'tree'), link_back=True)
+        self.assertEqual(stat.S_IMODE(os.stat(script).st_mode), 0o755)
+        for allow_hardlink in (True, False):
+            destination = os.path.join(self.directory, 'copy {}'.format(allow_hardlink))
+            self.store.materialize_tree(digest, destination, allow_hardlink)
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(destination, 'run.sh')).st_mode), 0o755)
+
+    def test_untrusted_store_verifies_objects(self):
+        store = ArtifactStore(os.path.join(self.directory, 'store'), verify=True)
+        digest = store.put_bytes(b'payload')
+        destination = os.path.join(self.directory, 'materialized')
+        store.materialize(digest, destination)
+        self.assertFalse(os.path.samefile(destination, store.path(digest)))
+        os.chmod(store.path(digest), 0o644)
+        with open(store.path(digest), 'wb') as stored:
+            stored.write(b'tampered')
+        os.remove(destination)
+        self.assertRaises(ArtifactCorruptError, store.materialize, digest, destination)
+        self.assertRaises(ArtifactCorruptError, store.verified_path, digest)
+        self.assertFalse(os.path.exists(destination))
+        self.assertEqual(os.listdir(self.directory), ['store'])
+
+    def test_untrusted_store_does_not_link_back_to_unverified_objects(self):
+        store = ArtifactStore(os.path.join(self.directory, 'store'), verify=True)
+        digest = store.put_bytes(b'payload')
+        os.chmod(store.path(digest), 0o644)
+        with open(store.path(digest), 'wb') as stored:
+            stored.write(b'EVIL')
+        path = os.path.join(self.directory, 'output')
+        with open(path, 'wb') as output:
+            output.write(b'payload')
+        self.assertRaises(ArtifactCorruptError, store.put, path, link_back=True)
+        with open(path, 'rb') as output:
+            self.assertEqual(output.read(), b'payload')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['output', 'store'])
+
+    def test_least_recently_used_are_evicted(self):
+        old = self.store.put_bytes(b'x' * 100)
+        new = self.store.put_bytes(b'y' * 100)
+        os.utime(self.store.path(old), (time.time() - 60, time.time() - 60))
+        self.store.max_bytes = 150
+        self.store.put_bytes(b'z' * 10)
+        self.assertNotIn(old, self.store)
+        self.assertIn(new, self.store)
+
+    def test_copy_publishes_and_materializes(self):
+        set_output_mode(OutputMode.Batch)
+        source = self.write('source', b'payload')
+        destination = os.path.join(self.directory, 'destination')
+        workflow = MainSequence()
+        workflow.addstep('publish', Copy(source, Artifact('payload')))
+        workflow.addstep('materialize', Copy(Artifact('payload'), destination))
+        stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        with mock.patch.object(artifacts, 'get_artifact_store', return_value=self.store):
+            workflow.execute()
+        sys.stdout.close()
+        sys.stdout = stdout
+        set_output_mode(None)
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertTrue(os.path.samefile(destination, self.store.path(workflow.exhaust['payload'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
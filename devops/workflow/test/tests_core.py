@@ -1,8 +1,20 @@
 import unittest
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 from unittest.mock import Mock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+from .. import core
+from .. import logrotation
+from ..logrotation import RotatingLogFileHandler
+from ..logrotation import maintain_log_directory
+
 class CoreTests(unittest.TestCase):
     """
     Run recursive from top tests package: C:\development\DevOps\devops>c:\python33\python.exe -m unittest discover -v
@@ -10,14 +22,79 @@ class CoreTests(unittest.TestCase):
 
     def setUp(self):
         "Hook method for setting up the test fixture before exercising it."
-        pass
+        self.logdir = tempfile.mkdtemp()
 
     def tearDown(self):
         "Hook method for deconstructing the test fixture after testing it."
-        pass
+        shutil.rmtree(self.logdir)
+
+    def test_rotating_log_file_handler_rolls_over_by_size(self):
+        logpath = os.path.join(self.logdir, 'Test.20140101.000001.log')
+        handler = RotatingLogFileHandler(logpath, max_bytes=100, compression_method='gzip')
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'x' * 80, None, None)
+        handler.emit(record)
+        handler.emit(record)
+        handler.close()
+        logrotation._submit_log_maintenance(lambda: None).result()
+        self.assertTrue(os.path.exists(logpath))
+        self.assertTrue(os.path.exists(logpath + '.1.gz'))
+        self.assertFalse(os.path.exists(logpath + '.1'))
+
+    def test_rotating_log_file_handler_rolls_over_by_age(self):
+        logpath = os.path.join(self.logdir, 'Test.20140101.000002.log')
+        handler = RotatingLogFileHandler(logpath, rotate_interval=60)
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'message', None, None)
+        handler.emit(record)
+        handler._rollover_at = time.time() - 1
+        handler.emit(record)
+        handler.close()
+        self.assertTrue(os.path.exists(logpath + '.1'))
+
+    def test_maintain_log_directory_retention_and_compression(self):
+        now = time.time()
+        for i in range(5):
+            path = os.path.join(self.logdir, 'Test.2014010{}.log'.format(i))
+            with open(path, 'w') as f:
+                f.write('log {}'.format(i))
+            os.utime(path, (now - (i + 1) * 3600, now - (i + 1) * 3600))
+        other = os.path.join(self.logdir, 'Other.20140101.log')
+        open(other, 'w').close()
+        os.utime(other, (0, 0))
+        current = os.path.join(self.logdir, 'Test.20140109.log')
+        open(current, 'w').close()
+
+        maintain_log_directory(self.logdir, 'Test.', current, compression_method='gzip', compress_idle_seconds=60, retention_max_files=3)
+
+        self.assertEqual(sorted(os.listdir(self.logdir)), ['Other.20140101.log', 'Test.20140100.log.gz', 'Test.20140101.log.gz', 'Test.20140102.log.gz', 'Test.20140109.log'])
+
+    def test_entry_point_runs_only_from_main(self):
+        calls = []
+        exec('entry_point(lambda: calls.append(1))', {'__name__': '__main__', 'entry_point': core.entry_point, 'calls': calls})
+        exec('entry_point(lambda: calls.append(2))', {'__name__': 'some.module', 'entry_point': core.entry_point, 'calls': calls})
+        self.assertEqual(calls, [1])
+
+    def test_heavy_modules_are_imported_lazily(self):
+        code = ('import sys\n'
+                'from devops.workflow import workflow, core\n'
+                'from devops.workflow.tasks import datatransformation, git, system, web\n'
+                'print(sorted(name for name in ("colorama", "requests", "xlrd", "multiprocessing", "logging.handlers") if name in sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(output.decode().strip(), '[]')
+
+    def test_batch_output_does_not_import_colorama(self):
+        code = ('import sys\n'
+                'from devops.workflow import workflow, core\n'
+                'core.set_output_mode(core.OutputMode.Batch)\n'
+                'workflow.Sequence()._prehook()\n'
+                'print("colorama" in sys.modules)')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(output.decode().strip().splitlines()[-1], 'False')
 
-    #def test_one(self):
-    #    raise NotImplementedError()
+    def test_get_system_config_value_fallback(self):
+        self.assertEqual(core.get_system_config_value('Logging', 'doesNotExist', fallback='42'), '42')
+        self.assertRaises(KeyError, core.get_system_config_value, 'Logging', 'doesNotExist')
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
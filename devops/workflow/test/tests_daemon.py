@@ -0,0 +1,130 @@
+import unittest
+import http.client
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from ..workflow import MainSequence
+from ..daemon import WorkflowDaemon
+from ..daemon import Run
+from ..daemon import read_token
+from ..core import OutputMode
+from ..core import set_output_mode
+from .tests_workflow import ProcessId
+
+
+def build_workflow():
+    workflow = MainSequence()
+    workflow.addstep('process id', ProcessId())
+    return workflow
+
+
+class DaemonTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        set_output_mode(OutputMode.Batch)
+        self.stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        self.daemon = WorkflowDaemon(max_concurrent_runs=2, max_retained_runs=10)
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        self.daemon.shutdown()
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        set_output_mode(None)
+
+    def test_submit_records_events(self):
+        run = self.daemon.get_run(self.daemon.submit(build_workflow))
+        self.assertTrue(run.wait(10))
+        self.assertEqual(run.status, Run.Status.Succeeded)
+        events = [event['event'] for event in run.events]
+        self.assertEqual(events, ['run_started', 'step_started', 'step_finished', 'run_finished'])
+        self.assertEqual(run.events[2]['status'], 'completed_ok')
+
+    def test_events_and_runs_are_bounded(self):
+        run = Run('run', 'name', max_events=3)
+        for index in range(5):
+            run.add_event('event', index=index)
+        self.assertEqual(([event['seq'] for event in run.events], run.event_count), ([2, 3, 4], 5))
+        self.assertEqual([event['index'] for event in run.wait_for_events(0, timeout=0)], [2, 3, 4])
+        self.assertEqual([event['index'] for event in run.wait_for_events(4, timeout=0)], [4])
+        finished = self.daemon.get_run(self.daemon.submit(build_workflow))
+        self.assertTrue(finished.wait(10))
+        self.assertEqual(self.daemon.runs(), [finished])
+        self.daemon.run_retention_seconds = 0.001
+        time.sleep(0.01)
+        self.assertEqual(self.daemon.runs(), [])
+
+    def test_failed_run(self):
+        run = self.daemon.get_run(self.daemon.submit(build_workflow, variables={'fail': True}))
+        self.assertTrue(run.wait(10))
+        self.assertEqual(run.status, Run.Status.Failed)
+
+    def test_http_round_trip(self):
+        self.daemon.token = 'secret'
+        self.daemon.allowed_workflows = {__name__ + ':build_workflow', 'no_such_module:build'}
+        host, port = self.daemon.serve(('127.0.0.1', 0))
+        connection = http.client.HTTPConnection(host, port, timeout=10)
+        headers = {'Authorization': 'Bearer secret'}
+        connection.request('POST', '/runs', json.dumps({'workflow': __name__ + ':build_workflow'}), headers)
+        response = connection.getresponse()
+        self.assertEqual(response.status, 202)
+        run_id = json.loads(response.read())['run_id']
+        connection.request('GET', '/runs/{}/events'.format(run_id), headers=headers)
+        events = [json.loads(line) for line in connection.getresponse().read().splitlines()]
+        self.assertEqual(events[-1]['event'], 'run_finished')
+        connection.request('GET', '/runs/' + run_id, headers=headers)
+        self.assertEqual(json.loads(connection.getresponse().read())['status'], Run.Status.Succeeded)
+        connection.request('POST', '/runs', json.dumps({'workflow': 'no_such_module:build'}), headers)
+        self.assertEqual(connection.getresponse().status, 400)
+        connection.close()
+
+    def test_http_requires_token_and_allowed_workflow(self):
+        self.daemon.allowed_workflows = {__name__ + ':build_workflow'}
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache}):
+            host, port = self.daemon.serve(('127.0.0.1', 0))
+            token = read_token()
+            token_mode = stat.S_IMODE(os.stat(os.path.join(cache, 'devops-workflow', 'daemon', 'token')).st_mode)
+        self.assertEqual(token, self.daemon.token)
+        self.assertEqual(token_mode, 0o600)
+        connection = http.client.HTTPConnection(host, port, timeout=10)
+        for headers in ({}, {'Authorization': 'Bearer wrong'}):
+            connection.request('POST', '/runs', json.dumps({'workflow': __name__ + ':build_workflow'}), headers)
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(response.status, 401)
+            connection.request('GET', '/runs', headers=headers)
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(response.status, 401)
+        connection.request('POST', '/runs', json.dumps({'workflow': 'os:abort'}), {'Authorization': 'Bearer ' + token})
+        response = connection.getresponse()
+        response.read()
+        self.assertEqual(response.status, 403)
+        connection.close()
+        self.assertEqual(self.daemon.runs(), [])
+        self.assertRaises(PermissionError, self.daemon.submit, 'os:abort')
+
+    def test_schedule(self):
+        self.daemon.schedule(build_workflow, 0.05, name='scheduled')
+        deadline = time.monotonic() + 10
+        while len([run for run in self.daemon.runs() if run.done()]) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(self.daemon.runs()), 2)
+        self.assertTrue(all(run.name == 'scheduled' for run in self.daemon.runs()))
+
+
+if __name__ == '__main__':
+    unittest.main()
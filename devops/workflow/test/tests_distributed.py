@@ -0,0 +1,139 @@
+import unittest
+import os
+import sys
+import tempfile
+import multiprocessing
+from multiprocessing.connection import Client
+
+from ..workflow import MainSequence
+from ..workflow import WorkflowTask
+from ..workflow import ForEach
+from ..workflow import IsolatedTaskError
+from ..distributed import Coordinator
+from ..distributed import NoWorkersError
+from ..distributed import WorkerLostError
+from ..distributed import start_local_workers
+from ..core import OutputMode
+from ..core import set_output_mode
+from .tests_workflow import ProcessId
+
+
+class DistributedTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        set_output_mode(OutputMode.Batch)
+        self.coordinator = Coordinator()
+        self.workers = start_local_workers(self.coordinator, 2)
+        self.assertTrue(self.coordinator.wait_for_workers(2, timeout=10))
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        self.coordinator.close()
+        for worker in self.workers:
+            worker.join(10)
+        set_output_mode(None)
+
+    def test_steps_run_on_workers(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        workflow.step_executor = self.coordinator
+        workflow.addstep('for each', ForEach(range(6), lambda item: ProcessId(), max_workers=2))
+        workflow.execute()
+        sys.stdout.close()
+        pids = set(result['pid'] for result in workflow.get('for each').exhaust['results'])
+        self.assertTrue(pids)
+        self.assertTrue(pids.issubset(set(worker.pid for worker in self.workers)))
+        with open("unit_test.txt", 'r') as test_print:
+            self.assertEqual(test_print.read().count('Running in a worker process'), 6)
+
+    def test_step_error_is_reported_by_worker(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        workflow.step_executor = self.coordinator
+        task = ProcessId()
+        task.continue_on_error = True
+        workflow.addstep('fails', task)
+        workflow.execute(existing_variables={'fail': True})
+        sys.stdout.close()
+        self.assertEqual(task.status, WorkflowTask.Status.CompletedError)
+        with open("unit_test.txt", 'r') as test_print:
+            output = test_print.read()
+        self.assertIn(IsolatedTaskError.__name__, output)
+        self.assertIn('ValueError: asked to fail', output)
+
+
+class UnixSocketDistributedTests(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Unix sockets are only available on Unix')
+    def test_unix_socket_worker(self):
+        set_output_mode(OutputMode.Batch)
+        directory = tempfile.mkdtemp()
+        coordinator = Coordinator(os.path.join(directory, 'coordinator.sock'))
+        workers = start_local_workers(coordinator, 1)
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        workflow.step_executor = coordinator
+        task = ProcessId()
+        workflow.addstep('remote', task)
+        workflow.execute()
+        sys.stdout.close()
+        coordinator.close()
+        workers[0].join(10)
+        set_output_mode(None)
+        self.assertEqual(task.exhaust['pid'], workers[0].pid)
+
+
+def die_after_one_step(address, authkey):
+    # A worker that takes one step and then goes away without answering.
+    connection = Client(address, authkey=authkey)
+    connection.recv()
+    connection.close()
+
+
+class LostWorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        set_output_mode(OutputMode.Batch)
+        self.coordinator = Coordinator(worker_timeout=0.2)
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        self.coordinator.close()
+        set_output_mode(None)
+
+    def connect_dying_worker(self):
+        # A process of its own, so that a worker process forked later doesn't keep its end of the connection open.
+        process = multiprocessing.Process(target=die_after_one_step, args=(self.coordinator.address, self.coordinator.authkey), daemon=True)
+        process.start()
+        self.assertTrue(self.coordinator.wait_for_workers(self.coordinator.worker_count() + 1, timeout=10))
+
+    def test_no_workers(self):
+        self.assertRaises(NoWorkersError, self.coordinator.run, b'step')
+        self.connect_dying_worker()
+        self.assertRaises(WorkerLostError, self.coordinator.run, b'step')
+        self.assertEqual(self.coordinator.worker_count(), 0)
+
+    def test_step_moves_to_another_worker(self):
+        self.connect_dying_worker()
+        workers = start_local_workers(self.coordinator, 1)
+        self.assertTrue(self.coordinator.wait_for_workers(2, timeout=10))
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        workflow.step_executor = self.coordinator
+        task = ProcessId()
+        workflow.addstep('remote', task)
+        workflow.execute()
+        sys.stdout.close()
+        self.coordinator.close()
+        workers[0].join(10)
+        self.assertEqual(task.exhaust['pid'], workers[0].pid)
+        self.assertEqual(self.coordinator.worker_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
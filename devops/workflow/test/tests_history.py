@@ -0,0 +1,132 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+from unittest import mock
+
+from .. import history as history_module
+from .. import workflow as workflow_module
+from ..history import RunHistory
+from ..streams import Stream
+from ..workflow import MainSequence
+from ..workflow import Sequence
+from ..workflow import IfElse
+from ..workflow import ForEach
+from ..workflow import DevOpsTask
+from ..workflow import WorkflowTask
+from ..tasks.system import Copy
+from ..core import OutputMode
+from ..core import set_output_mode
+
+
+class Nothing(DevOpsTask):
+
+    def execute(self, step_name=''):
+        pass
+
+
+class HistoryTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        self.directory = tempfile.mkdtemp()
+        self.history = RunHistory(os.path.join(self.directory, 'history.sqlite'))
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        shutil.rmtree(self.directory)
+
+    def test_records_run_structure(self):
+        set_output_mode(OutputMode.Batch)
+        stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        source = os.path.join(self.directory, 'source')
+        with open(source, 'wb') as output:
+            output.write(b'12345')
+        workflow = MainSequence()
+        workflow.add_listener(self.history)
+        workflow.addstep('copy', Copy(source, Stream('data')))
+        branch = IfElse(True)
+        branch.add_true_handler('inner', Nothing())
+        workflow.addstep('branch', branch)
+        workflow.addstep('loop', ForEach(range(2), lambda item: Nothing()))
+        workflow.execute(step_name='nightly')
+        sys.stdout.close()
+        sys.stdout = stdout
+        set_output_mode(None)
+        runs = self.history.runs('nightly')
+        self.assertEqual([run['status'] for run in runs], ['ok'])
+        steps = {step['path']: step for step in self.history.steps(runs[0]['run_id'])}
+        self.assertEqual(sorted(steps), ['branch', 'branch/inner', 'copy', 'loop', 'loop/loop [0]', 'loop/loop [1]'])
+        self.assertEqual(steps['copy']['bytes'], 5)
+        self.assertEqual((steps['branch/inner']['parent'], steps['branch/inner']['task']), ('branch', 'Nothing'))
+
+    def test_regressions_and_estimates(self):
+        for n, (build, test) in enumerate([(10, 60), (12, 58), (11, 62), (10, 61)]):
+            self.history.record('nightly', 1000 + n, build + test, 'ok', [('build', None, 'ExecuteCommand', 1000 + n, build, 'ok', 0), ('test', None, 'ExecuteCommand', 1000 + n, test, 'ok', 0)])
+        self.assertEqual(self.history.estimate_duration('nightly'), 70.5)
+        self.assertEqual(self.history.step_durations('nightly'), {'build': 10.5, 'test': 60.5})
+        self.assertEqual(self.history.regressions('nightly'), [])
+        run_id = self.history.record('nightly', 2000, 90, 'ok', [('build', None, 'ExecuteCommand', 2000, 25, 'ok', 0), ('test', None, 'ExecuteCommand', 2000, 65, 'ok', 0)])
+        regressions = self.history.regressions('nightly')
+        self.assertEqual([(regression.path, regression.run_id, regression.baseline, regression.baseline_runs) for regression in regressions], [('build', run_id, 10.5, 4)])
+        self.assertEqual(len(self.history.report('nightly')), 2)
+        self.assertIsNone(self.history.estimate_duration('weekly'))
+        self.assertEqual(self.history.regressions('weekly'), [])
+
+    def test_main_sequence_cost_estimates(self):
+        self.history.record('nightly', 1000, 70, 'ok', [('build', None, 'Sequence', 1000, 10, 'ok', 0), ('build/compile', 'build', 'Nothing', 1000, 8, 'ok', 0),
+                                                        ('test', None, 'Nothing', 1000, 60, 'ok', 0)])
+        configured = workflow_module.get_system_config_value
+
+        def get_system_config_value(header, key, fallback=None):
+            return self.history.database if (header, key) == ('History', 'database') else configured(header, key, fallback=fallback)
+
+        set_output_mode(OutputMode.Batch)
+        stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence(max_workers=2)
+        build = Sequence()
+        build.addstep('compile', Nothing())
+        workflow.addstep('build', build)
+        workflow.addstep('test', Nothing(), depends_on=())
+        workflow.addstep('new', Nothing())
+        with mock.patch.object(workflow_module, 'get_system_config_value', get_system_config_value), \
+                mock.patch.object(history_module, 'get_system_config_value', get_system_config_value):
+            workflow.execute(step_name='nightly')
+        sys.stdout.close()
+        sys.stdout = stdout
+        set_output_mode(None)
+        self.assertEqual(workflow.cost_estimates, {'build': 10, 'test': 60})
+        self.assertEqual(build.cost_estimates, {'compile': 8})
+        self.assertEqual(len(self.history.runs('nightly')), 2)
+
+    def test_main_sequence_runs_with_corrupt_history(self):
+        with open(self.history.database, 'wb') as database:
+            database.write(b'not a database' * 100)
+        configured = workflow_module.get_system_config_value
+
+        def get_system_config_value(header, key, fallback=None):
+            return self.history.database if (header, key) == ('History', 'database') else configured(header, key, fallback=fallback)
+
+        set_output_mode(OutputMode.Batch)
+        stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        workflow.addstep('nothing', Nothing())
+        with mock.patch.object(workflow_module, 'get_system_config_value', get_system_config_value), \
+                mock.patch.object(history_module, 'get_system_config_value', get_system_config_value), self.assertLogs(level='WARNING') as logs:
+            workflow.execute(step_name='nightly')
+        sys.stdout.close()
+        sys.stdout = stdout
+        set_output_mode(None)
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertEqual(len(logs.records), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+from unittest import mock
+
+from .. import plan as plan_module
+from ..plan import load_plan
+from ..plan import PlanError
+from ..resources import Resources
+from ..workflow import IfElse
+from ..workflow import StepRecord
+from ..workflow import WorkflowTask
+from ..tasks.system import Copy
+from ..tasks.system import MakeDirectory
+from ..core import OutputMode
+from ..core import set_output_mode
+
+
+class PlanTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        set_output_mode(OutputMode.Batch)
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'cache'))
+        self.cache = mock.patch.object(plan_module, '_get_cache_directory', return_value=os.path.join(self.directory, 'cache'))
+        self.cache.start()
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        self.cache.stop()
+        shutil.rmtree(self.directory)
+        set_output_mode(None)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as workflow_file:
+            workflow_file.write(content if isinstance(content, str) else json.dumps(content))
+        return path
+
+    def test_compile_and_execute(self):
+        target = os.path.join(self.directory, 'made')
+        path = self.write('workflow.json', {
+            'variables': {'answer': 42},
+            'steps': [
+                {'name': 'second', 'task': 'system:MakeDirectory', 'args': [target], 'depends_on': ['first']},
+                {'name': 'first', 'if': {'not': {'exists': target}},
+                 'then': [{'name': 'then', 'task': MakeDirectory.__module__ + ':MakeDirectory', 'args': [target + '_then']}]}]})
+        plan = load_plan(path)
+        self.assertEqual([step.name for step in plan.steps], ['first', 'second'])
+        workflow = plan.build()
+        self.assertIsInstance(workflow.get('first'), IfElse)
+        self.assertIsInstance(workflow.get('second'), StepRecord)
+        self.assertIs(workflow.get('second').task_class, MakeDirectory)
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = plan.execute()
+        sys.stdout.close()
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertTrue(os.path.isdir(target))
+        self.assertTrue(os.path.isdir(target + '_then'))
+
+    def test_conditions_see_workflow_variables(self):
+        target = os.path.join(self.directory, 'made')
+        path = self.write('workflow.json', {
+            'steps': [{'name': 'if make', 'if': {'variable': 'make'},
+                       'then': [{'name': 'make', 'task': 'system:MakeDirectory', 'args': [target]}]}]})
+        sys.stdout = open("unit_test.txt", "w")
+        load_plan(path).execute()
+        self.assertFalse(os.path.exists(target))
+        load_plan(path).build().execute(existing_variables={'make': True})
+        sys.stdout.close()
+        self.assertTrue(os.path.isdir(target))
+
+    def test_toml(self):
+        path = self.write('workflow.toml', '[[steps]]\nname = "copy"\ntask = "system:Copy"\nargs = ["a", "b"]\n')
+        self.assertEqual(load_plan(path).steps[0].args, ('a', 'b'))
+
+    def test_max_workers_and_costs(self):
+        first, second = os.path.join(self.directory, 'first'), os.path.join(self.directory, 'second')
+        path = self.write('workflow.json', {
+            'max_workers': 2,
+            'steps': [
+                {'name': 'first', 'task': 'system:MakeDirectory', 'args': [first], 'cost': 30, 'resources': {'cpu': 0, 'disk_io': True}},
+                {'name': 'second', 'task': 'system:MakeDirectory', 'args': [second]},
+                {'name': 'both', 'if': {'all': [{'exists': first}, {'exists': second}]}, 'depends_on': ['first', 'second'],
+                 'then': [{'name': 'made', 'task': 'system:MakeDirectory', 'args': [first + '_then']}]}]})
+        plan = load_plan(path)
+        self.assertEqual(plan.max_workers, 2)
+        self.assertEqual([(step.depends_on, step.cost) for step in plan.steps], [((), 30), ((), None), (('first', 'second'), None)])
+        self.assertEqual(plan.build().get('first').resources, Resources(cpu=0, disk_io=True))
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = plan.execute()
+        sys.stdout.close()
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertTrue(os.path.isdir(first + '_then'))
+
+    def test_plan_is_cached(self):
+        path = self.write('workflow.json', {'steps': [{'name': 'copy', 'task': 'system:Copy', 'args': ['a', 'b']}]})
+        load_plan(path)
+        with mock.patch.object(plan_module, 'compile_plan') as compile_plan:
+            self.assertEqual(load_plan(path).steps[0].name, 'copy')
+            self.assertFalse(compile_plan.called)
+        self.write('workflow.json', {'steps': [{'name': 'changed', 'task': 'system:Copy', 'args': ['a', 'b']}]})
+        self.assertEqual(load_plan(path).steps[0].name, 'changed')
+
+    def test_cached_plan_round_trip(self):
+        path = self.write('workflow.json', {
+            'max_workers': 2, 'variables': {'answer': 42},
+            'steps': [{'name': 'copy', 'task': 'system:Copy', 'args': ['a', 'b'], 'kwargs': {'decompress': 'auto'}, 'cost': 5, 'resources': {'cpu': 2, 'host': 'example.com'}},
+                      {'name': 'if', 'if': {'exists': 'a'}, 'depends_on': ['copy'], 'then': [{'name': 'then', 'task': 'system:MakeDirectory', 'args': ['c']}]}]})
+        compiled = load_plan(path)
+        with mock.patch.object(plan_module, 'compile_plan') as compile_plan:
+            cached = load_plan(path)
+            self.assertFalse(compile_plan.called)
+        self.assertEqual((cached.max_workers, cached.variables, cached.digest), (compiled.max_workers, compiled.variables, compiled.digest))
+        copy, conditional = cached.steps
+        self.assertEqual((copy.args, copy.kwargs, copy.cost, copy.resources), (('a', 'b'), {'decompress': 'auto'}, 5, Resources(cpu=2, host='example.com')))
+        self.assertIs(copy.task_class, compiled.steps[0].task_class)
+        self.assertEqual((conditional.depends_on, conditional.then_steps[0].task_class), (('copy',), MakeDirectory))
+        cache_files = os.listdir(os.path.join(self.directory, 'cache'))
+        with open(os.path.join(self.directory, 'cache', cache_files[0])) as cached_file:
+            self.assertEqual(json.load(cached_file)['steps'][0]['task'], Copy.__module__ + ':Copy')
+
+    def test_cache_directory_is_private(self):
+        self.cache.stop()
+        try:
+            with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.directory}):
+                directory = plan_module._get_cache_directory()
+            self.assertEqual(directory, os.path.join(self.directory, 'devops-workflow', 'plans'))
+            if hasattr(os, 'getuid'):
+                self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+                os.chmod(directory, 0o777)
+                with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.directory}):
+                    self.assertRaises(PermissionError, plan_module._get_cache_directory)
+                    path = self.write('workflow.json', {'steps': [{'name': 'copy', 'task': 'system:Copy', 'args': ['a', 'b']}]})
+                    self.assertEqual(load_plan(path).steps[0].name, 'copy')
+                self.assertEqual(os.listdir(directory), [])
+        finally:
+            self.cache.start()
+
+    def test_invalid_workflows(self):
+        invalid = [
+            {'steps': [{'name': 'a', 'task': 'system:NoSuchTask'}]},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'args': ['x', 'y']}, {'name': 'a', 'task': 'system:Copy'}]},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'depends_on': ['b']}, {'name': 'b', 'task': 'system:Copy', 'depends_on': ['a']}]},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'depends_on': ['missing']}]},
+            {'steps': [{'name': 'a', 'if': {'maybe': True}}]},
+            {'steps': [{'name': 'a'}]},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'arguments': []}]},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'cost': 'long'}]},
+            {'steps': [], 'max_workers': 0},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'resources': {'gpu': 1}}]},
+            {'steps': [{'name': 'a', 'task': 'system:Copy', 'resources': {'memory': '2GB'}}]},
+        ]
+        for document in invalid:
+            with self.assertRaises(PlanError):
+                load_plan(self.write('invalid.json', document))
+        with self.assertRaises(PlanError):
+            load_plan(self.write('invalid.json', '{not json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import sys
+import threading
+import time
+from unittest import mock
+
+from .. import resources as resources_module
+from .. import workflow as workflow_module
+from ..resources import Resources
+from ..resources import ResourceGovernor
+from ..workflow import DevOpsTask
+from ..workflow import ForEach
+from ..workflow import MainSequence
+from ..workflow import Sequence
+from ..workflow import WorkflowTask
+from ..core import OutputMode
+from ..core import set_output_mode
+
+
+class Busy(DevOpsTask):
+
+    """
+    A small DevOpsTask that declares resources and keeps track of how many instances are executing at the same time.
+    """
+
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def __init__(self, resources=None):
+        super().__init__()
+        self.resources = resources
+
+    def execute(self, step_name=''):
+        with Busy.lock:
+            Busy.running += 1
+            Busy.max_running = max(Busy.max_running, Busy.running)
+        time.sleep(0.02)
+        with Busy.lock:
+            Busy.running -= 1
+
+
+class ResourcesTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        set_output_mode(OutputMode.Batch)
+        self.governor = ResourceGovernor(cpu_slots=2, memory_bytes=1000, disk_io_slots=1, host_slots=1, min_available_memory_bytes=0, max_rss_bytes=0, poll_interval=0.01)
+        Busy.max_running = 0
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        set_output_mode(None)
+
+    def start_acquire(self, resources):
+        admitted = threading.Event()
+
+        def acquire():
+            self.governor.acquire(resources)
+            admitted.set()
+        threading.Thread(target=acquire, daemon=True).start()
+        return admitted
+
+    def test_tokens(self):
+        for first, second in [(Resources(cpu=2), Resources()), (Resources(cpu=0, memory=600), Resources(cpu=0, memory=600)),
+                              (Resources(cpu=0, disk_io=True), Resources(cpu=0, disk_io=True)), (Resources(cpu=0, host='a'), Resources(cpu=0, host='a'))]:
+            self.governor.acquire(first)
+            admitted = self.start_acquire(second)
+            self.assertFalse(admitted.wait(0.05))
+            self.governor.release(first)
+            self.assertTrue(admitted.wait(1))
+            self.governor.release(second)
+        self.governor.acquire(Resources(cpu=0, host='a'))
+        self.assertTrue(self.start_acquire(Resources(cpu=0, host='b')).wait(1))
+        self.assertEqual(self.governor.running, 2)
+
+    def test_oversized_step_runs_alone(self):
+        with self.governor.admit(Resources(cpu=8, memory=5000)):
+            self.assertEqual(self.governor.running, 1)
+            admitted = self.start_acquire(None)
+            self.assertTrue(admitted.wait(1))
+        self.assertEqual(self.governor.running, 1)
+
+    def test_memory_pressure(self):
+        self.governor.min_available_memory_bytes = 100
+        with mock.patch.object(resources_module, 'available_memory', return_value=50) as available_memory:
+            self.governor.acquire(None)
+            admitted = self.start_acquire(None)
+            self.assertFalse(admitted.wait(0.05))
+            available_memory.return_value = 500
+            self.assertTrue(admitted.wait(1))
+        self.governor.max_rss_bytes = 100
+        with mock.patch.object(resources_module, 'process_rss', return_value=200):
+            self.assertTrue(self.governor.under_memory_pressure())
+
+    def test_steps_wait_for_resources(self):
+        stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        with mock.patch.object(workflow_module, 'get_governor', return_value=self.governor):
+            workflow = MainSequence()
+            for_each = ForEach(range(6), lambda item: Busy(Resources(cpu=1)), max_workers=4)
+            workflow.addstep('for each', for_each)
+            workflow.execute()
+            self.assertEqual(for_each.status, WorkflowTask.Status.CompletedOK)
+            self.assertEqual(Busy.max_running, 2)
+
+            Busy.max_running = 0
+            workflow = Sequence(max_workers=4)
+            for index in range(4):
+                workflow.addstep('busy {}'.format(index), Busy(Resources(cpu=0, disk_io=True)), depends_on=())
+            workflow.execute()
+        sys.stdout.close()
+        sys.stdout = stdout
+        self.assertEqual(Busy.max_running, 1)
+        self.assertEqual(self.governor.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
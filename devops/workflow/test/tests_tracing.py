@@ -0,0 +1,94 @@
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from ..tracing import Tracer
+from ..tracing import current_traceparent
+from ..workflow import MainSequence
+from ..workflow import Sequence
+from ..workflow import IfElse
+from ..workflow import ForEach
+from ..workflow import DevOpsTask
+from ..tasks.system import ExecuteCommand
+from ..core import OutputMode
+from ..core import set_output_mode
+
+
+class Fail(DevOpsTask):
+
+    def execute(self, step_name=''):
+        raise ValueError('asked to fail')
+
+
+class Nothing(DevOpsTask):
+
+    def execute(self, step_name=''):
+        pass
+
+
+class TracingTests(unittest.TestCase):
+    """
+    Run recursive from top tests package (i.e.): /DevOps/devops-->python -m unittest discover -v
+    """
+
+    def setUp(self):
+        "Hook method for setting up the test fixture before exercising it."
+        set_output_mode(OutputMode.Batch)
+        self.directory = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+
+    def tearDown(self):
+        "Hook method for deconstructing the test fixture after testing it."
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+        set_output_mode(None)
+
+    def run_traced(self, format):
+        path = os.path.join(self.directory, 'trace.json')
+        workflow = MainSequence()
+        workflow.add_listener(Tracer(path, format))
+        workflow.addstep('command', ExecuteCommand([sys.executable, '-c', 'import os; print(os.environ["TRACEPARENT"])']))
+        branch = IfElse(True)
+        branch.add_true_handler('inner', Nothing())
+        workflow.addstep('branch', branch)
+        workflow.addstep('loop', ForEach(range(2), lambda item: Nothing(), max_workers=2))
+        failing = Fail()
+        failing.continue_on_error = True
+        workflow.addstep('failing', failing)
+        workflow.execute()
+        self.assertIsNone(current_traceparent())
+        with open(path) as trace:
+            return workflow, json.load(trace)
+
+    def test_otlp_trace(self):
+        workflow, trace = self.run_traced('otlp')
+        spans = {span['name']: span for span in trace['resourceSpans'][0]['scopeSpans'][0]['spans']}
+        root = spans['MainSequence']
+        self.assertNotIn('parentSpanId', root)
+        self.assertEqual(len({span['traceId'] for span in spans.values()}), 1)
+        for child, parent in (('command', 'MainSequence'), ('branch', 'MainSequence'), ('Sequence', 'branch'), ('inner', 'Sequence'), ('loop [1]', 'loop'),
+                              ('failing', 'MainSequence')):
+            self.assertEqual(spans[child]['parentSpanId'], spans[parent]['spanId'])
+        self.assertEqual(workflow.exhaust['output'].strip(), '00-{}-{}-01'.format(root['traceId'], spans['command']['spanId']))
+        self.assertEqual(spans['failing']['status']['code'], 2)
+        self.assertEqual(spans['failing']['events'][0]['name'], 'exception')
+        attributes = {attribute['key']: attribute['value'] for attribute in spans['command']['attributes']}
+        self.assertEqual(attributes['workflow.status'], {'stringValue': 'ok'})
+        self.assertIn('process.output_bytes', attributes)
+
+    def test_chrome_trace(self):
+        workflow, trace = self.run_traced('chrome')
+        complete = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        self.assertEqual(len(complete), 11)
+        self.assertEqual([event['name'] for event in trace['traceEvents'] if event['ph'] == 'i'], ['exception'])
+        self.assertEqual(complete[0]['name'], 'MainSequence')
+        self.assertTrue(all(event['ts'] >= complete[0]['ts'] and event['ts'] + event['dur'] <= complete[0]['ts'] + complete[0]['dur'] for event in complete))
+
+
+if __name__ == '__main__':
+    unittest.main()
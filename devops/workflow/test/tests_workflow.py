@@ -1,14 +1,84 @@
 import unittest
+import io
 import colorama
 import sys
 from unittest.mock import MagicMock
 import os
+import gc
+import pickle
+import weakref
+import threading
+import time
 
 from ..workflow import Sequence
 from ..workflow import MainSequence
 from ..workflow import WorkflowTask
 from ..workflow import IfElse
+from ..workflow import DevOpsTask
+from ..workflow import StepRecord
+from ..workflow import ForEach
+from ..workflow import IsolatedTaskError
+from ..workflow import VariableScope
+from ..workflow import RunSummary
 from ..tasks.system import Copy
+from ..streams import Stream
+from ..streams import StreamReader
+from ..core import OutputMode
+from ..core import set_output_mode
+
+
+class Square(DevOpsTask):
+
+    """
+    A small DevOpsTask used by the ForEach tests. It squares the workflow variable 'item' and keeps track of how many instances are executing at the same time.
+    """
+
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def execute(self, step_name=''):
+        with Square.lock:
+            Square.running += 1
+            Square.max_running = max(Square.max_running, Square.running)
+        time.sleep(0.01)
+        item = self.input['item']
+        self.exhaust['square'] = [i * i for i in item] if isinstance(item, list) else item * item
+        with Square.lock:
+            Square.running -= 1
+
+
+class ProcessId(DevOpsTask):
+
+    """
+    A small DevOpsTask used by the run_in_process tests. It publishes the id of the process it ran in, or fails if the workflow variable 'fail' is set.
+    """
+
+    def execute(self, step_name=''):
+        self._w_print('Running in a worker process')
+        if self.input.get('fail'):
+            raise ValueError('asked to fail')
+        self.exhaust['pid'] = os.getpid()
+
+
+class Started(DevOpsTask):
+
+    """
+    A small DevOpsTask used by the dependency graph tests. It records the order steps start in, publishes its step name and fails if asked to.
+    """
+
+    order = []
+
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+
+    def execute(self, step_name=''):
+        Started.order.append(step_name)
+        time.sleep(0.02)
+        if self.fail:
+            raise ValueError('asked to fail')
+        self.exhaust[step_name] = sorted(name for name in self.input if name in Started.order)
 
 
 class WorkflowTests(unittest.TestCase):
@@ -18,11 +88,11 @@ class WorkflowTests(unittest.TestCase):
 
     def setUp(self):
         "Hook method for setting up the test fixture before exercising it."
-        pass
+        set_output_mode(OutputMode.Interactive)
 
     def tearDown(self):
         "Hook method for deconstructing the test fixture after testing it."
-        pass
+        set_output_mode(None)
 
     def test_basic_workflow_structure(self):
         basic_workflow = MainSequence()
@@ -61,6 +131,58 @@ class WorkflowTests(unittest.TestCase):
         self.assertEqual(copytruewf.status, WorkflowTask.Status.NotYetRun)
         sys.stdout.close()
 
+    def test_if_else_lazy_condition_and_factories(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        workflow.addstep('square', Square())
+        built = []
+
+        def build_branch(name):
+            def factory(variables):
+                built.append(name)
+                return Square()
+            return factory
+
+        workflow.addstep('If square > 10', IfElse(lambda variables: variables['square'] > 10, iffactory=build_branch('true'), elsefactory=build_branch('false')))
+        workflow.execute(existing_variables={'item': 4})
+        sys.stdout.close()
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertEqual(built, ['true'])
+
+    def test_variable_scope_snapshots(self):
+        scope = VariableScope({'a': 1, 'b': 2})
+        snapshot = scope.snapshot()
+        scope['a'] = 10
+        del scope['b']
+        snapshot['c'] = 3
+        self.assertEqual(scope, {'a': 10})
+        self.assertEqual(snapshot, {'a': 1, 'b': 2, 'c': 3})
+        self.assertNotIn('b', scope)
+        self.assertIsNone(scope.get('b'))
+        self.assertRaises(KeyError, scope.__getitem__, 'b')
+        for i in range(VariableScope.MAX_LAYERS * 2):
+            scope[i] = i
+            scope.snapshot()
+        self.assertLessEqual(len(scope._layers), VariableScope.MAX_LAYERS)
+        self.assertEqual(len(scope), VariableScope.MAX_LAYERS * 2 + 1)
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)), snapshot)
+        self.assertEqual(repr(snapshot), repr({'a': 1, 'b': 2, 'c': 3}))
+
+    def test_step_input_is_a_snapshot(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        first, second = Square(), Square()
+        workflow.addstep('first', first)
+        conditional = IfElse(lambda variables: True, iffactory=lambda variables: Square())
+        workflow.addstep('if', conditional)
+        workflow.addstep('second', second)
+        workflow.execute(existing_variables={'item': 3})
+        sys.stdout.close()
+        first.input['item'] = 100
+        self.assertEqual(second.input['item'], 3)
+        self.assertEqual(second.input['square'], 9)
+        self.assertEqual(conditional.exhaust, {'square': 9})
+
     def test_if_else_add_handlers(self):
         copytruewf = Copy(r'c:\true.log', r'c:\true.log')
         copyfalsewf = Copy(r'c:\false.log', r'c:\false.log')
@@ -112,6 +234,267 @@ class WorkflowTests(unittest.TestCase):
         self.assertEqual(workflow.status, WorkflowTask.Status.CompletedError)
         sys.stdout.close()
 
+    def test_slotted_task_has_no_instance_dict(self):
+
+        class SlottedTask(DevOpsTask):
+            __slots__ = ('source',)
+
+            def __init__(self, source):
+                super().__init__()
+                self.source = source
+
+            def execute(self, step_name=''):
+                pass
+
+        task = SlottedTask('a')
+        self.assertFalse(hasattr(task, '__dict__'))
+        self.assertIsNone(task._input)
+        self.assertIsNone(task._exhaust)
+        self.assertEqual(task.exhaust, {})
+
+    def test_sequence_execute_step_record(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        dir = os.path.dirname(__file__)
+        record = StepRecord(Copy, os.path.join(dir, 'testtrue.dat'), os.path.join(dir, 'testtrue.dat1'))
+        workflow.addstep('test', record)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertIs(workflow.get('test'), record)
+        self.assertEqual(record.status, WorkflowTask.Status.CompletedOK)
+        self.assertTrue(os.path.exists(os.path.join(dir, 'testtrue.dat1')))
+
+    def test_sequence_execute_step_record_error(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        record = StepRecord(Copy, '/does/not/exist', '/does/not/exist1')
+        record.continue_on_error = True
+        workflow.addstep('test', record)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(record.status, WorkflowTask.Status.CompletedError)
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedError)
+
+    def test_sequence_addsteps_is_lazy_and_releases_steps(self):
+        sys.stdout = open("unit_test.txt", "w")
+        created = []
+        released = []
+
+        def steps():
+            for i in range(3):
+                copy = Copy('/test1', '/test2')
+                if created:
+                    gc.collect()
+                    released.append(created[-1]() is None)
+                copy.execute = MagicMock()
+                created.append(weakref.ref(copy))
+                yield 'copy {}'.format(i), copy
+
+        workflow = MainSequence()
+        workflow.addsteps(steps())
+        self.assertEqual(created, [])
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(len(created), 3)
+        self.assertEqual(released, [True, True])
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+
+    def test_sequence_addsteps_keeps_order_with_addstep(self):
+        sys.stdout = open("unit_test.txt", "w")
+        order = []
+
+        def make(name):
+            copy = Copy('/test1', '/test2')
+            copy.execute = MagicMock(side_effect=lambda step_name='': order.append(step_name))
+            return copy
+
+        workflow = MainSequence()
+        workflow.addstep('first', make('first'))
+        workflow.addsteps((name, make(name)) for name in ['second', 'third'])
+        workflow.addstep('fourth', make('fourth'))
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(order, ['first', 'second', 'third', 'fourth'])
+
+    def test_for_each_sequential(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        for_each = ForEach(range(5), lambda item: Square())
+        workflow.addstep('for each', for_each)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(for_each.status, WorkflowTask.Status.CompletedOK)
+        self.assertEqual([result['square'] for result in for_each.exhaust['results']], [0, 1, 4, 9, 16])
+
+    def test_run_summary(self):
+        stdout = sys.stdout
+        sys.stdout = open("unit_test.txt", "w")
+        summary = RunSummary()
+        workflow = MainSequence()
+        workflow.add_listener(summary)
+        workflow.addstep('square', Square())
+        workflow.addstep('for each', ForEach(range(2), lambda item: Square()))
+        workflow.execute(existing_variables={'item': 3})
+        sys.stdout.close()
+        sys.stdout = stdout
+        self.assertEqual((summary.count, summary.statuses[WorkflowTask.Status.CompletedOK]), (4, 4))
+        summary.add('command', WorkflowTask.Status.CompletedError, 2.0, {'wall_seconds': 2.0, 'output_bytes': 10, 'user_seconds': 1.5, 'system_seconds': 0.25,
+                                                                                  'max_rss_bytes': 1048576, 'block_input': 0, 'block_output': 8, 'voluntary_context_switches': 3,
+                                                                                  'involuntary_context_switches': 4})
+        lines = summary.get_lines(slowest=1)
+        self.assertEqual(lines[0], 'Run summary: 5 step(s), 1 failed')
+        self.assertEqual(lines[1], 'Child processes: wall 2.000s, user 1.500s, system 0.250s, max rss 1.0 MB, block i/o 0/8, context switches 3/4, output 10 bytes')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].startswith('2.000s command (failed); wall 2.000s'))
+
+    def test_run_summary_keeps_only_the_slowest_steps(self):
+        summary = RunSummary(slowest=3)
+        for index in range(1000):
+            summary.add('step {}'.format(index), WorkflowTask.Status.CompletedOK, index % 100 / 10, {'wall_seconds': 1.0, 'max_rss_bytes': index})
+        self.assertEqual(len(summary._slowest_steps), 3)
+        lines = summary.get_lines()
+        self.assertEqual(lines[0], 'Run summary: 1000 step(s), 0 failed')
+        self.assertEqual(lines[1], 'Child processes: wall 1000.000s, output 0 bytes')
+        self.assertEqual(summary.rusage['max_rss_bytes'], 999)
+        self.assertEqual([line.split(';')[0] for line in lines[2:]], ['9.900s step 99', '9.900s step 199', '9.900s step 299'])
+
+    def test_for_each_parallel(self):
+        sys.stdout = open("unit_test.txt", "w")
+        Square.max_running = 0
+        workflow = MainSequence()
+        for_each = ForEach(iter(range(20)), lambda item: Square(), max_workers=3)
+        workflow.addstep('for each', for_each)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual([result['square'] for result in for_each.exhaust['results']], [i * i for i in range(20)])
+        self.assertGreater(Square.max_running, 1)
+        self.assertLessEqual(Square.max_running, 3)
+
+    def test_for_each_batches(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        for_each = ForEach(range(5), lambda item: Square(), batch_size=2)
+        workflow.addstep('for each', for_each)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual([result['square'] for result in for_each.exhaust['results']], [[0, 1], [4, 9], [16]])
+
+    def test_for_each_parallel_error(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        for_each = ForEach(range(10), lambda item: Copy('/does/not/exist', '/does/not/exist1'), max_workers=2)
+        for_each.continue_on_error = True
+        workflow.addstep('for each', for_each)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(for_each.status, WorkflowTask.Status.CompletedError)
+
+    def build_graph(self, **costs):
+        Started.order = []
+        workflow = MainSequence(max_workers=2)
+        workflow.addstep('checkout', Started())
+        for name in ['lint', 'docs', 'package']:
+            workflow.addstep(name, Started(), depends_on=['checkout'], cost=costs.get(name))
+        workflow.addstep('test', Started(), depends_on=['checkout'], cost=costs.get('test'))
+        workflow.addstep('report', Started(), depends_on=['test', 'lint'])
+        return workflow
+
+    def test_sequence_dependency_graph(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = self.build_graph()
+        workflow.execute()
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedOK)
+        self.assertEqual(Started.order[0], 'checkout')
+        self.assertEqual(set(Started.order[1:3]), {'lint', 'docs'})
+        self.assertEqual(Started.order[-1], 'report')
+        self.assertTrue(set(workflow.exhaust['report']).issuperset(['checkout', 'lint', 'test']))
+
+        workflow = self.build_graph(test=60, lint=1, docs=1, package=1)
+        workflow.execute()
+        self.assertIn('test', Started.order[1:3])
+        workflow = self.build_graph()
+        workflow.cost_estimates = {'package': 30, 'lint': 2}
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(set(Started.order[1:3]), {'package', 'test'})
+
+    def test_sequence_dependency_graph_errors(self):
+        sys.stdout = open("unit_test.txt", "w")
+        Started.order = []
+        workflow = Sequence(max_workers=2)
+        workflow.addstep('first', Started(fail=True))
+        workflow.addstep('second', Started())
+        workflow.addstep('independent', Started(), depends_on=())
+        self.assertRaises(ValueError, workflow.execute)
+        self.assertNotIn('second', Started.order)
+
+        workflow = Sequence(max_workers=2)
+        workflow.addstep('first', Started(fail=True))
+        workflow.get('first').continue_on_error = True
+        workflow.addstep('second', Started())
+        workflow.execute()
+        self.assertEqual(workflow.status, WorkflowTask.Status.CompletedError)
+        self.assertEqual(workflow.get('second').status, WorkflowTask.Status.CompletedOK)
+
+        workflow = Sequence(max_workers=2)
+        workflow.addstep('first', Started(), depends_on=['missing'])
+        self.assertRaises(ValueError, workflow.execute)
+        workflow = Sequence(max_workers=2)
+        workflow.addstep('first', Started(), depends_on=['second'])
+        workflow.addstep('second', Started())
+        self.assertRaises(ValueError, workflow.execute)
+        sys.stdout.close()
+
+    def test_for_each_parallel_error_stops_iterations(self):
+        sys.stdout = open("unit_test.txt", "w")
+        Started.order = []
+        workflow = MainSequence()
+        workflow.addstep('for each', ForEach(range(100), lambda item: Started(fail=item == 0), max_workers=2))
+        self.assertRaises(ValueError, workflow.execute)
+        sys.stdout.close()
+        self.assertLess(len(Started.order), 10)
+
+    def test_sequence_execute_run_in_process(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = MainSequence()
+        task = ProcessId()
+        task.run_in_process = True
+        workflow.addstep('isolated', task)
+        workflow.execute()
+        sys.stdout.close()
+        self.assertEqual(task.status, WorkflowTask.Status.CompletedOK)
+        self.assertNotEqual(task.exhaust['pid'], os.getpid())
+        self.assertIs(task.parent, workflow)
+        with open("unit_test.txt", 'r') as test_print:
+            self.assertIn('Running in a worker process', test_print.read())
+
+    def test_sequence_execute_run_in_process_with_unbuffered_stream(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = Sequence()
+        task = ProcessId()
+        task.run_in_process = True
+        workflow.addstep('isolated', task)
+        copy = Copy(Stream('data'), 'unit_test.dat1')
+        copy.run_in_process = True
+        workflow.addstep('copy', copy)
+        self.assertRaises(IsolatedTaskError, workflow.execute, existing_variables={'data': StreamReader(io.BytesIO(b'data'))})
+        sys.stdout.close()
+        self.assertEqual(task.status, WorkflowTask.Status.CompletedOK)
+        with open("unit_test.txt", 'r') as test_print:
+            self.assertIn('Stream data is unbuffered', test_print.read())
+
+    def test_sequence_execute_run_in_process_error(self):
+        sys.stdout = open("unit_test.txt", "w")
+        workflow = Sequence()
+        task = ProcessId()
+        task.run_in_process = True
+        workflow.addstep('isolated', task)
+        self.assertRaises(IsolatedTaskError, workflow.execute, existing_variables={'fail': True})
+        sys.stdout.close()
+        self.assertEqual(task.status, WorkflowTask.Status.CompletedError)
+        with open("unit_test.txt", 'r') as test_print:
+            self.assertIn('ValueError: asked to fail', test_print.read())
+
     def test_sequence_get_header_style(self):
         test_if = IfElse(1 != 2)
         self.assertEqual(test_if._get_header_style(), colorama.Fore.YELLOW + colorama.Style.DIM)
@@ -209,6 +592,36 @@ class WorkflowTests(unittest.TestCase):
         with open("unit_test.txt", 'r') as test_print:
             self.assertEqual(test_print.read(), '%s%s     testing123\n' % (colorama.Fore.YELLOW, colorama.Style.DIM) )
 
+    def test_w_print_batch_output(self):
+        set_output_mode(OutputMode.Batch)
+        test_if = IfElse(1 != 2)
+        sys.stdout = open("unit_test.txt", "w")
+        test_if._w_print('testing123', WorkflowTask.TextStyle.Header)
+        sys.stdout.close()
+        with open("unit_test.txt", 'r') as test_print:
+            self.assertEqual(test_print.read(), '     testing123\n')
+
+    def test_w_print_auto_output_mode_uses_batch_when_not_a_tty(self):
+        set_output_mode(OutputMode.Auto)
+        test_if = IfElse(1 != 2)
+        sys.stdout = open("unit_test.txt", "w")
+        test_if._w_print('testing123', WorkflowTask.TextStyle.Header)
+        sys.stdout.close()
+        with open("unit_test.txt", 'r') as test_print:
+            self.assertEqual(test_print.read(), '     testing123\n')
+
+    def test_batch_output_abbreviates_variable_dumps(self):
+        set_output_mode(OutputMode.Batch)
+        test = Copy('', '')
+        test.input = dict(('variable{}'.format(i), 'x' * 1000) for i in range(1000))
+        sys.stdout = open("unit_test.txt", "w")
+        test._prehook()
+        sys.stdout.close()
+        with open("unit_test.txt", 'r') as test_print:
+            output = test_print.read()
+        self.assertIn('...', output)
+        self.assertLess(len(output), 3000)
+
     def test_devops_task_get_header_style(self):
         copy = Copy('','')
         self.assertEqual(copy._get_header_style(), colorama.Fore.WHITE + colorama.Style.DIM)
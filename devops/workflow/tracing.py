@@ -0,0 +1,239 @@
+"""
+The tracing module records the execution of a workflow as trace spans, to see where the time of a run goes: which steps overlapped, where it sat idle and what the critical path was.
+
+A Tracer is a WorkflowListener. Every Sequence, control flow task (IfElse, ForEach) and DevOpsTask that runs below the Sequence it is registered on gets a span, whose parent is the span of the task it ran
+in, so the spans form the same tree as the workflow. A span's attributes include the step name, task class, status and the byte counts found in the step's exhaust (see _get_byte_attributes()); a step
+that fails gets an exception event with the traceback.
+
+When the outermost Sequence finishes, the trace is written to a file, as either:
+
+- chrome: the Chrome trace event format, for chrome://tracing, Perfetto (https://ui.perfetto.dev) or speedscope, with a lane per thread; or
+- otlp: OTLP JSON (the OpenTelemetry protocol's JSON encoding), for tools that import OpenTelemetry traces, e.g. Jaeger.
+
+MainSequence adds a Tracer to every run if directory is set in the [Tracing] section of appsettings.cfg; the format is set there too.
+
+While a step runs, current_traceparent() returns the W3C traceparent of its span. ExecuteCommand passes it to the command as the TRACEPARENT environment variable, so tools that trace themselves can
+join the workflow's trace.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+from .workflow import DevOpsTask
+from .workflow import WorkflowListener
+from .workflow import WorkflowTask
+from .core import get_system_config_value
+
+
+_current = threading.local()
+
+
+def current_traceparent():
+    """
+    Returns the W3C traceparent (https://www.w3.org/TR/trace-context/) of the span of the step running on this thread, or None if it isn't being traced.
+    """
+
+    return getattr(_current, 'traceparent', None)
+
+
+class _Span(object):
+
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id', 'name', 'attributes', 'events', 'start', 'end', 'error', 'thread_id', 'previous_traceparent')
+
+    def __init__(self, trace_id, parent_span_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.attributes = attributes
+        self.events = []
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+        self.thread_id = threading.get_ident()
+        self.previous_traceparent = None
+
+    @property
+    def traceparent(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+
+class Tracer(WorkflowListener):
+
+    """
+    Records a span for every task that runs below the Sequence the Tracer is registered on (see Sequence.add_listener()), and writes the trace to a file when the outermost Sequence finishes. To use:
+
+    workflow.add_listener(Tracer('trace.json'))
+
+    Instance Variables
+    =====================================
+    - self.path = The file the trace is written to. If None, it is written to trace-<trace id>.json in the configured directory.
+    - self.format = 'chrome' or 'otlp'. If None, the format configured in the [Tracing] section of appsettings.cfg.
+    - self.spans = The finished spans of the trace being recorded.
+    """
+
+    def __init__(self, path=None, format=None):
+        self.path = path
+        self.format = format
+        self.spans = []
+        self._open = {}
+        self._trace_id = None
+        self._lock = threading.Lock()
+
+    def sequence_started(self, sequence):
+        with self._lock:
+            if id(sequence) in self._open:
+                # A Sequence that is a step of another has already been given its span by step_started().
+                return
+            parent = self._find_parent_span(sequence.parent)
+            if parent is None:
+                self._trace_id = os.urandom(16).hex()
+            self._open_span(sequence, parent, sequence.step_name or type(sequence).__name__)
+
+    def sequence_finished(self, sequence):
+        with self._lock:
+            span = self._open.get(id(sequence))
+            if span is None or 'workflow.step' in span.attributes:
+                return
+            self._close_span(sequence, span, None)
+            if span.parent_span_id is not None:
+                return
+            spans, self.spans = self.spans, []
+        self.write(spans)
+
+    def step_started(self, sequence, step_name, step):
+        with self._lock:
+            self._open_span(step, self._find_parent_span(sequence), step_name, {'workflow.step': step_name})
+
+    def step_finished(self, sequence, step_name, step, error=None):
+        with self._lock:
+            span = self._open.get(id(step))
+            if span is not None:
+                self._close_span(step, span, error)
+
+    def _find_parent_span(self, task):
+        while task is not None:
+            span = self._open.get(id(task))
+            if span is not None:
+                return span
+            task = task.parent
+        return None
+
+    def _open_span(self, task, parent, name, attributes=None):
+        attributes = dict(attributes or {}, **{'workflow.task': type(task).__name__})
+        span = _Span(self._trace_id, parent.span_id if parent is not None else None, name, attributes)
+        self._open[id(task)] = span
+        span.previous_traceparent = current_traceparent()
+        _current.traceparent = span.traceparent
+
+    def _close_span(self, task, span, error):
+        del self._open[id(task)]
+        span.end = time.time_ns()
+        span.attributes['workflow.status'] = 'error' if task.status == WorkflowTask.Status.CompletedError else 'ok'
+        if isinstance(task, DevOpsTask):
+            span.attributes.update(_get_byte_attributes(task._exhaust))
+        if error is not None:
+            span.error = error.strip().splitlines()[-1]
+            span.events.append((span.end, 'exception', {'exception.stacktrace': error}))
+        if threading.get_ident() == span.thread_id:
+            _current.traceparent = span.previous_traceparent
+        self.spans.append(span)
+
+    def write(self, spans=None):
+        """
+        Writes spans (by default, the finished spans recorded so far) to self.path, in self.format, and returns the path.
+        """
+
+        spans = self.spans if spans is None else spans
+        if not spans:
+            return None
+        format = (self.format or get_system_config_value('Tracing', 'format', fallback='chrome')).lower()
+        path = self.path
+        if path is None:
+            directory = get_system_config_value('Tracing', 'directory', fallback='') or '.'
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'trace-{}.json'.format(spans[0].trace_id))
+        document = _to_otlp(spans) if format == 'otlp' else _to_chrome(spans)
+        with open(path, 'w') as output:
+            json.dump(document, output)
+        return path
+
+
+def get_byte_counts(exhaust):
+    """
+    Returns the byte counts found in a task's exhaust: stream_bytes (the size of the Streams it published), retrieved_bytes (the bytes it retrieved, see HttpDataRetrieval and BulkHttpDataRetrieval)
+    and output_bytes (the output of its child processes, see ExecuteCommand). Counts that are zero are left out.
+    """
+
+    from .streams import StreamBuffer
+    counts = collections.Counter()
+    for value in (exhaust or {}).values():
+        if isinstance(value, StreamBuffer):
+            counts['stream_bytes'] += len(value)
+        elif isinstance(value, dict) and isinstance(value.get('bytes'), int):
+            counts['retrieved_bytes'] += value['bytes']
+    counts['output_bytes'] += ((exhaust or {}).get('rusage') or {}).get('output_bytes', 0)
+    return {name: count for name, count in counts.items() if count}
+
+
+def _get_byte_attributes(exhaust):
+    """
+    Returns span attributes for a task's exhaust: its byte counts (see get_byte_counts()) and the resources its child processes used.
+    """
+
+    attributes = {'workflow.' + name: count for name, count in get_byte_counts(exhaust).items()}
+    for key, value in ((exhaust or {}).get('rusage') or {}).items():
+        attributes['process.' + key] = value
+    return attributes
+
+
+def _to_chrome(spans):
+    """
+    Returns the spans as a Chrome trace event document: a complete (X) event per span, and an instant (i) event per span event, with timestamps in microseconds.
+    """
+
+    pid = os.getpid()
+    events = []
+    for span in spans:
+        args = dict(span.attributes, span_id=span.span_id, parent_span_id=span.parent_span_id, trace_id=span.trace_id)
+        if span.error is not None:
+            args['error'] = span.error
+        events.append({'name': span.name, 'cat': span.attributes['workflow.task'], 'ph': 'X', 'ts': span.start / 1000, 'dur': (span.end - span.start) / 1000, 'pid': pid, 'tid': span.thread_id,
+                       'args': args})
+        for timestamp, name, attributes in span.events:
+            events.append({'name': name, 'cat': span.attributes['workflow.task'], 'ph': 'i', 's': 't', 'ts': timestamp / 1000, 'pid': pid, 'tid': span.thread_id, 'args': attributes})
+    return {'traceEvents': sorted(events, key=lambda event: event['ts']), 'displayTimeUnit': 'ms'}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _to_otlp(spans):
+    """
+    Returns the spans as an OTLP JSON ExportTraceServiceRequest.
+    """
+
+    otlp_spans = []
+    for span in spans:
+        otlp_span = {'traceId': span.trace_id, 'spanId': span.span_id, 'name': span.name, 'kind': 1, 'startTimeUnixNano': str(span.start), 'endTimeUnixNano': str(span.end),
+                     'attributes': _otlp_attributes(dict(span.attributes, **{'thread.id': span.thread_id})),
+                     'events': [{'timeUnixNano': str(timestamp), 'name': name, 'attributes': _otlp_attributes(attributes)} for timestamp, name, attributes in span.events],
+                     'status': {'code': 2, 'message': span.error} if span.error is not None else {'code': 1}}
+        if span.parent_span_id is not None:
+            otlp_span['parentSpanId'] = span.parent_span_id
+        otlp_spans.append(otlp_span)
+    resource = {'attributes': _otlp_attributes({'service.name': 'devops-workflow', 'process.pid': os.getpid()})}
+    return {'resourceSpans': [{'resource': resource, 'scopeSpans': [{'scope': {'name': 'devops.workflow'}, 'spans': otlp_spans}]}]}
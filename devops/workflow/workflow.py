@@ -8,6 +8,10 @@ WorkflowTask is the abstract base class for all workflow-based tasks, including
 DevOpsTask is a super class for tasks that perform actions, such as the Copy task. As such, most of the tasks being added to a Sequence will likely be DevOpsTask items.
 ControlFlowTask is a super class for control flow tasks, such is IfElse.
 IfElse is the primary ControlFlowTask WorkflowTask. It is designed to work with workflow to provide basic if else functionality while staying coupled to the workflow.
+ForEach is a ControlFlowTask that runs a body Sequence once for every item of an iterable, either one item at a time, in batches, or in parallel.
+WorkflowListener is the base class for objects that follow the progress of a workflow (status displays, run histories and the like).
+VariableScope holds the workflow variables passed from step to step. It is a dictionary with amortized constant time, copy-on-write snapshots.
+StepRecord is a lightweight stand-in for a WorkflowTask in a Sequence, for workflows with a very large number of small steps. The task is only built when its step is executed.
 
 It is important to note that the goal of this module isn't to enforce strict rules on how scripts, or even workflows should be executed. One should feel free to mix and match standard python variables, if/else constructs, looping constructs, etc with the workflow as necessary.
 Rather, the goal is to provide some basic structure in terms of how scripts are executed, allowing many scripts that are functionally different to share several basic operational properties.
@@ -15,12 +19,245 @@ Rather, the goal is to provide some basic structure in terms of how scripts are
 
 import logging
 import collections
+import collections.abc
+import contextlib
 import sys
 import traceback
+import reprlib
+import itertools
+import os
+import threading
+import time
 from .core import get_system_config_value
+from .core import is_batch_output
+from .resources import get_governor
 from abc import ABCMeta, abstractmethod
+from functools import lru_cache
 
-import colorama
+
+@lru_cache(maxsize=None)
+def _get_console_setting(key):
+    """
+    Evaluates a [ConsoleOutput] setting from appsettings.cfg, such as a style or the indentation string. Settings don't change during a run, so each one is only evaluated once. colorama is only imported
+    for settings that refer to it (the styles), so batch runs, which only need the indentation, never pay for importing it.
+    """
+
+    expression = get_system_config_value('ConsoleOutput', key)
+    namespace = {}
+    if 'colorama' in expression:
+        import colorama
+        namespace['colorama'] = colorama
+    return eval(expression, namespace)
+
+
+class IsolatedTaskError(Exception):
+
+    """
+    Raised in the parent process when a DevOpsTask that was run in a worker process (see DevOpsTask.run_in_process) fails. The message is the formatted traceback from the worker.
+    """
+
+    pass
+
+
+# Set in worker processes while an isolated task runs; _w_print() appends its output here so it can be sent back to the parent rather than printed.
+_captured_output = None
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool():
+    """
+    The worker process pool used for DevOpsTask items with run_in_process set. It is created on first use and sized by processPoolSize in the [Execution] section of appsettings.cfg (0 means one worker per CPU).
+    """
+
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            size = int(get_system_config_value('Execution', 'processPoolSize', fallback='0'))
+            _process_pool = ProcessPoolExecutor(max_workers=size or os.cpu_count())
+        return _process_pool
+
+
+def _pickle_task(task):
+    """
+    Pickles a task without its parent, so that the rest of the workflow tree doesn't travel with it, and without the unbuffered streams in its input, which can't (see streams.without_stream_readers()).
+    """
+
+    import pickle
+    from .streams import without_stream_readers
+    parent, task_input = task.parent, task._input
+    task.parent = None
+    if task_input is not None:
+        task._input = without_stream_readers(task_input)
+    try:
+        return pickle.dumps(task)
+    finally:
+        task.parent = parent
+        task._input = task_input
+
+
+def _run_isolated_task(payload):
+    """
+    Runs a pickled task in a worker process and returns a dictionary with its exhaust, status, formatted traceback (if it failed) and the output it printed with _w_print().
+    """
+
+    global _captured_output
+    import pickle
+    task = pickle.loads(payload)
+    _captured_output = []
+    error = None
+    try:
+        task.execute(step_name=task.step_name)
+        status = WorkflowTask.Status.CompletedOK
+    except BaseException:
+        status = WorkflowTask.Status.CompletedError
+        error = ''.join(traceback.format_exception(*sys.exc_info()))
+    finally:
+        output, _captured_output = _captured_output, None
+    return {'exhaust': task._exhaust, 'status': status, 'error': error, 'output': output}
+
+
+def _apply_isolated_result(task, result):
+    """
+    Replays the output of a task that ran elsewhere through its own _w_print() (so it is styled, indented and logged in the parent, in order), copies its exhaust back, and raises IsolatedTaskError if it failed.
+    """
+
+    for text, textstyle, loglevel in result['output']:
+        task._w_print(text, textstyle, loglevel)
+    if result['exhaust']:
+        task.exhaust.update(result['exhaust'])
+    if result['error'] is not None:
+        raise IsolatedTaskError(result['error'])
+
+
+class ProcessPoolStepExecutor(object):
+
+    """
+    The step executor used for DevOpsTask items with run_in_process set. A step executor is any object with a run() method that takes a pickled task, runs it somewhere else, and returns the result of
+    _run_isolated_task(); distributed.Coordinator is another one.
+    """
+
+    def run(self, payload):
+        return _get_process_pool().submit(_run_isolated_task, payload).result()
+
+
+def _execute_elsewhere(task, step_name, executor):
+    task.step_name = step_name
+    _apply_isolated_result(task, executor.run(_pickle_task(task)))
+
+
+class VariableScope(collections.abc.MutableMapping):
+
+    """
+    VariableScope holds the workflow variables that are passed from step to step. It behaves like a dictionary, but snapshot() makes a copy of it in amortized constant time, however many variables it holds:
+    the snapshot and the original share everything that was in the scope when the snapshot was taken, and each one only keeps its own changes from then on (copy-on-write). A Sequence gives every step
+    a snapshot of the variables as its input, and IfElse and ForEach give every branch and iteration one, so steps can't change each other's variables, parallel iterations don't share a mutable
+    dictionary, and the input of a step is a checkpoint of the variables at the time it started.
+
+    Internally a scope is a tuple of frozen layers, which are shared and never changed again, plus a dictionary of its own changes on top. Once there are more than MAX_LAYERS layers they are merged
+    into one, so lookups stay cheap; that merge copies every variable, so one snapshot in MAX_LAYERS takes time proportional to the number of variables.
+    """
+
+    __slots__ = ('_layers', '_local')
+
+    MAX_LAYERS = 32
+
+    _DELETED = object()
+
+    def __init__(self, values=None):
+        self._layers = ()
+        self._local = dict(values) if values else {}
+
+    def snapshot(self):
+        """
+        Returns a copy of the scope, in amortized constant time (see the class documentation). Changes to either the copy or the original are not seen by the other.
+        """
+
+        if self._local:
+            layers = self._layers + (self._local,)
+            if len(layers) > VariableScope.MAX_LAYERS:
+                layers = (self._merge(layers),)
+            self._layers = layers
+            self._local = {}
+        snapshot = VariableScope.__new__(VariableScope)
+        snapshot._layers = self._layers
+        snapshot._local = {}
+        return snapshot
+
+    @staticmethod
+    def _merge(layers):
+        merged = {}
+        for layer in layers:
+            merged.update(layer)
+        return {key: value for key, value in merged.items() if value is not VariableScope._DELETED}
+
+    def _lookup(self, key):
+        value = self._local.get(key, VariableScope._DELETED)
+        if value is VariableScope._DELETED and key not in self._local:
+            for layer in reversed(self._layers):
+                if key in layer:
+                    return layer[key]
+        return value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is VariableScope._DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is VariableScope._DELETED else value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not VariableScope._DELETED
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._local[key] = VariableScope._DELETED
+
+    def __iter__(self):
+        return iter(self._merge(self._layers + (self._local,)))
+
+    def __len__(self):
+        return len(self._merge(self._layers + (self._local,)))
+
+    def __repr__(self):
+        return repr(self._merge(self._layers + (self._local,)))
+
+    def __reduce__(self):
+        return VariableScope, (self._merge(self._layers + (self._local,)),)
+
+
+def _snapshot(variables):
+    """
+    Returns a snapshot of variables, which can be a VariableScope or (e.g. for a task that is executed on its own) a plain dictionary.
+    """
+
+    if isinstance(variables, VariableScope):
+        return variables.snapshot()
+    return VariableScope(variables)
+
+
+@lru_cache(maxsize=None)
+def _get_batch_repr():
+    """
+    The reprlib.Repr used to abbreviate workflow variable dumps in batch output mode.
+    """
+
+    limit = int(get_system_config_value('ConsoleOutput', 'batchVariableDumpLimit', fallback='20'))
+    batch_repr = reprlib.Repr()
+    batch_repr.maxdict = batch_repr.maxlist = batch_repr.maxtuple = batch_repr.maxset = limit
+    batch_repr.maxstring = batch_repr.maxother = 80
+    batch_repr.maxlevel = 2
+    batch_repr.repr_VariableScope = batch_repr.repr_dict
+    return batch_repr
 
 
 class WorkflowTask(object):
@@ -41,14 +278,22 @@ class WorkflowTask(object):
 
     Instance Variables
     =====================================
-    - self.input => A dictionary of "variables" that can be passed from one WorkflowTask to another
+    - self.input => A dictionary of "variables" that can be passed from one WorkflowTask to another. In a Sequence, this is a VariableScope snapshot of the variables when the step started; changes a task
+    makes to it are not seen by other steps, only its exhaust is.
     - self.exhaust = The "exhaust" from a WorkflowTask as a dictionary, that will be passed into the next WorkflowTask.
     - self.step_name = The name of a WorkflowTask. It should be unique as it is used as the key of workflow steps in Sequence.
     - self.status = The status of the WorkflowTask.
     - self.continue_on_error = If this is true, and WorkflowTask raises an exception, continue to the next WorkflowTask.
     - self.parent = This is set to the parent container of the WorkflowTask. At the moment, this will be a Sequence or IfElse. The current purpose of this variable is for output indentation.
+
+    Memory Footprint
+    =====================================
+    WorkflowTask and the framework classes below it (DevOpsTask, ControlFlowTask, Sequence, IfElse) use __slots__, and self.input / self.exhaust are only allocated when they are first used. A concrete task
+    that also declares __slots__ for its own instance variables has no per-instance __dict__ at all, which matters for workflows with a very large number of small steps. See also StepRecord.
     """
 
+    __slots__ = ('_input', '_exhaust', 'step_name', 'status', 'continue_on_error', 'parent')
+
     class TextStyle(object):
 
         """
@@ -79,13 +324,33 @@ class WorkflowTask(object):
         Default constructor of WorkflowItem. It should not be overridden by subclasses; rather, it should be extended and called via super().
         """
 
-        self.input = {}
-        self.exhaust = {}
+        self._input = None
+        self._exhaust = None
         self.step_name = ''
         self.status = WorkflowTask.Status.NotYetRun
         self.continue_on_error = False
         self.parent = None
 
+    @property
+    def input(self):
+        if self._input is None:
+            self._input = {}
+        return self._input
+
+    @input.setter
+    def input(self, value):
+        self._input = value
+
+    @property
+    def exhaust(self):
+        if self._exhaust is None:
+            self._exhaust = {}
+        return self._exhaust
+
+    @exhaust.setter
+    def exhaust(self, value):
+        self._exhaust = value
+
     @abstractmethod
     def execute(self, step_name=''):
         """
@@ -143,16 +408,16 @@ class WorkflowTask(object):
         """
 
         if textstyle == WorkflowTask.TextStyle.Text or textstyle == WorkflowTask.TextStyle.Error:
-            return eval(get_system_config_value('ConsoleOutput', 'indentation')) * (self._get_indentation_level() + 1)
+            return _get_console_setting('indentation') * (self._get_indentation_level() + 1)
         else:
-            return eval(get_system_config_value('ConsoleOutput', 'indentation')) * self._get_indentation_level()
+            return _get_console_setting('indentation') * self._get_indentation_level()
 
     def _get_error_style(self):
         """
         Sets the output (console, logging, etc) error style of a WorkflowTask (if Exceptions are raised). It is not required to be implementd by subclasses as it has a default implementation, but feel free to override that.
         """
 
-        return eval(get_system_config_value('ConsoleOutput', 'workflowTaskErrorStyle'))
+        return _get_console_setting('workflowTaskErrorStyle')
 
     def _w_print(self, text, textstyle=TextStyle.Text, loglevel=logging.INFO):
         """
@@ -160,12 +425,20 @@ class WorkflowTask(object):
         to printing to the console. If additional/different printing behavior is required, please extend this method.
 
         Because this is a protected method, it should only be called in its containing class.
+
+        In batch output mode (see core.OutputMode) the text is written without any style.
         """
 
+        if _captured_output is not None:
+            _captured_output.append((text, textstyle, loglevel))
+            return
+
         w_print_logger = logging.getLogger('w_print_logger')
         w_print_logger.propagate = False
 
-        if textstyle == WorkflowTask.TextStyle.Header:
+        if is_batch_output():
+            sys.stdout.write(self._get_indentation(textstyle) + text + '\n')
+        elif textstyle == WorkflowTask.TextStyle.Header:
             print(self._get_header_style() + self._get_indentation(WorkflowTask.TextStyle.Header) + text)
         elif textstyle == WorkflowTask.TextStyle.Footer:
             print(self._get_footer_style() + self._get_indentation(WorkflowTask.TextStyle.Footer) + text)
@@ -181,33 +454,52 @@ class WorkflowTask(object):
         A hook method that is called before execute() is called. Some examples of what might be here: text indicating a WorkflowTask is starting or printing input workflow variables.
         """
 
-        self._w_print('Input workflow variables: {}'.format(self.input))
+        self._w_print('Input workflow variables: {}'.format(self._format_variables(self.input)))
 
     def _posthook(self):
         """
         A hook method that is called after execute() is complete. Some examples of what might be here: text indicating a WorkflowTask is complete or printing exhaust workflow variables.
         """
 
-        self._w_print('Exhaust workflow variables {}'.format(self.exhaust))
+        self._w_print('Exhaust workflow variables {}'.format(self._format_variables(self.exhaust)))
+
+    def _format_variables(self, variables):
+        """
+        Formats a dictionary of workflow variables for output. In batch output mode, large dictionaries and values are abbreviated so that a big set of variables doesn't cost more to print than the step costs to run.
+        """
+
+        if is_batch_output():
+            return _get_batch_repr().repr(variables)
+        return '{}'.format(variables)
 
 
 class DevOpsTask(WorkflowTask):
 
     """
     DevOpsTask is a super class for all concrete devops tasks like Copy or Ftp. It has some basic structure set up in terms of its header style, text styles and such.
+
+    Instance Variables
+    =====================================
+    - self.run_in_process = If this is true, a Sequence runs the task's execute() in a worker process instead of in the workflow's own process. This is meant for CPU-bound tasks (such as XlsToCsv), which
+    otherwise hold the GIL. The task and its input are pickled and sent to the worker; its exhaust, status and output are sent back. Other changes the task makes to itself in the worker are not.
+    - self.resources = The resources.Resources the task needs to run, or None. A step that runs on this host only starts once they are available; see the resources module.
     """
 
+    __slots__ = ('run_in_process', 'resources')
+
     def __init__(self):
         super().__init__()
+        self.run_in_process = False
+        self.resources = None
 
     def _get_header_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'devOpsTaskHeaderStyle'))
+        return _get_console_setting('devOpsTaskHeaderStyle')
 
     def _get_footer_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'devOpsTaskFooterStyle'))
+        return _get_console_setting('devOpsTaskFooterStyle')
 
     def _get_text_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'devOpsTaskTextStyle'))
+        return _get_console_setting('devOpsTaskTextStyle')
 
     def _prehook(self):
         self._w_print('Starting ==> {}'.format(self.step_name), WorkflowTask.TextStyle.Header)
@@ -221,20 +513,22 @@ class DevOpsTask(WorkflowTask):
 class ControlFlowTask(WorkflowTask):
 
     """
-    ControlFlowTask is a super class for all concrete control flow tasks like IfElse or ForEach (not yet implemented). It has some basic structure set up in terms of its header style, text styles and such.
+    ControlFlowTask is a super class for all concrete control flow tasks like IfElse or ForEach. It has some basic structure set up in terms of its header style, text styles and such.
     """
 
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
 
     def _get_header_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'controlFlowTaskHeaderStyle'))
+        return _get_console_setting('controlFlowTaskHeaderStyle')
 
     def _get_footer_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'controlFlowTaskFooterStyle'))
+        return _get_console_setting('controlFlowTaskFooterStyle')
 
     def _get_text_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'controlFlowTaskTextStyle'))
+        return _get_console_setting('controlFlowTaskTextStyle')
 
     def _prehook(self, style=''):
         self._w_print('Starting ==> {}'.format(self.step_name), WorkflowTask.TextStyle.Header)
@@ -245,6 +539,115 @@ class ControlFlowTask(WorkflowTask):
         self._w_print('Complete ==> {}'.format(self.step_name), WorkflowTask.TextStyle.Footer)
 
 
+class WorkflowListener(object):
+
+    """
+    WorkflowListener is the base class for objects that want to follow the progress of a workflow, such as a status display or a run history. Register one with Sequence.add_listener(); it is then told
+    about every Sequence and step below that Sequence. All of the methods do nothing by default, so subclasses only need to override the ones they care about.
+
+    Listeners are called on the thread that runs the step, which for a parallel ForEach is not the main thread.
+    """
+
+    def sequence_started(self, sequence):
+        pass
+
+    def sequence_finished(self, sequence):
+        """
+        sequence.status tells whether the Sequence completed with or without errors.
+        """
+
+        pass
+
+    def step_started(self, sequence, step_name, step):
+        pass
+
+    def step_finished(self, sequence, step_name, step, error=None):
+        """
+        step.status tells whether the step completed with or without errors. If it failed, error is the formatted traceback.
+        """
+
+        pass
+
+
+class RunSummary(WorkflowListener):
+
+    """
+    A WorkflowListener that keeps the totals of the steps that finished, and of the resources used by the child processes of the tasks that publish them (the rusage exhaust variable, see
+    ExecuteCommand), and the slowest steps. MainSequence prints one at the end of every run. Only the slowest steps are kept, so a run of many (e.g. streamed) steps doesn't grow it.
+
+    Instance Variables
+    =====================================
+    - self.slowest = The number of slowest steps that are kept.
+    - self.count = The number of steps that have finished.
+    - self.statuses = A Counter of the status of every step that has finished.
+    - self.rusage = The resources used by all of the steps' child processes: the sums, except max_rss_bytes, which is the largest.
+    """
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.count = 0
+        self.statuses = collections.Counter()
+        self.rusage = collections.Counter()
+        self._slowest_steps = []
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def step_started(self, sequence, step_name, step):
+        with self._lock:
+            self._started[id(step)] = time.monotonic()
+
+    def step_finished(self, sequence, step_name, step, error=None):
+        with self._lock:
+            seconds = time.monotonic() - self._started.pop(id(step), time.monotonic())
+        # A Sequence's exhaust includes its steps' exhaust, so only a DevOpsTask's rusage is its own.
+        rusage = step._exhaust.get('rusage') if isinstance(step, DevOpsTask) and step._exhaust else None
+        self.add(step_name, step.status, seconds, rusage)
+
+    def add(self, step_name, status, seconds, rusage=None):
+        """
+        Adds a finished step: its name, status, wall seconds and rusage (or None).
+        """
+
+        import heapq
+        with self._lock:
+            self.count += 1
+            self.statuses[status] += 1
+            if rusage:
+                self.rusage.update({key: value for key, value in rusage.items() if key != 'max_rss_bytes'})
+                self.rusage['max_rss_bytes'] = max(self.rusage['max_rss_bytes'], rusage.get('max_rss_bytes', 0))
+            # A min-heap of the slowest steps so far; the step order breaks ties, so the names, statuses and rusage are never compared.
+            entry = (seconds, -self.count, step_name, status, rusage)
+            if len(self._slowest_steps) < self.slowest:
+                heapq.heappush(self._slowest_steps, entry)
+            elif entry > self._slowest_steps[0]:
+                heapq.heapreplace(self._slowest_steps, entry)
+
+    def get_lines(self, slowest=None):
+        """
+        Returns the summary as lines of text: the total child process resources used, then the slowest steps (at most self.slowest), with their own resources.
+        """
+
+        with self._lock:
+            count, failed, totals = self.count, self.statuses[WorkflowTask.Status.CompletedError], dict(self.rusage)
+            steps = sorted(self._slowest_steps, reverse=True)
+        lines = ['Run summary: {} step(s), {} failed'.format(count, failed)]
+        if totals:
+            lines.append('Child processes: ' + _format_rusage(totals))
+        for seconds, _, step_name, status, rusage in steps[:slowest]:
+            failed = ' (failed)' if status == WorkflowTask.Status.CompletedError else ''
+            lines.append('{:.3f}s {}{}{}'.format(seconds, step_name, failed, '; ' + _format_rusage(rusage) if rusage else ''))
+        return lines
+
+
+def _format_rusage(rusage):
+    parts = ['wall {:.3f}s'.format(rusage.get('wall_seconds', 0))]
+    if 'user_seconds' in rusage:
+        parts.append('user {:.3f}s, system {:.3f}s, max rss {:.1f} MB'.format(rusage['user_seconds'], rusage['system_seconds'], rusage['max_rss_bytes'] / 1048576))
+        parts.append('block i/o {}/{}, context switches {}/{}'.format(rusage['block_input'], rusage['block_output'], rusage['voluntary_context_switches'], rusage['involuntary_context_switches']))
+    parts.append('output {} bytes'.format(rusage.get('output_bytes', 0)))
+    return ', '.join(parts)
+
+
 class Sequence(WorkflowTask):
 
     """
@@ -253,77 +656,343 @@ class Sequence(WorkflowTask):
 
     Instance Variables
     =====================================
-     -self._workflowsteps - the OrderedDict of WorkflowTask items.
+     -self._workflowsteps - the OrderedDict of WorkflowTask items. Steps can also be streamed in from an iterable with addsteps().
+    - self.listeners = The WorkflowListener items registered with add_listener(), or None.
+    - self.step_executor = If set, every DevOpsTask in this Sequence (and in the Sequences below it) is handed to this step executor instead of being run in this process, e.g. a distributed.Coordinator.
     - self.parent = the parent this sequence. This is an explicit keyword argument of this class (vs just being a property one can set) for convenience - when setting up a Sequence in IfElse for the left and right
     steps, it is easy to just set this constructor parameter; in other cases, it is just set later.
+    - self.max_workers = The number of steps that may run at the same time, if the steps declare what they depend on (see addstep()). 1 (the default) runs the steps one after another.
+    - self.cost_estimates = A dictionary of step name to expected duration (in seconds), or None. Used with the costs declared in addstep() to decide which ready step starts first; MainSequence fills
+    it in from the run history, if one is configured.
     """
 
-    def __init__(self, parent=None):
+    __slots__ = ('_workflowsteps', 'step_executor', 'listeners', 'max_workers', 'cost_estimates', '_dependencies', '_costs')
+
+    def __init__(self, parent=None, max_workers=1):
         super().__init__()
         self._workflowsteps = collections.OrderedDict()
         self.parent = parent
+        self.step_executor = None
+        self.listeners = None
+        self.max_workers = max_workers
+        self.cost_estimates = None
+        self._dependencies = None
+        self._costs = None
 
     def _get_header_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'sequenceHeaderStyle'))
+        return _get_console_setting('sequenceHeaderStyle')
 
     def _get_footer_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'sequenceFooterStyle'))
+        return _get_console_setting('sequenceFooterStyle')
 
     def _get_text_style(self):
-        return eval(get_system_config_value('ConsoleOutput', 'sequenceTextStyle'))
+        return _get_console_setting('sequenceTextStyle')
 
     def execute(self, step_name='', existing_variables=None):
         """
         The Sequence implementation of execute is the primary driver of a workflow. It iterates over all of the steps in workflowsteps exceuting each one in order. It also takes care of calling the pre and posthook
-        methods of the WorkflowTask, in addition to pushing workflowvariables through the pipeline.
+        methods of the WorkflowTask, in addition to pushing workflowvariables through the pipeline. The exhaust of every step is also collected into the exhaust of the Sequence itself.
+
+        workflowvariables is a VariableScope; existing_variables can be one (its changes are then seen by the caller) or a dictionary (which is copied). Every step gets a snapshot of the variables as its input,
+        and its exhaust is written back into workflowvariables for the steps after it.
         """
 
         super().execute(step_name)
 
-        if existing_variables is not None:
+        if isinstance(existing_variables, VariableScope):
             workflowvariables = existing_variables
         else:
-            workflowvariables = {}
+            workflowvariables = VariableScope(existing_variables)
 
         print('\n')
 
+        listeners = self._get_listeners()
+        self.status = WorkflowTask.Status.Running
+        for listener in listeners:
+            listener.sequence_started(self)
+
         errors_found = False
+        try:
+            if self._dependencies and self.max_workers > 1:
+                errors_found = self._execute_graph(workflowvariables, listeners)
+            else:
+                for key, step in self._iter_steps():
+                    if not self._execute_step(key, step, workflowvariables, listeners):
+                        errors_found = True
+                    # Drop the reference before the next step is pulled, so that steps from a step source are released as soon as they complete.
+                    step = None
+        except:
+            errors_found = True
+            raise
+        finally:
+            if errors_found is True:
+                self.status = WorkflowTask.Status.CompletedError
+            else:
+                self.status = WorkflowTask.Status.CompletedOK
+            for listener in listeners:
+                listener.sequence_finished(self)
+
+    def _iter_steps(self):
+        """
+        Yields (step name, step) pairs in execution order. Step sources added with addsteps() are pulled from lazily, one step at a time, as the Sequence gets to them.
+        """
+
         for key in self._workflowsteps:
-            try:
-                self._workflowsteps[key].input = workflowvariables
-                self._workflowsteps[key]._prehook()
-                self._workflowsteps[key].execute(step_name=key)
-                self._workflowsteps[key]._posthook()
-                workflowvariables.update(self._workflowsteps[key].exhaust)
-                self._workflowsteps[key].status = WorkflowTask.Status.CompletedOK
-                print('\n')
-
-            except:
-                errors_found = True
-                self._workflowsteps[key].status = WorkflowTask.Status.CompletedError
-                self._w_print("Unexpected error in workflow step {}.".format(key), WorkflowTask.TextStyle.Error, loglevel=logging.ERROR)
-                errorlist = traceback.format_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
-                for e in errorlist:
-                    self._w_print(e, WorkflowTask.TextStyle.Error)
-
-                if self._workflowsteps[key].continue_on_error is True:
-                    continue
-                else:
-                    raise
-
-        if errors_found is True:
-            self.status = WorkflowTask.Status.CompletedError
+            yield from self._iter_step(key)
+
+    def _iter_step(self, key):
+        step = self._workflowsteps[key]
+        if isinstance(step, _StepSource):
+            for name, task in step.steps:
+                if not isinstance(task, StepRecord):
+                    task.step_name = name
+                    task.parent = self
+                yield name, task
+                task = None
         else:
-            self.status = WorkflowTask.Status.CompletedOK
+            yield key, step
+
+    def _execute_graph(self, workflowvariables, listeners):
+        """
+        Executes the steps as a graph of dependencies (see addstep()), running up to self.max_workers of them at the same time. Of the steps that are ready to run, the one with the longest remaining path
+        (its own cost plus that of the costliest chain of steps waiting on it) starts first, so the critical path is never held up by shorter steps, which fill in the gaps around it. Without costs, the
+        steps start in the order they were added. Returns True if a step failed but was allowed to continue on error; once a step fails otherwise, no more steps are started, and its exception is
+        re-raised when the running steps have finished.
+        """
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        import heapq
+        names = list(self._workflowsteps)
+        dependents, waiting = self._get_dependency_graph(names)
+        ranks = self._get_critical_path_ranks(names, dependents)
+        ready = [(-ranks[index], index) for index, count in enumerate(waiting) if not count]
+        heapq.heapify(ready)
+        lock = threading.Lock()
+        errors_found = False
+        failure = None
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while running or (ready and failure is None):
+                    while ready and failure is None and len(running) < self.max_workers:
+                        index = heapq.heappop(ready)[1]
+                        running[executor.submit(self._execute_graph_step, names[index], workflowvariables, listeners, lock)] = index
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = running.pop(future)
+                        try:
+                            if not future.result():
+                                errors_found = True
+                        except BaseException as e:
+                            failure = failure or e
+                            continue
+                        for dependent in dependents[index]:
+                            waiting[dependent] -= 1
+                            if not waiting[dependent]:
+                                heapq.heappush(ready, (-ranks[dependent], dependent))
+            finally:
+                wait(running)
+        if failure is not None:
+            raise failure
+        return errors_found
+
+    def _get_dependency_graph(self, names):
+        """
+        Returns, for every step (by index in names), the indexes of the steps that depend on it and the number of steps it depends on. A step added without depends_on depends on the step added before it.
+        """
+
+        indexes = {name: index for index, name in enumerate(names)}
+        dependents = [[] for name in names]
+        waiting = [0] * len(names)
+        for index, name in enumerate(names):
+            depends_on = self._dependencies.get(name)
+            if depends_on is None:
+                depends_on = names[index - 1:index]
+            unknown = [dependency for dependency in depends_on if dependency not in indexes]
+            if unknown:
+                raise ValueError('Step {} depends on unknown step(s): {}'.format(name, ', '.join(unknown)))
+            for dependency in set(depends_on):
+                dependents[indexes[dependency]].append(index)
+                waiting[index] += 1
+        return dependents, waiting
+
+    def _get_critical_path_ranks(self, names, dependents):
+        """
+        Returns the rank of every step: its cost plus the highest rank of the steps that depend on it, i.e. the length of the longest path from its start to the end of the Sequence. A step's cost is the one
+        declared in addstep(), else its entry in self.cost_estimates, else the mean of the costs that are known (or 0).
+        """
+
+        costs = [(self._costs or {}).get(name, (self.cost_estimates or {}).get(name)) for name in names]
+        known = [cost for cost in costs if cost is not None]
+        default = sum(known) / len(known) if known else 0
+        costs = [default if cost is None else cost for cost in costs]
+
+        # Ranks are computed in reverse topological order (Kahn's algorithm), which also finds cycles.
+        incoming = [0] * len(names)
+        for targets in dependents:
+            for target in targets:
+                incoming[target] += 1
+        order = [index for index, count in enumerate(incoming) if not count]
+        for index in order:
+            for target in dependents[index]:
+                incoming[target] -= 1
+                if not incoming[target]:
+                    order.append(target)
+        if len(order) < len(names):
+            raise ValueError('The steps have a dependency cycle: {}'.format(', '.join(name for index, name in enumerate(names) if incoming[index])))
+        ranks = [0] * len(names)
+        for index in reversed(order):
+            ranks[index] = costs[index] + max((ranks[target] for target in dependents[index]), default=0)
+        return ranks
+
+    def _execute_graph_step(self, key, workflowvariables, listeners, lock):
+        # A step source is a single node of the graph; its steps run one after another.
+        succeeded = True
+        for name, step in self._iter_step(key):
+            if not self._execute_step(name, step, workflowvariables, listeners, lock):
+                succeeded = False
+            step = None
+        return succeeded
+
+    def _execute_step(self, key, step, workflowvariables, listeners=(), lock=None):
+        """
+        Executes a single step, calling its pre and posthook methods and pushing its exhaust into workflowvariables. Returns False if the step failed but is allowed to continue on error; otherwise the
+        exception is re-raised. listeners are told when the step starts and finishes. If steps run at the same time, lock guards workflowvariables and the exhaust of the Sequence.
+        """
+
+        record = step if isinstance(step, StepRecord) else None
+        error = None
+        started = False
+        admitted = False
+        try:
+            if record is not None:
+                step = record.build(key, self)
+            executor = self._get_step_executor(step)
+            if isinstance(step, DevOpsTask) and (executor is None or isinstance(executor, ProcessPoolStepExecutor)):
+                # Steps that run on this host wait for the resources they declare (see the resources module).
+                resources = getattr(step, 'resources', None)
+                governor = get_governor()
+                governor.acquire(resources)
+                admitted = True
+            step.status = WorkflowTask.Status.Running
+            for listener in listeners:
+                listener.step_started(self, key, step)
+            started = True
+            with lock or _NO_LOCK:
+                step.input = workflowvariables.snapshot()
+            step._prehook()
+            if executor is not None:
+                _execute_elsewhere(step, key, executor)
+            else:
+                step.execute(step_name=key)
+            step._posthook()
+            if step._exhaust:
+                with lock or _NO_LOCK:
+                    workflowvariables.update(step._exhaust)
+                    self.exhaust.update(step._exhaust)
+            step.status = WorkflowTask.Status.CompletedOK
+            print('\n')
+            return True
+
+        except:
+            step.status = WorkflowTask.Status.CompletedError
+            self._w_print("Unexpected error in workflow step {}.".format(key), WorkflowTask.TextStyle.Error, loglevel=logging.ERROR)
+            errorlist = traceback.format_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
+            for e in errorlist:
+                self._w_print(e, WorkflowTask.TextStyle.Error)
+            error = ''.join(errorlist)
+
+            if step.continue_on_error is True:
+                return False
+            else:
+                raise
+
+        finally:
+            if admitted:
+                governor.release(resources)
+            if record is not None:
+                record.status = step.status
+            if started:
+                for listener in listeners:
+                    listener.step_finished(self, key, step, error)
+
+    def _get_listeners(self):
+        """
+        Returns the WorkflowListener items registered on this Sequence and all of its ancestors.
+        """
+
+        listeners = []
+        node = self
+        while node is not None:
+            node_listeners = getattr(node, 'listeners', None)
+            if node_listeners:
+                listeners.extend(node_listeners)
+            node = node.parent
+        return listeners
 
-    def addstep(self, workflowname, workflow):
+    def add_listener(self, listener):
         """
-        addstep() is specific to the Sequence class. It is the primary way to add WorkflowTask items to the Sequence.
+        Registers a WorkflowListener. It is told about every step of this Sequence, and of every Sequence below it.
+        """
+
+        if self.listeners is None:
+            self.listeners = []
+        self.listeners.append(listener)
+
+    def _get_step_executor(self, step):
+        """
+        Returns the step executor a step should be handed to, or None if it should run in this process. If a step_executor is set on this Sequence or any of its ancestors, every DevOpsTask step is handed
+        to it; otherwise only DevOpsTask steps with run_in_process set are, and they go to the local worker process pool.
+        """
+
+        if not isinstance(step, DevOpsTask):
+            return None
+        node = self
+        while node is not None:
+            executor = getattr(node, 'step_executor', None)
+            if executor is not None:
+                return executor
+            node = node.parent
+        if getattr(step, 'run_in_process', False):
+            return ProcessPoolStepExecutor()
+        return None
+
+    def addstep(self, workflowname, workflow, depends_on=None, cost=None):
+        """
+        addstep() is specific to the Sequence class. It is the primary way to add WorkflowTask items to the Sequence. A StepRecord can be added in place of a WorkflowTask.
+
+        depends_on names the steps that must complete before this one starts; it lets steps run at the same time when the Sequence has max_workers > 1. A step added without it depends on the step added
+        before it, so depends_on=() is needed for a step to start straight away. cost is the expected duration of the step (in seconds), used to start the steps on the longest path first.
+
+        workflow = Sequence(max_workers=4)
+        workflow.addstep('Checkout', git.Clone(repository, 'src'))
+        workflow.addstep('Unit tests', ExecuteCommand('make test', 'src'), depends_on=['Checkout'], cost=600)
+        workflow.addstep('Docs', ExecuteCommand('make docs', 'src'), depends_on=['Checkout'], cost=60)
         """
 
         self._workflowsteps[workflowname] = workflow
-        self._workflowsteps[workflowname].step_name = workflowname
-        self._workflowsteps[workflowname].parent = self
+        if depends_on is not None:
+            if self._dependencies is None:
+                self._dependencies = {}
+            self._dependencies[workflowname] = tuple(depends_on)
+        if cost is not None:
+            if self._costs is None:
+                self._costs = {}
+            self._costs[workflowname] = cost
+        if not isinstance(workflow, StepRecord):
+            self._workflowsteps[workflowname].step_name = workflowname
+            self._workflowsteps[workflowname].parent = self
+
+    def addsteps(self, steps):
+        """
+        addsteps() attaches a source of steps to the Sequence: any iterable (e.g. a generator) of (step name, WorkflowTask or StepRecord) pairs. The source is not read until execute() reaches it, and then only
+        one step at a time, so a workflow over millions of inputs never has to hold all of its steps in memory. Steps from a source are not kept by the Sequence once they complete, so they can't be
+        looked up with get(), and a source can only be executed once.
+
+        workflow.addsteps(('Copy {}'.format(name), Copy(name, name + '.bak')) for name in os.listdir(directory))
+        """
+
+        self._workflowsteps['<step source {}>'.format(len(self._workflowsteps))] = _StepSource(steps)
 
     def get(self, key):
         """
@@ -333,19 +1002,105 @@ class Sequence(WorkflowTask):
         return self._workflowsteps[key]
 
 
+_NO_LOCK = contextlib.nullcontext()
+
+
+class _StepSource(object):
+
+    """
+    Wraps an iterable of (step name, step) pairs added to a Sequence with addsteps().
+    """
+
+    __slots__ = ('steps',)
+
+    def __init__(self, steps):
+        self.steps = steps
+
+
+class StepRecord(object):
+
+    """
+    StepRecord is a lightweight stand-in for a WorkflowTask in a Sequence. It only holds the task class and its constructor arguments; the task itself is built right before the step is executed and is
+    released again once it is complete, leaving only its status behind in the record. This keeps workflows with hundreds of thousands of small steps (e.g. one Copy per file) small in memory:
+
+    workflow.addstep('Copy a.txt', StepRecord(Copy, 'a.txt', 'b.txt'))
+
+    Instance Variables
+    =====================================
+    - self.task_class = The WorkflowTask subclass to build.
+    - self.args = The positional arguments for the task_class constructor.
+    - self.kwargs = The keyword arguments for the task_class constructor, or None.
+    - self.status = The status of the step, once it has run. See WorkflowTask.Status.
+    - self.continue_on_error = Passed on to the task when it is built.
+    - self.resources = If not None, set on the task when it is built (see DevOpsTask.resources).
+    """
+
+    __slots__ = ('task_class', 'args', 'kwargs', 'status', 'continue_on_error', 'resources')
+
+    def __init__(self, task_class, *args, **kwargs):
+        self.task_class = task_class
+        self.args = args
+        self.kwargs = kwargs or None
+        self.status = WorkflowTask.Status.NotYetRun
+        self.continue_on_error = False
+        self.resources = None
+
+    def build(self, step_name, parent):
+        """
+        Builds the WorkflowTask described by this record.
+        """
+
+        task = self.task_class(*self.args, **(self.kwargs or {}))
+        task.step_name = step_name
+        task.parent = parent
+        task.continue_on_error = self.continue_on_error
+        if self.resources is not None:
+            task.resources = self.resources
+        return task
+
+
 class MainSequence(Sequence):
 
     """
     MainSequence is a helper class that is intended to serve as the main or primary Sequence of a workflow. It takes care of setting the default indentation level,
-    in addition to outputting the start and complete messages of a standard workflow.
+    in addition to outputting the start and complete messages of a standard workflow, and a RunSummary at the end of the run. If tracing or a run history is configured (see the tracing and
+    history modules), every run is traced or recorded, and the durations of earlier runs become the cost estimates of the steps (see Sequence.addstep()).
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+
+    def __init__(self, max_workers=1):
+        super().__init__(max_workers=max_workers)
 
     def execute(self, step_name='', existing_variables=None):
+        if step_name:
+            # Names the run, e.g. for the run history.
+            self.step_name = step_name
         self._prehook()
-        super().execute(step_name)
+        summary = RunSummary()
+        listeners = [summary]
+        if get_system_config_value('Tracing', 'directory', fallback=''):
+            from .tracing import Tracer
+            listeners.append(Tracer())
+        if get_system_config_value('History', 'database', fallback=''):
+            import sqlite3
+            from .history import RunHistory
+            history = RunHistory()
+            listeners.append(history)
+            try:
+                _set_cost_estimates(self, history.step_durations(history.get_workflow_name(self)))
+            except sqlite3.Error as e:
+                # The history only improves scheduling; a locked or corrupt database mustn't stop the run.
+                logging.warning('Not using the run history for cost estimates: %s', e)
+        for listener in listeners:
+            self.add_listener(listener)
+        try:
+            super().execute(step_name, existing_variables)
+        finally:
+            for listener in listeners:
+                self.listeners.remove(listener)
+            for line in summary.get_lines():
+                self._w_print(line)
         self._posthook()
 
     def _prehook(self):
@@ -360,6 +1115,17 @@ class MainSequence(Sequence):
         return 0
 
 
+def _set_cost_estimates(sequence, durations, prefix=''):
+    """
+    Sets the cost estimates of a Sequence, and of the Sequences that are steps of it, from durations: a dictionary of step path (see the history module) to seconds.
+    """
+
+    sequence.cost_estimates = {name: durations[prefix + name] for name in sequence._workflowsteps if prefix + name in durations}
+    for name, step in sequence._workflowsteps.items():
+        if isinstance(step, Sequence):
+            _set_cost_estimates(step, durations, prefix + name + '/')
+
+
 class IfElse(ControlFlowTask):
 
     """
@@ -372,6 +1138,11 @@ class IfElse(ControlFlowTask):
 
     test = IfElse( 1 != 2, ifworkflowname='some_workflow', ifworkflow=some_workflow_task, elseworkflowname='some_else_workflow', elseworkflow=some_workflow_task1 )
 
+    The condition can also be a callable, which is called with the workflow variables when the IfElse is executed, so that it can depend on what earlier steps have done. A branch can be given as a factory
+    that builds it, which is only called for the branch that is chosen:
+
+    test = IfElse(lambda variables: os.path.exists(variables['distribution_directory']), iffactory=build_clean_steps, elsefactory=build_make_steps)
+
     Noteworthy Methods
     =====================================
     - exceute(): This will evaluate the condition property set in the constructor. If it is true, the workflow task set in add_true_handler (or the if portion of the constructor) is called. Otherwise the
@@ -381,12 +1152,16 @@ class IfElse(ControlFlowTask):
 
     Instance Variables
     =====================================
-    - self.condition: The condition that must be satisfied for the tasks in self._leftsteps to be executed.
+    - self.condition: The condition that must be satisfied for the tasks in self._leftsteps to be executed. Either True/False, or a callable that takes the workflow variables.
     - self._leftsteps: If self.condition evaluates to true, these steps will be executed.
     - self._rightsteps: If self.condition evaluates to false, these steps will be executed.
+    - self.iffactory: If set, a callable that takes the workflow variables and returns the WorkflowTask (usually a Sequence) to execute when self.condition evaluates to true, after self._leftsteps.
+    - self.elsefactory: Likewise for when self.condition evaluates to false, after self._rightsteps.
     """
 
-    def __init__(self, condition, ifworkflowname=None, ifworkflow=None, elseworkflowname=None, elseworkflow=None):
+    __slots__ = ('condition', '_leftsteps', '_rightsteps', 'iffactory', 'elsefactory')
+
+    def __init__(self, condition, ifworkflowname=None, ifworkflow=None, elseworkflowname=None, elseworkflow=None, iffactory=None, elsefactory=None):
         """
         Sets up IfElse; if all arguments are passed in (including keyword args) it will take care of adding a true and false handler. If multiple true and false handlers are needed, condition should be supplied,
         and then add_true_handler() and add_false_handler() should be called multiple times after IfElse is constructed.
@@ -394,6 +1169,8 @@ class IfElse(ControlFlowTask):
 
         super().__init__()
         self.condition = condition
+        self.iffactory = iffactory
+        self.elsefactory = elsefactory
         self._leftsteps = Sequence(parent=self)
         self._rightsteps = Sequence(parent=self)
         if ifworkflow is not None and ifworkflowname is not None:
@@ -404,16 +1181,30 @@ class IfElse(ControlFlowTask):
     def execute(self, step_name=''):
         """
         This will evaluate the condition property set in the constructor. If it is true, the workflow task set in add_true_handler (or the if portion of the constructor) is called. Otherwise the
-        workflow task set in add_false_handler (or the false portion of the constructor) is called.
+        workflow task set in add_false_handler (or the false portion of the constructor) is called. The factory of the chosen branch, if any, is then called and what it builds is executed.
         """
 
         super().execute(step_name)
-        if self.condition is True:
+        if self._evaluate_condition():
             self._w_print('Conditional evaluates to True.')
-            self._leftsteps.execute(existing_variables=self.input)
+            steps, factory, branch = self._leftsteps, self.iffactory, 'true'
         else:
             self._w_print('Conditional evaluates to False.')
-            self._rightsteps.execute(existing_variables=self.input)
+            steps, factory, branch = self._rightsteps, self.elsefactory, 'false'
+        variables = _snapshot(self.input)
+        if steps._workflowsteps or factory is None:
+            steps.execute(existing_variables=variables)
+            self.exhaust.update(steps.exhaust)
+        if factory is not None:
+            name = '{} [{}]'.format(self.step_name, branch)
+            built = _as_sequence(factory(variables), name, self)
+            built.execute(step_name=name, existing_variables=variables)
+            self.exhaust.update(built.exhaust)
+
+    def _evaluate_condition(self):
+        if callable(self.condition):
+            return bool(self.condition(self.input))
+        return self.condition is True
 
     def add_true_handler(self, workflowname, workflow):
         """
@@ -428,3 +1219,117 @@ class IfElse(ControlFlowTask):
         """
 
         self._rightsteps.addstep(workflowname, workflow)
+
+
+def _as_sequence(task, name, parent):
+    """
+    Returns task, wrapped in a Sequence of its own if it is not one already, ready to be executed below parent.
+    """
+
+    if not isinstance(task, Sequence):
+        sequence = Sequence()
+        sequence.addstep(name, task)
+        task = sequence
+    task.parent = parent
+    task.step_name = name
+    return task
+
+
+class ForEach(ControlFlowTask):
+
+    """
+    ForEach is a concrete control flow task that runs a body once for every item of an iterable, much like a for loop. The body is a callable that takes an item and returns the WorkflowTask (usually a
+    Sequence) to run for it; a new body is built for every iteration so that iterations don't share state. To use:
+
+    def copy_file(name):
+        body = Sequence()
+        body.addstep('Copy {}'.format(name), Copy(name, name + '.bak'))
+        return body
+
+    test = ForEach(os.listdir(directory), copy_file, max_workers=4)
+
+    Each iteration sees the input workflow variables plus the current item (under variable_name). The exhaust of every iteration is collected, in the order of the iterable, into a list that is published as
+    the ForEach's own exhaust under results_name.
+
+    Instance Variables
+    =====================================
+    - self.iterable: The items to iterate over. It is only read as iterations are started, so it can be a generator.
+    - self.body: A callable that takes an item (or a list of items, see batch_size) and returns the WorkflowTask to run for it.
+    - self.variable_name: The workflow variable the current item is bound to.
+    - self.max_workers: The maximum number of iterations that run at the same time. The default of 1 runs iterations one after another.
+    - self.batch_size: If set, the iterable is split into lists of up to batch_size items, and the body runs once per list rather than once per item.
+    - self.results_name: The exhaust variable the list of iteration results is published under.
+    """
+
+    __slots__ = ('iterable', 'body', 'variable_name', 'max_workers', 'batch_size', 'results_name')
+
+    def __init__(self, iterable, body, variable_name='item', max_workers=1, batch_size=None, results_name='results'):
+        super().__init__()
+        self.iterable = iterable
+        self.body = body
+        self.variable_name = variable_name
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.results_name = results_name
+
+    def execute(self, step_name=''):
+        """
+        Runs the body for every item. If max_workers is greater than 1, up to max_workers iterations run in parallel on a thread pool; items are pulled from the iterable only as fast as the pool can take them.
+        If an iteration fails, no further iterations are started and the error is re-raised once the running ones have finished.
+        """
+
+        super().execute(step_name)
+        items = self._iter_items()
+        if self.max_workers > 1:
+            results = self._execute_parallel(items)
+        else:
+            results = [self._execute_iteration(index, item) for index, item in enumerate(items)]
+        self._w_print('Completed {} iteration(s).'.format(len(results)))
+        self.exhaust[self.results_name] = results
+
+    def _iter_items(self):
+        if not self.batch_size:
+            return iter(self.iterable)
+        iterator = iter(self.iterable)
+        return iter(lambda: list(itertools.islice(iterator, self.batch_size)), [])
+
+    def _execute_iteration(self, index, item):
+        """
+        Builds and runs the body for a single item, returning its exhaust.
+        """
+
+        variables = _snapshot(self.input)
+        variables[self.variable_name] = item
+        name = '{} [{}]'.format(self.step_name, index)
+        body = _as_sequence(self.body(item), name, self)
+        body.execute(step_name=name, existing_variables=variables)
+        return body.exhaust
+
+    def _execute_parallel(self, items):
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        results = {}
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for index, item in enumerate(items):
+                    # Iterations that have finished are collected before every submit, so that a failure stops the loop straight away.
+                    done = {future for future in pending if future.done()}
+                    if len(pending) - len(done) >= self.max_workers * 2:
+                        done |= wait(pending - done, return_when=FIRST_COMPLETED).done
+                    pending -= done
+                    self._collect(done, results)
+                    future = executor.submit(self._execute_iteration, index, item)
+                    future.index = index
+                    pending.add(future)
+                done, pending = wait(pending)
+                self._collect(done, results)
+            finally:
+                # Iterations that are queued but haven't started are dropped.
+                for future in pending:
+                    future.cancel()
+                wait(pending)
+        return [results[index] for index in range(len(results))]
+
+    def _collect(self, done, results):
+        for future in done:
+            results[future.index] = future.result()
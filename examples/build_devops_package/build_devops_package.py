@@ -27,7 +27,8 @@ def get_configuration_data(variable_config):
 
 
 def get_setup_dir_conditional(config):
-    setup_dir_conditional = IfElse(os.path.exists(config['distribution_root_directory']))
+    # The condition is checked when the step is reached, rather than when the workflow is built.
+    setup_dir_conditional = IfElse(lambda variables: os.path.exists(config['distribution_root_directory']))
     make_dist_dir = 'Make Distribution Directory.', MakeDirectory(config['distribution_root_directory'])
 
     setup_dir_conditional.add_true_handler('Clean Distribution Directory.',